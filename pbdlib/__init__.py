@@ -4,7 +4,11 @@ from .gmm import GMM
 from .gmr import GMR
 from .hmm import HMM
 from .hsmm import HSMM
-from .model import Model
+from .model import Model, BlockStructure
+from .em_utils import SufficientStats, EMTrace
+from .kmeans import kmeans, kmeans_plusplus
+from .online import HMMFilter, FixedLagSmoother, HSMMFilter
+from .bank import HMMBank
 from .mvn import *
 from .plot import *
 from .pylqr import *
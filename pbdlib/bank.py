@@ -0,0 +1,198 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from .functions import multi_variate_normal_batch, forward_log_likelihood, triangular_inv
+from .hmm import HMM
+
+# state of scoring worker processes
+_worker = {}
+
+
+def _bank_init(bank):
+    _worker['bank'] = bank
+
+
+def _bank_job(demos):
+    return _worker['bank']._log_likelihood(demos)
+
+
+class HMMBank(object):
+    """
+    Bank of HMMs of the same dimension, to evaluate the likelihood of sequences under all
+    models at once, e.g. for classification. The parameters of the models are stacked
+    (states padded to the largest model) such that observation likelihoods of all states of
+    all models are computed in one pass and the forward recursions of all (sequence, model)
+    pairs run as one batched product per timestep.
+
+    The parameters of the models are read when the bank is created.
+    """
+
+    def __init__(self, models, marginal=None, n_jobs=1, batch_size=64, chunk_size=4096):
+        """
+
+        :param models: 		[list of HMM]
+        :param marginal: 	[slice(dim_start, dim_end)] or [list of int] or None
+                If not None, sequences only contain these dimensions
+        :param n_jobs: 		[int]
+                Number of processes over which sequences are split, -1 uses all processors.
+                If 1, sequences are evaluated in this process.
+        :param batch_size: 	[int]
+                Number of sequences whose forward recursions are run together, sequences of
+                similar lengths are grouped to limit padding
+        :param chunk_size: 	[int]
+                Number of samples for which observation likelihoods are computed at once
+        """
+        self.nb_models = len(models)
+        self.nb_states = max([m.nb_states for m in models])
+        self.marginal = marginal
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+
+        nb_models, nb_states = self.nb_models, self.nb_states
+
+        # padded states have no initial or transition probability
+        self.init_priors = np.zeros((nb_models, 1, nb_states))
+        self.Trans = np.zeros((nb_models, nb_states, nb_states))
+        self.state_mask = np.zeros((nb_models, nb_states), dtype=bool)
+
+        # models with their own observation model are evaluated separately
+        self.custom = {}
+
+        mus, sigma_chols = [], []
+        for k, m in enumerate(models):
+            n = m.nb_states
+            self.init_priors[k, 0, :n] = m.init_priors
+            self.Trans[k, :n, :n] = m.Trans
+            self.state_mask[k, :n] = True
+
+            if type(m).obs_likelihood is not HMM.obs_likelihood:
+                self.custom[k] = m
+                continue
+
+            if marginal is not None:
+                mu, sigma = m.get_marginal(marginal)
+            else:
+                mu, sigma = m.mu, m.sigma
+
+            mus += [mu]
+            sigma_chols += [np.linalg.cholesky(sigma)]
+
+        # index of stacked Gaussian states in [nb_models, nb_states] arrays
+        self.gaussian = np.array([k for k in range(nb_models) if k not in self.custom], dtype=int)
+        self.mu = np.concatenate(mus, axis=0) if mus else None
+        self.sigma_chol = np.concatenate(sigma_chols, axis=0) if mus else None
+        self.chol_inv = triangular_inv(self.sigma_chol) if mus else None
+
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self._pool = None
+        if n_jobs is not None and n_jobs > 1:
+            self._pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=_bank_init,
+                                             initargs=(self, ))
+        self.n_jobs = n_jobs
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def obs_likelihood(self, data):
+        """
+        :param data: 	np.array([nb_samples, nb_dim])
+        :return: 		np.array([nb_models, nb_samples, nb_states])
+        """
+        B = np.zeros((self.nb_models, data.shape[0], self.nb_states))
+
+        if self.mu is not None:
+            mask = self.state_mask[self.gaussian]
+            B_ = np.zeros((self.mu.shape[0], data.shape[0]))
+
+            for i in range(0, data.shape[0], self.chunk_size):
+                B_[:, i:i + self.chunk_size] = multi_variate_normal_batch(
+                    data[i:i + self.chunk_size], self.mu, self.sigma_chol, log=False,
+                    chol_inv=self.chol_inv)
+
+            # [nb_gaussian_models, nb_samples, nb_states]
+            B_gauss = np.zeros((self.gaussian.shape[0], self.nb_states, data.shape[0]))
+            B_gauss[mask] = B_
+            B[self.gaussian] = np.swapaxes(B_gauss, 1, 2)
+
+        for k, m in self.custom.items():
+            B[k, :, :m.nb_states] = m.obs_likelihood(data, marginal=self.marginal)[0].T
+
+        return B
+
+    def _log_likelihood(self, demos):
+        """
+        Log-likelihood of sequences under all models, in this process
+
+        :param demos: 	[list of np.array([nb_timestep, nb_dim])]
+        :return: 		np.array([nb_demos, nb_models])
+        """
+        lengths = np.array([d.shape[0] for d in demos])
+        ll = np.zeros((len(demos), self.nb_models))
+
+        trans_rdot = lambda alpha: np.matmul(alpha, self.Trans)
+
+        order = np.argsort(lengths)
+        for i in range(0, len(demos), self.batch_size):
+            idx = order[i:i + self.batch_size]
+            batch_lengths = lengths[idx]
+            mask = np.arange(np.max(batch_lengths))[:, None] < batch_lengths[None]
+
+            B_ = self.obs_likelihood(np.concatenate([demos[j] for j in idx], axis=0))
+
+            # time first [nb_timestep, nb_models, nb_demos, nb_states]
+            B = np.zeros((mask.shape[0], self.nb_models, idx.shape[0], self.nb_states))
+            B.transpose(2, 0, 1, 3)[mask.T] = np.swapaxes(B_, 0, 1)
+
+            ll[idx] = forward_log_likelihood(
+                B, batch_lengths, self.init_priors, trans_rdot,
+                state_mask=self.state_mask[:, None]).T
+
+        return ll
+
+    def log_likelihood(self, demos):
+        """
+        Log-likelihood of sequences under all models
+
+        :param demos: 	[list of np.array([nb_timestep, nb_dim])]
+        :return: 		np.array([nb_demos, nb_models])
+        """
+        if self._pool is None or len(demos) < 2:
+            return self._log_likelihood(demos)
+
+        # shards of sequences of balanced total length, longest sequences first
+        lengths = [d.shape[0] for d in demos]
+        shards = [[] for i in range(min(self.n_jobs, len(demos)))]
+        load = np.zeros(len(shards))
+        for i in np.argsort(lengths)[::-1]:
+            shards[np.argmin(load)] += [i]
+            load[np.argmin(load)] += lengths[i]
+
+        ll = np.zeros((len(demos), self.nb_models))
+        for shard, shard_ll in zip(shards, self._pool.map(
+                _bank_job, [[demos[i] for i in shard] for shard in shards])):
+            ll[shard] = shard_ll
+
+        return ll
+
+    def predict(self, demos):
+        """
+        Most likely model of each sequence
+
+        :param demos: 	[list of np.array([nb_timestep, nb_dim])]
+        :return: 		np.array([nb_demos]) of int
+        """
+        return np.argmax(self.log_likelihood(demos), axis=1)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,786 @@
+import numpy as np
+import os
+import time
+import hashlib
+import tracemalloc
+from multiprocessing.shared_memory import SharedMemory
+from contextlib import contextmanager, nullcontext
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from .functions import realmin
+
+
+class SufficientStats(object):
+    """
+    Sufficient statistics of the E-step of GMM and HMM. They can be computed from
+    disjoint shards of data (or by different workers) and merged by addition before
+    running the M-step.
+    """
+
+    def __init__(self, nb_states, nb_dim, hmm=False, cov_type='full', blocks=None):
+        """
+
+        :param nb_states: 	[int]
+        :param nb_dim: 		[int]
+        :param hmm: 		[bool]
+                If True, also hold transition and initial state counts
+        :param cov_type: 	[string] in ['full', 'diag', 'spherical']
+                For 'diag' and 'spherical', only the diagonal of second moments is stored
+        :param blocks: 		[BlockStructure] or None
+                For 'full', only store the second moments of the blocks of dimensions
+                and the diagonal for the other dimensions
+        """
+        self.nb_states = nb_states
+        self.nb_dim = nb_dim
+        self.cov_type = cov_type
+        self.blocks = blocks if cov_type == 'full' else None
+
+        self.nb_samples = 0.
+        self.log_lik = 0.  # sum of log-likelihood of the samples or sequences
+
+        self.s0 = np.zeros(nb_states)  # per-state counts
+        self.s1 = np.zeros((nb_states, nb_dim))  # per-state first moments
+        # per-state second moments
+        if self.blocks is not None:
+            self.s2 = [np.zeros((nb_states, ) + idx.shape + idx.shape[1:])
+                       for idx in self.blocks.groups] + \
+                      [np.zeros((nb_states, self.blocks.free.shape[0]))]
+        elif cov_type == 'full':
+            self.s2 = np.zeros((nb_states, nb_dim, nb_dim))
+        else:
+            self.s2 = np.zeros((nb_states, nb_dim))
+
+        if hmm:
+            self.nb_seq = 0.
+            self.init = np.zeros(nb_states)  # initial state counts
+            self.trans = np.zeros((nb_states, nb_states))  # transition counts
+            self.trans_from = np.zeros(nb_states)  # counts of state occupancy before last step
+        else:
+            self.nb_seq = None
+            self.init = None
+            self.trans = None
+            self.trans_from = None
+
+    @property
+    def is_hmm(self):
+        return self.trans is not None
+
+    @classmethod
+    def from_resp(cls, data, resp, log_lik=0., cov_type='full', blocks=None):
+        """
+        Create the statistics of samples given their responsibilities
+
+        :param data: 		np.array([nb_samples, nb_dim])
+        :param resp: 		np.array([nb_states, nb_samples])
+        :param log_lik: 	[float]
+        :param cov_type: 	[string] in ['full', 'diag', 'spherical']
+        :param blocks: 		[BlockStructure] or None
+        :return:
+        """
+        stats = cls(resp.shape[0], data.shape[1], cov_type=cov_type, blocks=blocks)
+        stats.add_resp(data, resp, log_lik)
+
+        return stats
+
+    @classmethod
+    def from_messages(cls, demo, gamma, zeta_sum, log_lik=0., cov_type='full', blocks=None):
+        """
+        Create the statistics of one sequence from its smoothed marginals
+
+        :param demo: 		np.array([nb_timestep, nb_dim])
+        :param gamma: 		np.array([nb_states, nb_timestep])
+                Smoothed node marginals
+        :param zeta_sum: 	np.array([nb_states, nb_states])
+                Smoothed edge marginals, summed over time
+        :param log_lik: 	[float]
+        :param cov_type: 	[string] in ['full', 'diag', 'spherical']
+        :param blocks: 		[BlockStructure] or None
+        :return:
+        """
+        stats = cls(gamma.shape[0], demo.shape[1], hmm=True, cov_type=cov_type,
+                    blocks=blocks)
+        stats.add_resp(demo, gamma, log_lik)
+
+        stats.nb_seq = 1.
+        stats.init = gamma[:, 0].copy()
+        stats.trans = zeta_sum
+        stats.trans_from = np.sum(gamma[:, :-1], axis=1)
+
+        return stats
+
+    def add_resp(self, data, resp, log_lik=0.):
+        """
+        Accumulate samples weighted by their responsibilities
+
+        :param data: 		np.array([nb_samples, nb_dim])
+        :param resp: 		np.array([nb_states, nb_samples])
+        :param log_lik: 	[float]
+        """
+        self.nb_samples += data.shape[0]
+        self.log_lik += log_lik
+
+        self.s0 += np.sum(resp, axis=1)
+        self.s1 += resp.dot(data)
+        if self.blocks is not None:
+            for s2, idx in zip(self.s2, self.blocks.groups):
+                x = data[:, idx]
+                s2 += np.einsum('at,tbi,tbj->abij', resp, x, x, optimize=True)
+            self.s2[-1] += resp.dot(data[:, self.blocks.free] ** 2)
+        elif self.cov_type == 'full':
+            self.s2 += np.matmul(resp[:, None] * data.T[None], data)
+        else:
+            self.s2 += resp.dot(data ** 2)
+
+    def copy(self):
+        stats = SufficientStats(self.nb_states, self.nb_dim, hmm=self.is_hmm,
+                                cov_type=self.cov_type, blocks=self.blocks)
+        stats.nb_samples, stats.log_lik = self.nb_samples, self.log_lik
+        stats.s0, stats.s1 = self.s0.copy(), self.s1.copy()
+        stats.s2 = [s2.copy() for s2 in self.s2] if self.blocks is not None \
+            else self.s2.copy()
+
+        if self.is_hmm:
+            stats.nb_seq = self.nb_seq
+            stats.init, stats.trans, stats.trans_from = \
+                self.init.copy(), self.trans.copy(), self.trans_from.copy()
+
+        return stats
+
+    def __add__(self, other):
+        stats = self.copy()
+        stats += other
+        return stats
+
+    def __radd__(self, other):
+        # allows sum([stats_1, stats_2, ...])
+        if isinstance(other, (int, float)) and other == 0:
+            return self.copy()
+        return self.__add__(other)
+
+    def __iadd__(self, other):
+        if (self.nb_states, self.nb_dim) != (other.nb_states, other.nb_dim):
+            raise ValueError('Cannot merge statistics of different shapes')
+        if self.is_hmm != other.is_hmm:
+            raise ValueError('Cannot merge GMM and HMM statistics')
+        if self.cov_type != other.cov_type:
+            raise ValueError('Cannot merge statistics of different covariance types')
+        if (self.blocks is None) != (other.blocks is None) or (
+                self.blocks is not None and not np.array_equal(self.blocks.mask, other.blocks.mask)):
+            raise ValueError('Cannot merge statistics of different block structures')
+
+        self.nb_samples += other.nb_samples
+        self.log_lik += other.log_lik
+        self.s0 += other.s0
+        self.s1 += other.s1
+        if self.blocks is not None:
+            for s2, other_s2 in zip(self.s2, other.s2):
+                s2 += other_s2
+        else:
+            self.s2 += other.s2
+
+        if self.is_hmm:
+            self.nb_seq += other.nb_seq
+            self.init += other.init
+            self.trans += other.trans
+            self.trans_from += other.trans_from
+
+        return self
+
+    def __mul__(self, value):
+        """
+        Scale all the statistics, e.g. to blend them in stochastic EM
+
+        :param value: 	[float]
+        :return:
+        """
+        stats = self.copy()
+        for name in ['nb_samples', 'log_lik', 's0', 's1']:
+            setattr(stats, name, getattr(stats, name) * value)
+
+        stats.s2 = [s2 * value for s2 in stats.s2] if self.blocks is not None \
+            else stats.s2 * value
+
+        if self.is_hmm:
+            for name in ['nb_seq', 'init', 'trans', 'trans_from']:
+                setattr(stats, name, getattr(stats, name) * value)
+
+        return stats
+
+    __rmul__ = __mul__
+
+    def __imul__(self, value):
+        """
+        Scale all the statistics in place, e.g. to forget past samples in online EM
+
+        :param value: 	[float]
+        :return:
+        """
+        self.nb_samples *= value
+        self.log_lik *= value
+        self.s0 *= value
+        self.s1 *= value
+        if self.blocks is not None:
+            for s2 in self.s2:
+                s2 *= value
+        else:
+            self.s2 *= value
+
+        if self.is_hmm:
+            self.nb_seq *= value
+            self.init *= value
+            self.trans *= value
+            self.trans_from *= value
+
+        return self
+
+    @classmethod
+    def from_params(cls, mu, sigma, weights, trans=None, init_priors=None, cov_type='full'):
+        """
+        Statistics that give back the parameters with the M-step, with weights[i]
+        pseudo-samples for state i. Used as a prior when statistics are accumulated online.
+
+        :param mu: 			np.array([nb_states, nb_dim])
+        :param sigma: 		np.array([nb_states, nb_dim, nb_dim])
+        :param weights: 	np.array([nb_states])
+        :param trans: 		np.array([nb_states, nb_states]) or None
+        :param init_priors: np.array([nb_states]) or None
+        :param cov_type: 	[string] in ['full', 'diag', 'spherical']
+        :return:
+        """
+        stats = cls(mu.shape[0], mu.shape[1], hmm=trans is not None, cov_type=cov_type)
+
+        stats.nb_samples = np.sum(weights)
+        stats.s0 = weights.astype(float)
+        stats.s1 = weights[:, None] * mu
+        if cov_type == 'full':
+            stats.s2 = weights[:, None, None] * (sigma + np.einsum('ai,aj->aij', mu, mu))
+        else:
+            stats.s2 = weights[:, None] * (np.diagonal(sigma, axis1=1, axis2=2) + mu ** 2)
+
+        if trans is not None:
+            stats.nb_seq = 1.
+            stats.init = init_priors.copy()
+            stats.trans = weights[:, None] * trans
+            stats.trans_from = stats.s0.copy()
+
+        return stats
+
+    def priors(self):
+        """
+        :return: 	np.array([nb_states])
+        """
+        return self.s0 / self.nb_samples
+
+    def mean(self):
+        """
+        :return: 	np.array([nb_states, nb_dim])
+        """
+        return self.s1 / (self.s0[:, None] + realmin)
+
+    def covariance(self, reg=None):
+        """
+
+        :param reg: 	np.array([nb_dim, nb_dim])
+                Regularization added to the covariance matrices, masked by the block
+                structure if any
+        :return: 		np.array([nb_states, nb_dim, nb_dim])
+        """
+        if self.blocks is not None:
+            mu = self.mean()
+            s0 = self.s0 + realmin
+
+            sigma = self.blocks.scatter(
+                [s2 / s0[:, None, None, None] - np.einsum('abi,abj->abij', mu[:, idx], mu[:, idx])
+                 for s2, idx in zip(self.s2, self.blocks.groups)],
+                self.s2[-1] / s0[:, None] - mu[:, self.blocks.free] ** 2)
+
+            if reg is not None:
+                sigma += reg * self.blocks.mask
+
+            return sigma
+
+        if self.cov_type != 'full':
+            var = self.variance(reg)
+            var = var[:, None] * np.ones(self.nb_dim) if var.ndim == 1 else var
+            return np.einsum('ai,ij->aij', var, np.eye(self.nb_dim))
+
+        mu = self.mean()
+        sigma = self.s2 / (self.s0[:, None, None] + realmin) - \
+            np.einsum('ai,aj->aij', mu, mu)
+
+        if reg is not None:
+            sigma += reg
+
+        return sigma
+
+    def variance(self, reg=None):
+        """
+        Variances, for 'diag' and 'spherical' covariance types, computed without
+        nb_dim x nb_dim arrays.
+
+        :param reg: 	float or np.array([nb_dim]) or np.array([nb_dim, nb_dim])
+                Regularization, only the diagonal is used
+        :return: 		np.array([nb_states, nb_dim]) or np.array([nb_states]) if spherical
+        """
+        mu = self.mean()
+
+        if self.blocks is not None:
+            var = np.diagonal(self.covariance(), axis1=1, axis2=2).copy()
+        elif self.cov_type == 'full':
+            var = np.diagonal(self.s2, axis1=1, axis2=2) / (self.s0[:, None] + realmin) - mu ** 2
+        else:
+            var = self.s2 / (self.s0[:, None] + realmin) - mu ** 2
+
+        if reg is not None:
+            reg = np.asarray(reg)
+            var = var + (np.diagonal(reg) if reg.ndim == 2 else reg)
+
+        if self.cov_type == 'spherical':
+            var = np.mean(var, axis=1)
+
+        return var
+
+    def init_priors(self):
+        """
+        :return: 	np.array([nb_states])
+        """
+        return self.init / self.nb_seq
+
+    def transition(self):
+        """
+        :return: 	np.array([nb_states, nb_states])
+        """
+        return self.trans / (self.trans_from[:, None] + realmin)
+
+
+def demo_key(demo):
+    """
+    Key identifying a demonstration by its content, to cache its statistics
+
+    :param demo: 	np.array([nb_timestep, nb_dim])
+    :return: 		[tuple]
+    """
+    demo = np.ascontiguousarray(demo)
+    return demo.shape, hashlib.sha1(demo.tobytes()).hexdigest()
+
+
+def state_divergence(old, new):
+    """
+    Change of each state between two sets of parameters, as the KL divergence of the new
+    observation model (and transition distribution) from the old one.
+
+    :param old: 	[dict of np.array] as given by Model.get_em_params
+    :param new: 	[dict of np.array]
+    :return: 		np.array([nb_states])
+    """
+    d_mu = new['mu'] - old['mu']
+    nb_dim = d_mu.shape[1]
+
+    if 'sigma' in old and 'sigma' in new:
+        sigma_inv = np.linalg.inv(old['sigma'])
+        kl = 0.5 * (np.einsum('aij,aji->a', sigma_inv, new['sigma']) +
+                    np.einsum('ai,aij,aj->a', d_mu, sigma_inv, d_mu) - nb_dim +
+                    np.linalg.slogdet(old['sigma'])[1] - np.linalg.slogdet(new['sigma'])[1])
+    elif 'sigma_diag' in old and 'sigma_diag' in new and \
+            old['sigma_diag'].ndim == new['sigma_diag'].ndim:
+        var_old, var_new = old['sigma_diag'], new['sigma_diag']
+        if var_old.ndim == 1:
+            var_old, var_new = var_old[:, None], var_new[:, None]
+
+        kl = 0.5 * np.sum(var_new / var_old + d_mu ** 2 / var_old - 1. +
+                          np.log(var_old) - np.log(var_new) + np.zeros_like(d_mu), axis=1)
+    else:
+        # type of covariance changed
+        return np.full(d_mu.shape[0], np.inf)
+
+    if 'Trans' in old and 'Trans' in new:
+        kl += np.sum(new['Trans'] * (np.log(new['Trans'] + realmin) -
+                                     np.log(old['Trans'] + realmin)), axis=1)
+
+    return kl
+
+
+class EMTrace(object):
+    """
+    Record of an EM run: log-likelihood, samples processed, wall time and peak memory
+    of temporary arrays for each phase (init, E-step, M-step) of each iteration.
+
+    The lists of E-step and M-step have one element per iteration, aligned with log_lik.
+    When a phase runs several times in an iteration (e.g. with SQUAREM), its times are
+    summed and the largest peak is kept. The list of init has one element per
+    initialization phase.
+    """
+
+    # phases recorded once per iteration, in add_iteration
+    iteration_phases = ['e_step', 'm_step']
+
+    def __init__(self, memory=True):
+        """
+
+        :param memory: 	[bool]
+                If True, measure the peak of memory allocated during each phase with
+                tracemalloc. It slows down allocations and thus affects the timing.
+        """
+        self.memory = memory
+
+        self.log_lik = []  # average log-likelihood per iteration
+        self.nb_samples = []  # number of samples processed per iteration
+        self.time = {'init': [], 'e_step': [], 'm_step': []}
+        self.peak_memory = {'init': [], 'e_step': [], 'm_step': []}  # in bytes
+        self.converged = False
+
+        # time and peak memory of the phases of the current iteration
+        self._iteration = {}
+
+    @property
+    def nb_iter(self):
+        return len(self.log_lik)
+
+    @property
+    def total_time(self):
+        return sum([sum(t) for t in self.time.values()])
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measure a phase, to be used as
+            with trace.phase('e_step'):
+                ...
+
+        :param name: 	[string] in ['init', 'e_step', 'm_step']
+        """
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+
+        if self.memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+
+        t = time.time()
+        try:
+            yield
+        finally:
+            t = time.time() - t
+            peak = tracemalloc.get_traced_memory()[1] - start_memory if self.memory else 0
+
+            if tracing:
+                tracemalloc.stop()
+
+            if name in self.iteration_phases:
+                t_, peak_ = self._iteration.get(name, (0., 0))
+                self._iteration[name] = (t_ + t, max(peak_, peak))
+            else:
+                self.time[name] += [t]
+                if self.memory:
+                    self.peak_memory[name] += [peak]
+
+    def add_iteration(self, log_lik, nb_samples):
+        """
+        End an iteration, recording its log-likelihood and the phases run since the last one
+        """
+        self.log_lik += [log_lik]
+        self.nb_samples += [nb_samples]
+
+        for name in self.iteration_phases:
+            t, peak = self._iteration.get(name, (0., 0))
+            self.time[name] += [t]
+            if self.memory:
+                self.peak_memory[name] += [peak]
+
+        self._iteration = {}
+
+    def summary(self):
+        s = 'EM %s after %d iterations: %.3e\n' % (
+            'converged' if self.converged else 'did not converge', self.nb_iter,
+            self.log_lik[-1] if self.nb_iter else np.nan)
+
+        for name, times in self.time.items():
+            s += '%s: %.3fs' % (name, sum(times))
+            if self.memory and len(self.peak_memory[name]):
+                s += ', peak %.1f MB' % (max(self.peak_memory[name]) / 1e6)
+            s += '\n'
+
+        return s
+
+
+class SQUAREM(object):
+    """
+    Squared iterative method (Varadhan and Roland, 2008) accelerating EM. Two EM steps are
+    extrapolated along the path of parameters and the extrapolated parameters are
+    stabilized by a third EM step. If they are not valid or decrease the log-likelihood,
+    the plain EM steps are kept.
+    """
+
+    # parameters that are probabilities, normalized along their last axis
+    simplex = ['priors', 'init_priors', 'Trans']
+
+    def __init__(self, model, step_max=1., mstep=4.):
+        """
+
+        :param model: 		[Model]
+                Should implement get_em_params and set_em_params
+        :param step_max: 	[float]
+                Initial maximum extrapolation step length
+        :param mstep: 		[float]
+                Factor by which the maximum step length is increased when reached
+        """
+        self.model = model
+        self.step_max = step_max
+        self.mstep = mstep
+
+        self.nb_e_steps = 0  # E-steps run during the last step
+        self.nb_fallback = 0  # number of times extrapolation was rejected
+
+    def project(self, params):
+        for k in self.simplex:
+            if k in params:
+                p = np.maximum(params[k], 0.)
+                params[k] = p / (np.sum(p, axis=-1, keepdims=True) + realmin)
+
+        return params
+
+    def valid(self):
+        with np.errstate(invalid='ignore'):
+            try:
+                return bool(np.all(np.isfinite(self.model.sigma_chol)))
+            except np.linalg.LinAlgError:
+                return False
+
+    def step(self, em_step):
+        """
+
+        :param em_step: 	[function]
+                Run E-step on the current parameters of the model, then M-step. Should
+                return a tuple whose first element is the SufficientStats of the E-step.
+        :return: 			the output of em_step for which the parameters were accepted
+        """
+        p0 = self.model.get_em_params()
+        res_1 = em_step()
+        p1 = self.model.get_em_params()
+        res_2 = em_step()
+        p2 = self.model.get_em_params()
+        self.nb_e_steps = 2
+
+        if not set(p0) == set(p1) == set(p2):
+            # type of parameters changed, e.g. from full to diagonal covariances
+            return res_2
+
+        r = {k: p1[k] - p0[k] for k in p0}
+        v = {k: p2[k] - 2. * p1[k] + p0[k] for k in p0}
+
+        norm_r = np.sqrt(sum([np.sum(r[k] ** 2) for k in r]))
+        norm_v = np.sqrt(sum([np.sum(v[k] ** 2) for k in v]))
+
+        if norm_v < realmin:
+            return res_2
+
+        alpha = max(-self.step_max, min(-1., -norm_r / norm_v))
+
+        self.model.set_em_params(self.project(
+            {k: p0[k] - 2. * alpha * r[k] + alpha ** 2 * v[k] for k in p0}))
+
+        if self.valid():
+            try:
+                res = em_step()
+                self.nb_e_steps += 1
+            except np.linalg.LinAlgError:
+                res = None
+
+            if res is not None and res[0].log_lik >= res_2[0].log_lik and \
+                    np.isfinite(res[0].log_lik):
+                if alpha == -self.step_max:
+                    self.step_max *= self.mstep
+                return res
+
+        # fall back on plain EM
+        self.nb_fallback += 1
+        self.step_max = max(1., self.step_max / self.mstep)
+        self.model.set_em_params(p2)
+
+        return res_2
+
+
+def make_trace(trace):
+    """
+    :param trace: 	[bool] or [EMTrace] or None
+    :return: 		[EMTrace] or None
+    """
+    if trace is True:
+        return EMTrace()
+    return trace if isinstance(trace, EMTrace) else None
+
+
+def trace_phase(trace, name):
+    """
+    Context measuring a phase of EM if trace is not None
+    """
+    return trace.phase(name) if trace is not None else nullcontext()
+
+
+def _em_restart(job):
+    em, model, seed, args, kwargs = job
+
+    rng = np.random.default_rng(seed)
+
+    t = time.time()
+    result = em(model, *args, rng=rng, **kwargs)
+
+    return model, result, model._em_ll, time.time() - t
+
+
+def em_restarts(em, model, args, kwargs, n_init, n_jobs=None, random_state=None,
+                verbose=False, reset=None):
+    """
+    Run several EM from different random initializations, possibly in a pool of processes,
+    and keep the one with highest final log-likelihood. Each restart gets its own seeded
+    numpy.random.Generator, whose seed is stored as the entropy and spawn_key of its
+    numpy.random.SeedSequence in model.em_restarts. A restart can be reproduced with
+        np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=spawn_key))
+
+    :param em: 				[function]
+            EM function, called as em(model, *args, rng=rng, **kwargs)
+    :param model: 			[Model]
+            Model in which to store the best restart
+    :param args: 			[tuple]
+    :param kwargs: 			[dict]
+    :param n_init: 			[int]
+            Number of restarts
+    :param n_jobs: 			[int] or None
+            Number of processes. If 1, restarts are run sequentially in this process.
+            If None, use all the processors of the machine.
+    :param random_state: 	[int] or None
+            Seed from which the seeds of all the restarts are generated
+    :param reset: 			[function] or None
+            Called on the copies of the model of all restarts but the first, to drop
+            parameters that should be initialized randomly. The first restart then starts
+            from the parameters of the model.
+    :return: 				result of the best restart
+    """
+    seeds = np.random.SeedSequence(random_state).spawn(n_init)
+    models = [deepcopy(model) for seed in seeds]
+    if reset is not None:
+        for m in models[1:]:
+            reset(m)
+
+    jobs = [(em, m, seed, args, kwargs) for m, seed in zip(models, seeds)]
+
+    if n_jobs == 1:
+        results = [_em_restart(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_em_restart, jobs))
+
+    lls = np.array([r[2] for r in results])
+    best = int(np.nanargmax(lls))
+
+    model.__dict__.update(results[best][0].__dict__)
+    model.em_restarts = [{'entropy': seed.entropy, 'spawn_key': seed.spawn_key,
+                          'log_lik': ll, 'time': t}
+                         for seed, (_, _, ll, t) in zip(seeds, results)]
+
+    if verbose:
+        for i, r in enumerate(model.em_restarts):
+            print('Restart %d: %.3e in %.2fs' % (i, r['log_lik'], r['time']))
+
+    return results[best][1]
+
+
+# state of E-step worker processes
+_worker = {}
+
+
+def _e_step_init(e_step, model, shm_name, shape, lengths):
+    shm = SharedMemory(name=shm_name)
+    data = np.ndarray(shape, dtype=float, buffer=shm.buf)
+
+    _worker['shm'] = shm
+    _worker['demos'] = np.split(data, np.cumsum(lengths)[:-1], axis=0)
+    _worker['e_step'] = e_step
+    _worker['model'] = model
+
+
+def _e_step_job(job):
+    params, idx, dep, cov_type = job
+    model, demos = _worker['model'], [_worker['demos'][i] for i in idx]
+
+    model.set_em_params(params)
+    _worker['e_step'](model, demos, dep=dep, cov_type=cov_type, keys=list(range(len(demos))))
+
+    return [model._demo_stats[i][0] for i in range(len(demos))]
+
+
+class EStepPool(object):
+    """
+    Persistent pool of processes computing the E-step of disjoint sets of demonstrations.
+    Demonstrations are copied once in shared memory when the pool is created. At each
+    E-step, only the parameters are sent to the workers, which return the sufficient
+    statistics of each demonstration instead of the messages.
+    """
+
+    def __init__(self, e_step, model, demos, n_jobs=-1):
+        """
+
+        :param e_step: 	[function]
+                Called as e_step(model, demos, dep=dep, cov_type=cov_type, keys=keys) in the
+                workers, should store the statistics of each demonstration in
+                model._demo_stats[key]
+        :param model: 	[Model]
+                Copied once in each worker
+        :param demos: 	[list of np.array([nb_timestep, nb_dim])]
+        :param n_jobs: 	[int]
+                Number of processes, -1 uses all processors
+        """
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        lengths = [demo.shape[0] for demo in demos]
+
+        # shards of demos of balanced total length, longest demos first
+        self.shards = [[] for i in range(min(n_jobs, len(demos)))]
+        load = np.zeros(len(self.shards))
+        for i in np.argsort(lengths)[::-1]:
+            self.shards[np.argmin(load)] += [i]
+            load[np.argmin(load)] += lengths[i]
+
+        data = np.concatenate(demos, axis=0).astype(float)
+        self._shm = SharedMemory(create=True, size=data.nbytes)
+        np.ndarray(data.shape, dtype=float, buffer=self._shm.buf)[:] = data
+
+        model = deepcopy(model)
+        model._demo_stats = {}
+
+        self._pool = ProcessPoolExecutor(
+            max_workers=len(self.shards), initializer=_e_step_init,
+            initargs=(e_step, model, self._shm.name, data.shape, lengths))
+
+        self.nb_demos = len(demos)
+
+    def map(self, params, dep=None, cov_type='full'):
+        """
+        Compute the statistics of all demonstrations
+
+        :param params: 		[dict of np.array] as given by get_em_params
+        :param dep: 		[A x [B x [int]]] or BlockStructure
+        :param cov_type: 	[string] in ['full', 'diag', 'spherical']
+        :return: 			[list of SufficientStats] in the order of demonstrations
+        """
+        results = self._pool.map(_e_step_job, [(params, shard, dep, cov_type)
+                                               for shard in self.shards])
+
+        stats = [None] * self.nb_demos
+        for shard, shard_stats in zip(self.shards, results):
+            for i, demo_stats in zip(shard, shard_stats):
+                stats[i] = demo_stats
+
+        return stats
+
+    def close(self):
+        self._pool.shutdown()
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
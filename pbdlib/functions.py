@@ -1,5 +1,6 @@
 import numpy as np
 from scipy.interpolate import interp1d
+from scipy.linalg import lapack
 from scipy.special import gamma, gammaln
 
 
@@ -262,6 +263,215 @@ def mvn_pdf(x, mu, sigma_chol, lmbda, sigma=None, reg=None):
     # 				   for i in range(N)])
 
 
+def triangular_inv(L):
+    """
+    Inverse of lower triangular matrices, by LAPACK triangular inversion
+
+    :param L: 	np.array([..., nb_dim, nb_dim])
+    :return: 	np.array([..., nb_dim, nb_dim])
+    """
+    L = np.asarray(L, dtype=float)
+    L_inv = np.empty_like(L)
+
+    for i in np.ndindex(L.shape[:-2]):
+        L_inv[i], info = lapack.dtrtri(L[i], lower=1)
+        if info > 0:
+            raise np.linalg.LinAlgError('Singular triangular matrix')
+
+    return L_inv
+
+
+def multi_variate_normal_batch(x, mu, sigma_chol, log=True, chol_inv=None):
+    """
+    Multivariate normal distribution PDF of several states, evaluated for all samples
+    in a single pass. The covariance matrices are given by their Cholesky decompositions
+    so that no inversion or determinant of the full covariance is needed.
+
+    :param x:			np.array([nb_samples, nb_dim])
+    :param mu: 			np.array([nb_states, nb_dim])
+    :param sigma_chol: 	np.array([nb_states, nb_dim, nb_dim])
+            lower cholesky decomposition of covariance matrices
+    :param log: 		bool
+    :param chol_inv: 	np.array([nb_states, nb_dim, nb_dim]) or None
+            inverses of sigma_chol, computed by triangular solves if None
+    :return: 			np.array([nb_states, nb_samples])
+    """
+    x = x[:, None] if x.ndim == 1 else x
+
+    if chol_inv is None:
+        chol_inv = triangular_inv(sigma_chol)
+
+    # whitened samples z = L^-1 (x - mu)
+    z = np.matmul(x[None] - mu[:, None], np.swapaxes(chol_inv, 1, 2))
+
+    log_lik = -0.5 * np.einsum('aci,aci->ac', z, z) - \
+        0.5 * mu.shape[1] * np.log(2 * np.pi) - \
+        np.sum(np.log(sigma_chol.diagonal(axis1=1, axis2=2)), axis=1)[:, None]
+
+    return log_lik if log else np.exp(log_lik)
+
+
+def multi_variate_normal_diag(x, mu, sigma_diag, log=True, chunk_size=None):
+    """
+    Multivariate normal distribution PDF of several states with diagonal covariance
+    matrices, evaluated for all samples in a single pass without building nb_dim x nb_dim
+    matrices.
+
+    :param x:			np.array([nb_samples, nb_dim])
+    :param mu: 			np.array([nb_states, nb_dim])
+    :param sigma_diag: 	np.array([nb_states, nb_dim]) or np.array([nb_states, 1])
+            variances, a single column for spherical covariances
+    :param log: 		bool
+    :param chunk_size: 	[int] or None
+            Number of samples evaluated at once, default keeps the differences
+            [nb_states, nb_dim, chunk_size] around 2^20 elements
+    :return: 			np.array([nb_states, nb_samples])
+    """
+    x = x[:, None] if x.ndim == 1 else x
+    sigma_diag = np.broadcast_to(sigma_diag, mu.shape)
+
+    prec = 1. / sigma_diag
+
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 20 // mu.size)
+
+    # (x - mu)^2 / sigma on the differences, expanding the square loses precision when the
+    # data are far from the origin compared to the variances
+    log_lik = np.empty((mu.shape[0], x.shape[0]))
+    for i in range(0, x.shape[0], chunk_size):
+        # [nb_states, nb_dim, nb_samples], samples contiguous
+        dx = x[i:i + chunk_size].T[None] - mu[:, :, None]
+        dx *= dx
+        log_lik[:, i:i + chunk_size] = -0.5 * np.einsum('aic,ai->ac', dx, prec)
+
+    log_lik -= 0.5 * (mu.shape[1] * np.log(2 * np.pi) +
+                      np.sum(np.log(sigma_diag), axis=1))[:, None]
+
+    return log_lik if log else np.exp(log_lik)
+
+
+class BandedMatrix(object):
+    """
+    Square matrix whose non-zero elements are on a few cyclic bands A[i, (i + k) % n],
+    as transition matrices of left-to-right or loop HMMs. Products cost O(n * nb_bands)
+    instead of O(n^2).
+    """
+
+    def __init__(self, A, offsets=None):
+        """
+
+        :param A: 		np.array([n, n])
+        :param offsets: [list of int] or None
+                Offsets k of the bands, elements out of the bands are ignored.
+                If None, found from the non-zero elements of A.
+        """
+        n = A.shape[0]
+        self.offsets = np.asarray(BandedMatrix.find_offsets(A, max_density=1.)
+                                  if offsets is None else offsets)
+        self.shape = A.shape
+
+        rows = np.arange(n)[:, None]
+
+        # A[i, idx_out[i, m]] is the element of row i on band m
+        self.idx_out = (rows + self.offsets[None]) % n
+        self.val_out = A[rows, self.idx_out]
+
+        # A[idx_in[j, m], j] is the element of column j on band m
+        self.idx_in = (rows - self.offsets[None]) % n
+        self.val_in = A[self.idx_in, rows]
+
+    @staticmethod
+    def find_offsets(A, max_density=0.25, tol=0.):
+        """
+        Offsets of the cyclic bands containing all elements of A above tol
+
+        :param A: 				np.array([n, n])
+        :param max_density: 	[float]
+                Maximum number of bands relative to n
+        :param tol: 			[float]
+                Elements with absolute value below or equal to tol are considered as zero
+        :return: 				np.array([nb_bands]) or None if more bands than max_density * n
+        """
+        n = A.shape[0]
+        i, j = np.nonzero(np.abs(A) > tol)
+        offsets = np.unique((j - i) % n)
+
+        return offsets if offsets.shape[0] <= max_density * n else None
+
+    def dot(self, x):
+        """
+        A.dot(x) for x of shape [..., n]
+        """
+        return np.sum(x[..., self.idx_out] * self.val_out, axis=-1)
+
+    def rdot(self, x):
+        """
+        x.dot(A) for x of shape [..., n]
+        """
+        return np.sum(x[..., self.idx_in] * self.val_in, axis=-1)
+
+    def masked_outer_sum(self, x, y):
+        """
+        A * sum_t outer(x_t, y_t), only computed on the bands
+
+        :param x: 	np.array([..., nb_timestep, n])
+        :param y: 	np.array([..., nb_timestep, n])
+        :return: 	np.array([..., n, n])
+        """
+        return self.todense(
+            self.val_out * np.einsum('...ti,...tim->...im', x, y[..., self.idx_out]))
+
+    def todense(self, values=None):
+        """
+        :param values: 	np.array([..., n, nb_bands]) or None
+                Elements on the bands, as val_out. If None, those of A.
+        :return: 		np.array([..., n, n])
+        """
+        values = self.val_out if values is None else values
+
+        A = np.zeros(values.shape[:-2] + self.shape)
+        A[..., np.arange(self.shape[0])[:, None], self.idx_out] = values
+
+        return A
+
+
+def forward_log_likelihood(B, lengths, init_priors, trans_rdot, state_mask=None):
+    """
+    Log-likelihood of sequences from the rescaled forward recursion of HMMs, keeping only
+    the forward variable of the current timestep.
+
+    :param B: 			np.array([nb_timestep, ..., nb_states])
+            Observation likelihoods of padded sequences, time first
+    :param lengths: 	np.array([...]) of int
+            Length of each sequence, broadcastable to B.shape[1:-1]
+    :param init_priors: np.array([..., nb_states])
+            Broadcastable to B.shape[1:]
+    :param trans_rdot: 	[function]
+            Product alpha.dot(Trans) for alpha of shape B.shape[1:]
+    :param state_mask: 	np.array([..., nb_states]) of bool or None
+            States that exist when models with different numbers of states are padded,
+            broadcastable to B.shape[1:]
+    :return: 			np.array(B.shape[1:-1])
+    """
+    floor = realmin if state_mask is None else realmin * state_mask
+
+    alpha = init_priors * B[0]
+    c = 1.0 / np.sum(alpha + floor, axis=-1)
+    alpha *= c[..., None]
+    log_lik = -np.log(c)
+
+    for t in range(1, B.shape[0]):
+        inside = t < lengths
+        alpha_t = trans_rdot(alpha) * B[t]
+        # Scaling to avoid underflow issues
+        c = 1.0 / np.sum(alpha_t + floor, axis=-1)
+
+        log_lik -= np.where(inside, np.log(c), 0.)
+        alpha = np.where(inside[..., None], alpha_t * c[..., None], alpha)
+
+    return log_lik
+
+
 def multi_variate_t(x, nu, mu, sigma=None, log=True, gmm=False, lmbda=None):
     """
     Multivariatve T-distribution PDF
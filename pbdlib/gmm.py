@@ -2,9 +2,12 @@ import numpy as np
 from .model import *
 from .functions import multi_variate_normal
 from scipy.linalg import block_diag
+from scipy.special import logsumexp
 
 from termcolor import colored
 from .mvn import MVN
+from .em_utils import SufficientStats, SQUAREM, em_restarts, make_trace, trace_phase
+from .kmeans import kmeans
 
 
 class GMM(Model):
@@ -184,35 +187,21 @@ class GMM(Model):
     def compute_resp(self, demo=None, dep=None, table=None, marginal=None, norm=True):
         sample_size = demo.shape[0]
 
-        B = np.ones((self.nb_states, sample_size))
+        B = np.zeros((self.nb_states, sample_size))
 
         if marginal != []:
-            for i in range(self.nb_states):
-                mu, sigma = (self.mu, self.sigma)
-
-                if marginal is not None:
-                    mu, sigma = self.get_marginal(marginal)
-
-                if dep is None:
-                    B[i, :] = multi_variate_normal(demo,
-                                                   mu[i],
-                                                   sigma[i], log=False)
-                else:  # block diagonal computation
-                    B[i, :] = 1.0
-                    for d in dep:
-                        dGrid = np.ix_([i], d, d)
-                        B[[i], :] *= multi_variate_normal(demo, mu[i, d],
-                                                          sigma[dGrid][:, :, 0], log=False)
-        B *= self.priors[:, None]
+            B = self.mvn_log_prob(demo, marginal=marginal, dep=dep)
+
+        B += np.log(self.priors)[:, None]
         if norm:
-            return B/np.sum(B, axis=0)
+            return np.exp(B - logsumexp(B, axis=0, keepdims=True))
         else:
-            return B
+            return np.exp(B)
 
     def init_params_scikit(self, data, cov_type='full'):
         from sklearn.mixture import BayesianGaussianMixture, GaussianMixture
         gmm_init = GaussianMixture(
-            self.nb_states, cov_type, n_init=5, init_params='random')
+            self.nb_states, covariance_type=cov_type, n_init=5, init_params='random')
         gmm_init.fit(data)
 
         self.mu = gmm_init.means_
@@ -228,25 +217,59 @@ class GMM(Model):
 
         self.init_priors = np.ones(self.nb_states) * 1. / self.nb_states
 
-    def init_params_kmeans(self, data):
-        from sklearn.cluster import KMeans
-        km_init = KMeans(n_clusters=self.nb_states)
-        km_init.fit(data)
-        self.mu = km_init.cluster_centers_
-        self.priors = np.ones(self.nb_states) / self.nb_states
-        self.sigma = np.array([np.eye(self.nb_dim)
-                               for i in range(self.nb_states)])
+    def init_params_kmeans(self, data, rng=None, batch_size=None, chunk_size=4096):
+        """
+        Init components with k-means++ / k-means. Covariances and priors are computed
+        from the assignment of the samples to the clusters.
+
+        :param data:	 		[np.array([nb_timesteps, nb_dim])]
+        :param rng: 			[np.random.Generator] or None
+                Random generator, np.random is used if None
+        :param batch_size: 		[int] or None
+                If given, use mini-batch k-means with this batch size
+        :param chunk_size: 		[int]
+                Number of samples for which distances and statistics are computed at once
+        :return:
+        """
+        centers, labels = kmeans(data, self.nb_states, batch_size=batch_size, rng=rng,
+                                 chunk_size=chunk_size)
+
+        stats = SufficientStats(self.nb_states, data.shape[1])
+        for i in range(0, data.shape[0], chunk_size):
+            resp = (labels[None, i:i + chunk_size] ==
+                    np.arange(self.nb_states)[:, None]).astype(float)
+            stats.add_resp(data[i:i + chunk_size], resp)
+
+        sigma = stats.covariance(self.reg)
+
+        # clusters with too few samples get the covariance of the whole data
+        few = stats.s0 <= data.shape[1]
+        if np.any(few):
+            sigma[few] = np.cov(data.T).reshape(data.shape[1], data.shape[1]) + self.reg
+
+        self.mu = centers
+        self.sigma = sigma
+        self.priors = stats.priors()
 
         self.Trans = np.ones((self.nb_states, self.nb_states)) * 0.01
 
         self.init_priors = np.ones(self.nb_states) * 1. / self.nb_states
 
-    def init_params_random(self, data):
+    def init_params_random(self, data, rng=None):
+        """
+
+        :param data:	 		[np.array([nb_timesteps, nb_dim])]
+        :param rng: 			[np.random.Generator] or None
+                Random generator, np.random is used if None
+        :return:
+        """
+        rng = np.random if rng is None else rng
+
         mu = np.mean(data, axis=0)
         sigma = np.dot((data - mu).T, (data - mu)) / \
             (data.shape[0] - 1)
 
-        self.mu = np.array([np.random.multivariate_normal(mu, sigma)
+        self.mu = np.array([rng.multivariate_normal(mu, sigma)
                             for i in range(self.nb_states)])
 
         self.sigma = np.array(
@@ -254,9 +277,63 @@ class GMM(Model):
 
         self.priors = np.ones(self.nb_states) / self.nb_states
 
+    def e_step(self, data, return_resp=False, cov_type=None):
+        """
+        Compute the responsibilities of the states and the sufficient statistics of the data.
+        Statistics of disjoint parts of the data can be merged by addition.
+
+        :param data:	 		[np.array([nb_samples, nb_dim])]
+        :param return_resp:		[bool]
+                Return also responsibilities np.array([nb_states, nb_samples])
+        :param cov_type: 		[string] in ['full', 'diag', 'spherical']
+                Covariance type of the statistics, default is the one of the model
+        :return: 				[SufficientStats]
+        """
+        L_log = np.log(self.priors)[:, None] + self.mvn_log_prob(data)
+        ll = logsumexp(L_log, axis=0)
+        GAMMA = np.exp(L_log - ll[None])
+
+        stats = SufficientStats.from_resp(data, GAMMA, np.sum(ll),
+                                          cov_type=self.cov_type if cov_type is None else cov_type)
+
+        if return_resp:
+            return stats, GAMMA
+        else:
+            return stats
+
+    def m_step(self, stats, diag=False, dep_mask=None):
+        """
+        Update parameters from sufficient statistics
+
+        :param stats: 			[SufficientStats]
+        :param diag:			[bool]
+                Use diagonal covariance matrices
+        :param dep_mask: 		[np.array([nb_dim, nb_dim])]
+                Composed of 0 and 1. Mask given the dependencies in the covariance matrices
+        :return:
+        """
+        self.priors = stats.priors()
+        self.mu = stats.mean()
+
+        if stats.cov_type != 'full':
+            # only variances are stored
+            self.sigma_diag = stats.variance(self.reg)
+            return
+
+        sigma = stats.covariance(self.reg)
+
+        if diag:
+            sigma *= np.eye(self.nb_dim)
+
+        if dep_mask is not None:
+            sigma *= dep_mask
+
+        self.sigma = sigma
+
     def em(self, data, reg=1e-8, maxiter=100, minstepsize=1e-5, diag=False, reg_finish=False,
            kmeans_init=False, random_init=True, dep_mask=None, verbose=False, only_scikit=False,
-           no_init=False):
+           no_init=False, n_init=1, n_jobs=None, random_state=None, rng=None, cov_type=None,
+           trace=False, accelerate=False):
         """
 
         :param data:	 		[np.array([nb_timesteps, nb_dim])]
@@ -265,86 +342,112 @@ class GMM(Model):
         :param maxiter:
         :param minstepsize:
         :param diag:			[bool]
-                Use diagonal covariance matrices
+                Use diagonal covariance matrices, same as cov_type='diag'
+        :param cov_type: 		[string] in ['full', 'diag', 'spherical'] or None
+                For 'diag' and 'spherical', only variances are computed and stored
         :param reg_finish:		[np.array([nb_dim]) or float]
                 Regulariazation for finish step
         :param kmeans_init:		[bool]
-                Init components with k-means.
+                Init components with k-means++ / k-means (init_params_kmeans), if random_init
+                is False. Otherwise, components are initialized with scikit-learn.
         :param random_init:		[bool]
                 Init components randomely.
         :param dep_mask: 		[np.array([nb_dim, nb_dim])]
                 Composed of 0 and 1. Mask given the dependencies in the covariance matrices
+        :param n_init:			[int]
+                Number of random restarts, the one with highest log-likelihood is kept.
+                Log-likelihood and timing of each restart are stored in self.em_restarts
+        :param n_jobs:			[int] or None
+                Number of processes to run restarts, None uses all processors
+        :param random_state:	[int] or None
+                Seed of the restarts
+        :param rng: 			[np.random.Generator] or None
+                Random generator for initialization
+        :param trace: 			[bool] or [EMTrace]
+                If True or EMTrace, record log-likelihood, timing and memory of each
+                iteration in self.em_trace
+        :param accelerate: 		[bool]
+                If True, accelerate EM with SQUAREM extrapolation. Each iteration then runs
+                two or three E-steps but far fewer iterations are needed.
         :return:
         """
+        if n_init > 1:
+            kwargs = dict(reg=reg, maxiter=maxiter, minstepsize=minstepsize, diag=diag,
+                          reg_finish=reg_finish, kmeans_init=kmeans_init,
+                          random_init=random_init, dep_mask=dep_mask, verbose=verbose,
+                          only_scikit=only_scikit, no_init=no_init, cov_type=cov_type,
+                          trace=trace, accelerate=accelerate)
+            return em_restarts(GMM.em, self, (data, ), kwargs, n_init, n_jobs=n_jobs,
+                               random_state=random_state, verbose=verbose)
 
         self.reg = reg
 
+        if cov_type is None:
+            cov_type = 'diag' if diag else 'full'
+
         nb_min_steps = 5  # min num iterations
         nb_max_steps = maxiter  # max iterations
         max_diff_ll = minstepsize  # max log-likelihood increase
 
         nb_samples = data.shape[0]
 
+        trace = make_trace(trace)
+        if trace is not None:
+            self.em_trace = trace
+
         if not no_init:
-            if random_init and not only_scikit:
-                self.init_params_random(data)
-            elif kmeans_init and not only_scikit:
-                self.init_params_kmeans(data)
-            else:
-                if diag:
-                    self.init_params_scikit(data, 'diag')
+            with trace_phase(trace, 'init'):
+                if random_init and not only_scikit:
+                    self.init_params_random(data, rng=rng)
+                elif kmeans_init and not only_scikit:
+                    self.init_params_kmeans(data, rng=rng)
                 else:
-                    self.init_params_scikit(data, 'full')
+                    if diag:
+                        self.init_params_scikit(data, 'diag')
+                    else:
+                        self.init_params_scikit(data, 'full')
 
         if only_scikit:
             return
-        data = data.T
-
-        LL = np.zeros(nb_max_steps)
-        for it in range(nb_max_steps):
 
+        def em_step():
             # E - step
-            L = np.zeros((self.nb_states, nb_samples))
-            L_log = np.zeros((self.nb_states, nb_samples))
-
-            for i in range(self.nb_states):
-                L_log[i, :] = np.log(self.priors[i]) + multi_variate_normal(data.T, self.mu[i],
-                                                                            self.sigma[i], log=True)
-
-            L = np.exp(L_log)
-            GAMMA = L / np.sum(L, axis=0)
-            GAMMA2 = GAMMA / np.sum(GAMMA, axis=1)[:, np.newaxis]
+            with trace_phase(trace, 'e_step'):
+                stats, resp = GMM.e_step(self, data, return_resp=True, cov_type=cov_type)
 
             # M-step
-            self.mu = np.einsum('ac,ic->ai', GAMMA2,
-                                data)  # a states, c sample, i dim
+            with trace_phase(trace, 'm_step'):
+                GMM.m_step(self, stats, dep_mask=dep_mask)
 
-            # nb_dim, nb_states, nb_samples
-            dx = data[None, :] - self.mu[:, :, None]
+            return stats, resp
 
-            self.sigma = np.einsum('acj,aic->aij', np.einsum('aic,ac->aci', dx, GAMMA2),
-                                   dx)  # a states, c sample, i-j dim
+        squarem = SQUAREM(self) if accelerate else None
 
-            self.sigma += self.reg
-
-            if diag:
-                self.sigma *= np.eye(self.nb_dim)
+        LL = np.zeros(nb_max_steps)
+        for it in range(nb_max_steps):
 
-            if dep_mask is not None:
-                self.sigma *= dep_mask
+            if squarem is None:
+                stats, GAMMA = em_step()
+            else:
+                stats, GAMMA = squarem.step(em_step)
 
-            # print self.Sigma[:,u :, i]
+            LL[it] = stats.log_lik / stats.nb_samples
+            self._em_ll = LL[it]
 
-            # Update initial state probablility vector
-            self.priors = np.mean(GAMMA, axis=1)
+            if trace is not None:
+                trace.add_iteration(LL[it], stats.nb_samples * (
+                    1 if squarem is None else squarem.nb_e_steps))
 
-            LL[it] = np.mean(np.log(np.sum(L, axis=0)))
             # Check for convergence
             if it > nb_min_steps:
                 if LL[it] - LL[it - 1] < max_diff_ll:
-                    if reg_finish is not False:
-                        self.sigma = np.einsum(
-                            'acj,aic->aij', np.einsum('aic,ac->aci', dx, GAMMA2), dx) + reg_finish
+                    if reg_finish is not False and cov_type != 'full':
+                        self.sigma_diag = stats.variance(reg_finish)
+                    elif reg_finish is not False:
+                        self.sigma = stats.covariance(reg_finish)
+
+                    if trace is not None:
+                        trace.converged = True
 
                     if verbose:
                         print(colored('Converged after %d iterations: %.3e' %
@@ -354,13 +457,97 @@ class GMM(Model):
             print("GMM did not converge before reaching max iteration. Consider augmenting the number of max iterations.")
         return GAMMA
 
+    def partial_fit(self, data, step_size=None, reg=None, diag=False, dep_mask=None,
+                    reset=False, kappa=0.6):
+        """
+        Stochastic EM step on a chunk of data. Running sufficient statistics are updated
+        with a step size and parameters are recomputed from them. Memory only depends on
+        the size of the chunk.
+
+        :param data:			[np.array([nb_samples, nb_dim])]
+        :param step_size:		[float] or None
+                Weight of the chunk in the running statistics. If None, use the
+                schedule (t + 1) ** -kappa, with t the number of chunks already seen.
+        :param reg:				[list([nb_dim]) or float]
+                Regulariazation for EM
+        :param diag:			[bool]
+                Use diagonal covariance matrices
+        :param dep_mask: 		[np.array([nb_dim, nb_dim])]
+                Composed of 0 and 1. Mask given the dependencies in the covariance matrices
+        :param reset:			[bool]
+                Forget running statistics
+        :param kappa:			[float] in (0.5, 1.]
+                Decay of the step size schedule
+        :return:				[float]
+                Average log-likelihood of the chunk before the update
+        """
+        if reg is not None:
+            self.reg = reg
+
+        if self.mu is None or self.sigma is None:
+            self.init_params_random(data)
+
+        if reset or getattr(self, '_stream_stats', None) is None:
+            self._stream_stats = None
+            self._stream_count = 0
+
+        if step_size is None:
+            step_size = (self._stream_count + 1.) ** -kappa
+
+        # E - step, statistics are normalized by the size of the chunk
+        stats = GMM.e_step(self, data, cov_type='diag' if diag else 'full') * \
+            (1. / data.shape[0])
+
+        if self._stream_stats is None:
+            self._stream_stats = stats
+        else:
+            self._stream_stats = self._stream_stats * (1. - step_size) + stats * step_size
+
+        self._stream_count += 1
+
+        # M-step
+        GMM.m_step(self, self._stream_stats, dep_mask=dep_mask)
+
+        return stats.log_lik
+
+    def em_stream(self, chunks, reg=1e-8, diag=False, dep_mask=None, kappa=0.6, verbose=False):
+        """
+        Stochastic (online) EM over a stream of data, consumed chunk by chunk.
+        Can be used to fit recordings that do not fit in memory.
+
+        :param chunks: 			[iterable of np.array([nb_samples, nb_dim])]
+                Iterator or generator of chunks of data
+        :param reg:				[list([nb_dim]) or float]
+                Regulariazation for EM
+        :param diag:			[bool]
+                Use diagonal covariance matrices
+        :param dep_mask: 		[np.array([nb_dim, nb_dim])]
+                Composed of 0 and 1. Mask given the dependencies in the covariance matrices
+        :param kappa:			[float] in (0.5, 1.]
+                Decay of the step size schedule (t + 1) ** -kappa
+        :return:				[np.array([nb_chunks])]
+                Average log-likelihood of each chunk before its update
+        """
+        self.reg = reg
+
+        LL = []
+        for i, chunk in enumerate(chunks):
+            LL += [self.partial_fit(chunk, diag=diag, dep_mask=dep_mask, reset=i == 0,
+                                    kappa=kappa)]
+
+        if verbose:
+            print('Stochastic EM processed %d chunks: %.3e' % (len(LL), LL[-1]))
+
+        return np.array(LL)
+
     def init_hmm_kbins(self, demos, dep=None, reg=1e-8, dep_mask=None):
         """
         Init HMM by splitting each demos in K bins along time. Each K states of the HMM will
         be initialized with one of the bin. It corresponds to a left-to-right HMM.
 
         :param demos:	[list of np.array([nb_timestep, nb_dim])]
-        :param dep:
+        :param dep:		[A x [B x [int]]] A list of list of dimensions or slices
+                or BlockStructure
         :param reg:		[float]
         :return:
         """
@@ -370,6 +557,8 @@ class GMM(Model):
 
         self.init_zeros()
 
+        sigma = np.zeros((self.nb_states, self.nb_dim, self.nb_dim))
+
         t_sep = []
 
         for demo in demos:
@@ -392,31 +581,30 @@ class GMM(Model):
             self.priors[i] = states_nb_data
             self.mu[i] = np.mean(data_tmp, axis=0)
 
-            if dep_mask is not None:
-                self.sigma *= dep_mask
+            sigma[i] = np.cov(data_tmp.T) + np.eye(self.nb_dim) * reg
 
-            if dep is None:
-                self.sigma[i] = np.cov(data_tmp.T) + np.eye(self.nb_dim) * reg
-            else:
-                for d in dep:
-                    dGrid = np.ix_([i], d, d)
-                    self.sigma[dGrid] = (np.cov(data_tmp[:, d].T) + np.eye(
-                        len(d)) * reg)[:, :, np.newaxis]
-                # print self.Sigma[:,:,i]
+        if dep is not None:
+            sigma *= self.get_block_structure(dep).mask
+
+        if dep_mask is not None:
+            sigma *= dep_mask
+
+        self.sigma = sigma
 
         # normalize priors
         self.priors = self.priors / np.sum(self.priors)
 
         # Hmm specific init
-        self.Trans = np.ones((self.nb_states, self.nb_states)) * 0.01
+        trans = np.ones((self.nb_states, self.nb_states)) * 0.01
 
         nb_data = np.mean([d.shape[0] for d in demos])
 
         for i in range(self.nb_states - 1):
-            self.Trans[i, i] = 1.0 - float(self.nb_states) / nb_data
-            self.Trans[i, i + 1] = float(self.nb_states) / nb_data
+            trans[i, i] = 1.0 - float(self.nb_states) / nb_data
+            trans[i, i + 1] = float(self.nb_states) / nb_data
 
-        self.Trans[-1, -1] = 1.0
+        trans[-1, -1] = 1.0
+        self.Trans = trans
         self.init_priors = np.ones(self.nb_states) * 1. / self.nb_states
 
     def add_trash_component(self, data, scale=2.):
@@ -445,18 +633,7 @@ class GMM(Model):
         :return: 			np.array([nb_states, nb_samples])
                 log mvn
         """
-        # if len(x.shape) > 1:  # TODO implement mvn for multiple xs
-        # 	raise NotImplementedError
-        mu, lmbda_, sigma_chol_ = self.mu, self.lmbda, self.sigma_chol
-
         if x.ndim > 1:
-            dx = mu[None] - x[:, None]  # nb_timesteps, nb_states, nb_dim
+            return self.mvn_log_prob(x).T
         else:
-            dx = mu - x
-
-        eins_idx = ('baj,baj->ba', 'ajk,baj->bak') if x.ndim > 1 else (
-            'aj,aj->a', 'ajk,aj->ak')
-
-        return -0.5 * np.einsum(eins_idx[0], dx, np.einsum(eins_idx[1], lmbda_, dx)) \
-            - mu.shape[1] / 2. * np.log(2 * np.pi) - np.sum(
-            np.log(sigma_chol_.diagonal(axis1=1, axis2=2)), axis=1)
+            return self.mvn_log_prob(x[None])[:, 0]
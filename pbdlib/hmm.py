@@ -4,6 +4,9 @@ import numpy as np
 from pbdlib.functions import *
 from pbdlib.model import *
 from pbdlib.gmm import *
+from pbdlib.em_utils import SufficientStats, SQUAREM, EStepPool, em_restarts, make_trace, \
+    trace_phase, demo_key, state_divergence
+from pbdlib.online import HMMFilter, logsumexp as _logsumexp
 
 import math
 from numpy.linalg import inv, pinv, norm, det
@@ -12,15 +15,47 @@ from collections import defaultdict
 from scipy.stats import multivariate_normal
 
 
+def _same_marginal(a, b):
+    if isinstance(a, slice) or isinstance(b, slice) or a is None or b is None:
+        return a == b
+
+    return np.array_equal(a, b)
+
+
 class HMM(GMM):
+    # transitions below this probability are neglected when looking for bands, see trans_band
+    trans_band_tol = 1e-10
+
     def __init__(self, nb_states, nb_dim=2):
         GMM.__init__(self, nb_states, nb_dim)
 
         self._trans = None
+        self._trans_band = None
         self._init_priors = None
-        self.qs = {}
-        self.hs = {}
-        self._hs = {}
+        # declared offsets of the bands of the transition matrix, see trans_band
+        self._trans_offsets = None
+
+        # filter used by online_forward_message, and state of its stream kept when the
+        # filter is rebuilt after a change of parameters
+        self._online_filter = None
+        self._online_stream = None
+        # running statistics and filter of online_update
+        self._update_stats = None
+        self._update_filter = None
+        self._update_count = 0
+        # conditioning of velocities on positions, see get_velocity_conditioning
+        self._velocity_cond = None
+        # array-backed histories of positions and states probabilities
+        self.qs = None
+        self.hs = None
+        self._hs = None
+
+        # statistics of each demonstration from last E-step, see em_incremental
+        self._demo_stats = {}
+        self._demo_stats_params = None
+        # dependency structure and mask of the last em, used by em_incremental
+        self._em_dep = None
+        self._em_dep_mask = None
 
     @property
     def init_priors(self):
@@ -34,6 +69,8 @@ class HMM(GMM):
     @init_priors.setter
     def init_priors(self, value):
         self._init_priors = value
+        self._online_filter = None
+        self._velocity_cond = None
 
     @property
     def trans(self):
@@ -47,6 +84,9 @@ class HMM(GMM):
     @trans.setter
     def trans(self, value):
         self._trans = value
+        self._trans_band = self._find_trans_band()
+        self._online_filter = None
+        self._velocity_cond = None
 
     @property
     def Trans(self):
@@ -56,6 +96,77 @@ class HMM(GMM):
     def Trans(self, value):
         self.trans = value
 
+    # parameters cached in online_forward_message and get_velocity_conditioning
+    @GMM.mu.setter
+    def mu(self, value):
+        GMM.mu.fset(self, value)
+        self._online_filter = None
+        self._velocity_cond = None
+
+    @GMM.sigma.setter
+    def sigma(self, value):
+        GMM.sigma.fset(self, value)
+        self._online_filter = None
+        self._velocity_cond = None
+
+    @GMM.lmbda.setter
+    def lmbda(self, value):
+        GMM.lmbda.fset(self, value)
+        self._online_filter = None
+        self._velocity_cond = None
+
+    @GMM.sigma_diag.setter
+    def sigma_diag(self, value):
+        GMM.sigma_diag.fset(self, value)
+        self._online_filter = None
+        self._velocity_cond = None
+
+    @property
+    def trans_offsets(self):
+        """
+        Declared offsets of the bands of the transition matrix, see trans_band
+        """
+        return self._trans_offsets
+
+    @trans_offsets.setter
+    def trans_offsets(self, value):
+        self._trans_offsets = value
+        self._trans_band = self._find_trans_band()
+        self._online_filter = None
+        self._velocity_cond = None
+
+    @property
+    def trans_band(self):
+        """
+        Banded structure of the transition matrix, with non-zero transitions only from i to
+        (i + k) % nb_states for a few offsets k, as for left-to-right or loop models. Forward,
+        backward and Viterbi steps then cost O(nb_states * nb_bands). Offsets can be declared
+        by setting trans_offsets, otherwise they are found from the transitions above
+        trans_band_tol.
+
+        It is computed when Trans or trans_offsets are set. Transitions modified in place
+        (e.g. model.Trans[0, 1] = 0.1) are not detected, set Trans again.
+
+        :return: [BandedMatrix] or None if the transition matrix is not sparse enough
+        """
+        return self._trans_band
+
+    def _find_trans_band(self):
+        if self._trans is None:
+            return None
+
+        offsets = self.trans_offsets if self.trans_offsets is not None else \
+            BandedMatrix.find_offsets(self._trans, tol=self.trans_band_tol)
+
+        return BandedMatrix(self._trans, offsets) if offsets is not None else None
+
+    def get_em_params(self):
+        params = GMM.get_em_params(self)
+        params['init_priors'] = np.array(self.init_priors, dtype=float)
+        params['Trans'] = np.array(self.Trans, dtype=float)
+
+        return params
+
     def make_finish_state(self, demos, dep_mask=None):
         self.has_finish_state = True
         self.nb_states += 1
@@ -84,43 +195,87 @@ class HMM(GMM):
         self.priors = np.concatenate([self.priors, np.zeros(1)], axis=0)
         pass
 
-    def viterbi(self, demo, reg=False):
+    def viterbi(self, demo, reg=False, marginal=None):
         """
         Compute most likely sequence of state given observations
 
         :param demo: 	[np.array([nb_timestep, nb_dim])]
-        :return:
+        :param marginal: [slice(dim_start, dim_end)] or []
+                If not None, demo only contains these dimensions
+        :return: 		[list of int]
         """
+        return self.viterbi_batch([demo], reg=reg, marginal=marginal)[0].tolist()
 
-        nb_data, dim = demo.shape if isinstance(
-            demo, np.ndarray) else demo['x'].shape
+    def viterbi_batch(self, demos, reg=False, marginal=None, return_log_prob=False):
+        """
+        Compute most likely sequences of states of several demonstrations of different
+        lengths. They are decoded together in log-domain, with one vectorized max-plus step
+        per timestep for all demonstrations and states.
+
+        :param demos: 			[list of np.array([nb_timestep, nb_dim])]
+        :param reg: 			[bool]
+                If True, add realmin to probabilities before taking log
+        :param marginal: 		[slice(dim_start, dim_end)] or []
+                If not None, demos only contain these dimensions
+        :param return_log_prob: [bool]
+                If True, also return the log-probability of each most likely sequence
+        :return: 				[list of np.array([nb_timestep])]
+        """
+        lengths = np.array([d.shape[0] if isinstance(d, np.ndarray) else d['x'].shape[0]
+                            for d in demos])
+        nb_demos, nb_data = len(demos), np.max(lengths)
+
+        if all([isinstance(d, np.ndarray) for d in demos]):
+            _, logB = self.obs_likelihood(np.concatenate(demos, axis=0), marginal=marginal)
+            logBs = np.split(logB, np.cumsum(lengths)[:-1], axis=1)
+        else:
+            logBs = [self.obs_likelihood(d, marginal=marginal)[1] for d in demos]
 
-        logB = np.zeros((self.nb_states, nb_data))
-        logDELTA = np.zeros((self.nb_states, nb_data))
-        PSI = np.zeros((self.nb_states, nb_data)).astype(int)
+        # padded observation log-likelihoods [nb_timestep, nb_demos, nb_states]
+        log_b = np.zeros((nb_data, nb_demos, self.nb_states))
+        for n, _logB in enumerate(logBs):
+            log_b[:lengths[n], n] = _logB.T
 
-        _, logB = self.obs_likelihood(demo)
+        band = self.trans_band
 
-        # forward pass
-        logDELTA[:, 0] = np.log(self.init_priors + realmin * reg) + logB[:, 0]
+        with np.errstate(divide='ignore'):
+            log_delta = np.log(self.init_priors + realmin * reg) + log_b[0]
+            if band is None:
+                log_trans = np.log(self.Trans + realmin * reg)
+            else:
+                # log_trans[j, m] is the log-transition to j on band m
+                log_trans = np.log(band.val_in + realmin * reg)
 
+        psi = np.zeros((nb_data, nb_demos, self.nb_states), dtype=int)
+
+        # forward pass, demonstrations that ended are not updated anymore
         for t in range(1, nb_data):
-            for i in range(self.nb_states):
-                # get index of maximum value : most probables
-                PSI[i, t] = np.argmax(
-                    logDELTA[:, t - 1] + np.log(self.Trans[:, i] + realmin * reg))
-                logDELTA[i, t] = np.max(
-                    logDELTA[:, t - 1] + np.log(self.Trans[:, i] + realmin * reg)) + logB[i, t]
+            if band is None:
+                scores = log_delta[:, :, None] + log_trans[None]
+                psi[t] = np.argmax(scores, axis=1)
+                max_score = np.take_along_axis(scores, psi[t][:, None], axis=1)[:, 0]
+            else:
+                scores = log_delta[:, band.idx_in] + log_trans[None]
+                arg = np.argmax(scores, axis=2)
+                psi[t] = np.take_along_axis(band.idx_in[None], arg[:, :, None], axis=2)[:, :, 0]
+                max_score = np.take_along_axis(scores, arg[:, :, None], axis=2)[:, :, 0]
 
-        assert not np.any(np.isnan(logDELTA)), "Nan values"
+            log_delta = np.where((lengths > t)[:, None], max_score + log_b[t], log_delta)
+
+        assert not np.any(np.isnan(log_delta)), "Nan values"
 
         # backtracking
-        q = [0 for i in range(nb_data)]
-        q[-1] = np.argmax(logDELTA[:, -1])
+        q = np.zeros((nb_data, nb_demos), dtype=int)
+        q[-1] = np.argmax(log_delta, axis=1)
         for t in range(nb_data - 2, -1, -1):
-            q[t] = PSI[q[t + 1], t + 1]
+            q[t] = np.where(t < lengths - 1, psi[t + 1, np.arange(nb_demos), q[t + 1]], q[t + 1])
+
+        qs = [q[:l, n] for n, l in enumerate(lengths)]
 
-        return q
+        if return_log_prob:
+            return qs, np.max(log_delta, axis=1)
+
+        return qs
 
     def split_kbins(self, demos):
         t_sep = []
@@ -143,59 +298,46 @@ class HMM(GMM):
     def obs_likelihood(self, demo=None, dep=None, marginal=None, sample_size=200, demo_idx=None):
         sample_size = demo.shape[0]
         # emission probabilities
-        B = np.ones((self.nb_states, sample_size))
+        B = np.zeros((self.nb_states, sample_size))
 
         if marginal != []:
-            for i in range(self.nb_states):
-                mu, sigma = (self.mu, self.sigma)
-
-                if marginal is not None:
-                    mu, sigma = self.get_marginal(marginal)
-
-                if dep is None:
-                    B[i, :] = multi_variate_normal(
-                        demo, mu[i], sigma[i], log=True)
-
-                else:  # block diagonal computation
-                    B[i, :] = 0.
-                    for d in dep:
-                        if isinstance(d, list):
-                            dGrid = np.ix_([i], d, d)
-                            B[[i], :] += multi_variate_normal(demo[:, d], mu[i, d],
-                                                              sigma[dGrid][0], log=True)
-                        elif isinstance(d, slice):
-                            B[[i], :] += multi_variate_normal(demo[:, d], mu[i, d],
-                                                              sigma[i, d, d], log=True)
+            B = self.mvn_log_prob(demo, marginal=marginal, dep=dep)
 
         return np.exp(B), B
 
     def online_forward_message(self, x, marginal=None, reset=False):
         """
+        Forward filtering of one stream of observations, see HMMFilter to filter several
+        streams with the same model. The filter is rebuilt when parameters are set or when
+        marginal changes, the stream then continues from its current state. Parameters
+        modified in place (e.g. model.mu[0] += 1) are not detected, set them again or
+        reset the stream.
 
-        :param x:
+        :param x: 		np.array([nb_dim])
         :param marginal: slice
-        :param reset:
-        :return:
+        :param reset: 	[bool]
+                If True, x is the first observation of the stream
+        :return: 		np.array([nb_states])
         """
-        if (not hasattr(self, '_marginal_tmp') or reset) and marginal is not None:
-            self._marginal_tmp = self.marginal_model(marginal)
+        f = self._online_filter
 
-        if marginal is not None:
-            B, _ = self._marginal_tmp.obs_likelihood(x[None])
-        else:
-            B, _ = self.obs_likelihood(x[None])
+        if f is None or not _same_marginal(f.marginal, marginal):
+            log_likelihood = None
+            if type(self).obs_likelihood is not HMM.obs_likelihood:
+                log_likelihood = lambda x: self.obs_likelihood(x, marginal=marginal)[1].T
 
-        if not hasattr(self, '_alpha_tmp') or reset:
-            self._alpha_tmp = self.init_priors * B[:, 0]
-        else:
-            self._alpha_tmp = self._alpha_tmp.dot(self.Trans) * (B[:, 0])
-        if np.count_nonzero(self._alpha_tmp) == 0:
-            print(self._alpha_tmp)
-        self._alpha_tmp /= np.sum(self._alpha_tmp, keepdims=True) 
+            f = self._online_filter = HMMFilter(self, marginal=marginal,
+                                                log_likelihood=log_likelihood)
+
+            if self._online_stream is not None:
+                f.log_alpha[:], f.started[:] = self._online_stream
+            self._online_stream = f.log_alpha, f.started
 
-        return self._alpha_tmp
+        if reset:
+            f.reset()
+
+        return f.step(x[None])[0]
 
-    
     def marginal_model(self, dims):
         """
         Get a GMM of a slice of this GMM
@@ -210,7 +352,8 @@ class HMM(GMM):
 
         return gmm
 
-    def compute_messages(self, demo=None, dep=None, table=None, marginal=None, sample_size=200, demo_idx=None):
+    def compute_messages(self, demo=None, dep=None, table=None, marginal=None, sample_size=200, demo_idx=None,
+                         zeta_sum=False):
         """
 
         :param demo: 	[np.array([nb_timestep, nb_dim])]
@@ -225,7 +368,10 @@ class HMM(GMM):
                 If not None, compute messages with marginals probabilities
                 If [] compute messages without observations, use size
                 (can be used for time-series regression)
-        :return:
+        :param zeta_sum: [bool]
+                If True, return smoothed edge marginals summed over time
+                np.array([nb_states, nb_states]) instead of zeta, which is never stored
+        :return: 		alpha, beta, gamma, zeta, c
         """
         if isinstance(demo, np.ndarray):
             sample_size = demo.shape[0]
@@ -237,25 +383,17 @@ class HMM(GMM):
         # 	B *= table[:, [n]]
         self._B = B
 
-        # forward variable alpha (rescaled)
-        alpha = np.zeros((self.nb_states, sample_size))
-        alpha[:, 0] = self.init_priors * B[:, 0]
-
-        c = np.zeros(sample_size)
-        c[0] = 1.0 / np.sum(alpha[:, 0] + realmin)
-        alpha[:, 0] = alpha[:, 0] * c[0]
+        band = self.trans_band
+        trans_dot = band.dot if band is not None else lambda x: self.Trans.dot(x)
 
-        for t in range(1, sample_size):
-            alpha[:, t] = alpha[:, t - 1].dot(self.Trans) * B[:, t]
-            # Scaling to avoid underflow issues
-            c[t] = 1.0 / np.sum(alpha[:, t] + realmin)
-            alpha[:, t] = alpha[:, t] * c[t]
+        # forward variable alpha (rescaled)
+        alpha, c = HMM._forward(self, B, band)
 
         # backward variable beta (rescaled)
         beta = np.zeros((self.nb_states, sample_size))
         beta[:, -1] = np.ones(self.nb_states) * c[-1]  # Rescaling
         for t in range(sample_size - 2, -1, -1):
-            beta[:, t] = np.dot(self.Trans, beta[:, t + 1] * B[:, t + 1])
+            beta[:, t] = trans_dot(beta[:, t + 1] * B[:, t + 1])
             beta[:, t] = np.minimum(beta[:, t] * c[t], realmax)
 
         # Smooth node marginals, gamma
@@ -263,17 +401,195 @@ class HMM(GMM):
                                          (self.nb_states, 1))
 
         # Smooth edge marginals. zeta (fast version, considers the scaling factor)
-        zeta = np.zeros((self.nb_states, self.nb_states, sample_size - 1))
-
-        for i in range(self.nb_states):
-            for j in range(self.nb_states):
-                zeta[i, j, :] = self.Trans[i, j] * alpha[i, 0:-1] * B[j, 1:] * beta[
-                    j,
-                    1:]
+        if zeta_sum and band is not None:
+            zeta = band.masked_outer_sum(alpha[:, :-1].T, (B[:, 1:] * beta[:, 1:]).T)
+        elif zeta_sum:
+            # sum over time of outer products, as one matrix product
+            zeta = self.Trans * alpha[:, :-1].dot((B[:, 1:] * beta[:, 1:]).T)
+        else:
+            zeta = self.Trans[:, :, None] * alpha[:, None, :-1] * (B[:, 1:] * beta[:, 1:])[None]
 
         return alpha, beta, gamma, zeta, c
 
-    def init_params_random(self, data, left_to_right=False, self_trans=0.9):
+    def _forward(self, B, band=None):
+        """
+        Rescaled forward recursion
+
+        :param B: 		np.array([nb_states, nb_timestep]) observation likelihoods
+        :param band: 	[BandedMatrix] or None
+        :return: 		alpha, c
+        """
+        trans_rdot = band.rdot if band is not None else lambda x: x.dot(self.Trans)
+
+        alpha = np.zeros(B.shape)
+        alpha[:, 0] = self.init_priors * B[:, 0]
+
+        c = np.zeros(B.shape[1])
+        c[0] = 1.0 / np.sum(alpha[:, 0] + realmin)
+        alpha[:, 0] = alpha[:, 0] * c[0]
+
+        for t in range(1, B.shape[1]):
+            alpha[:, t] = trans_rdot(alpha[:, t - 1]) * B[:, t]
+            # Scaling to avoid underflow issues
+            c[t] = 1.0 / np.sum(alpha[:, t] + realmin)
+            alpha[:, t] = alpha[:, t] * c[t]
+
+        return alpha, c
+
+    def forward_messages(self, demo, marginal=None, dep=None, log=False):
+        """
+        Forward variables only, i.e. filtered probabilities of the states, e.g. for
+        time-series regression. Backward variables and smoothed marginals of
+        compute_messages are not computed.
+
+        :param demo: 	[np.array([nb_timestep, nb_dim])]
+        :param marginal: [slice(dim_start, dim_end)] or []
+                If not None, compute messages with marginals probabilities
+                If [] compute messages without observations, use size
+        :param dep: 	[A x [B x [int]]] A list of list of dimensions
+        :param log: 	[bool]
+                If True, run the recursion in log domain from observation log-likelihoods,
+                such that timesteps where all states have negligible likelihood are not
+                floored, and return log_alpha, log_c
+        :return: 		alpha, c
+                np.array([nb_states, nb_timestep]), np.array([nb_timestep])
+                as given by compute_messages, alpha summing to one at each timestep
+        """
+        sample_size = demo['x'].shape[0] if isinstance(demo, dict) else demo.shape[0]
+
+        B, log_B = self.obs_likelihood(demo, dep, marginal, sample_size)
+        band = self.trans_band
+
+        if not log:
+            return HMM._forward(self, B, band)
+
+        trans_rdot = band.rdot if band is not None else lambda x: x.dot(self.Trans)
+
+        log_alpha = np.zeros(B.shape)
+        log_c = np.zeros(B.shape[1])
+
+        with np.errstate(divide='ignore'):
+            log_alpha[:, 0] = np.log(self.init_priors) + log_B[:, 0]
+
+            for t in range(B.shape[1]):
+                if t > 0:
+                    log_alpha[:, t] = np.log(trans_rdot(np.exp(log_alpha[:, t - 1]))) + \
+                        log_B[:, t]
+
+                log_c[t] = -_logsumexp(log_alpha[:, t])[0]
+                log_alpha[:, t] += log_c[t]
+
+        return log_alpha, log_c
+
+    def compute_messages_batch(self, demos, dep=None, marginal=None, zeta_sum=True,
+                               max_size=2 ** 22):
+        """
+        Forward-backward on several demonstrations of different lengths at once. They are
+        grouped by length into buckets, padded into [nb_demos, nb_timestep_max, nb_states]
+        arrays such that each step of the recursions is one batched product for all
+        demonstrations of the bucket. A demonstration that would be alone in its bucket
+        goes through compute_messages.
+
+        :param demos: 		[list of np.array([nb_timestep, nb_dim])]
+        :param dep: 		[A x [B x [int]]] A list of list of dimensions
+        :param marginal: 	[slice(dim_start, dim_end)] or None
+        :param zeta_sum: 	[bool]
+                If True, return smoothed edge marginals summed over time
+        :param max_size: 	[int]
+                Maximum number of elements of the padded arrays of a bucket. Demonstrations
+                in a bucket are at least half as long as the longest one, such that
+                padding at most doubles the memory.
+        :return: 			alphas, betas, gammas, zetas, cs
+                lists of arrays of each demonstration, as given by compute_messages
+        """
+        lengths = np.array([d.shape[0] for d in demos])
+
+        # longest demos first, a new bucket is started when the padded size exceeds
+        # max_size or when the demo is shorter than half the longest of the bucket
+        buckets = []
+        for n in np.argsort(-lengths, kind='stable'):
+            if buckets and 2 * lengths[n] >= lengths[buckets[-1][0]] and \
+                    (len(buckets[-1]) + 1) * lengths[buckets[-1][0]] * self.nb_states <= max_size:
+                buckets[-1] += [n]
+            else:
+                buckets += [[n]]
+
+        messages = [None] * len(demos)
+        for bucket in buckets:
+            if len(bucket) == 1:
+                messages[bucket[0]] = HMM.compute_messages(
+                    self, demos[bucket[0]], dep, marginal=marginal, zeta_sum=zeta_sum)
+            else:
+                for n, m in zip(bucket, zip(*HMM._compute_messages_padded(
+                        self, [demos[n] for n in bucket], dep, marginal, zeta_sum))):
+                    messages[n] = m
+
+        return tuple(list(m) for m in zip(*messages))
+
+    def _compute_messages_padded(self, demos, dep=None, marginal=None, zeta_sum=True):
+        """
+        Forward-backward on demonstrations padded to the same length, see
+        compute_messages_batch
+        """
+        lengths = np.array([d.shape[0] for d in demos])
+        nb_demos, nb_data = len(demos), np.max(lengths)
+        # mask of timesteps inside each demonstration [nb_demos, nb_timestep]
+        mask = np.arange(nb_data)[None] < lengths[:, None]
+
+        B_, _ = self.obs_likelihood(np.concatenate(demos, axis=0), dep, marginal)
+
+        B = np.zeros((nb_demos, nb_data, self.nb_states))
+        B[mask] = B_.T
+
+        band = self.trans_band
+        trans_rdot = band.rdot if band is not None else lambda x: x.dot(self.Trans)
+        trans_dot = band.dot if band is not None else lambda x: x.dot(self.Trans.T)
+
+        # forward variable alpha (rescaled), timesteps after the end are not used
+        alpha = np.zeros((nb_demos, nb_data, self.nb_states))
+        c = np.zeros((nb_demos, nb_data))
+
+        alpha[:, 0] = self.init_priors * B[:, 0]
+        c[:, 0] = 1.0 / np.sum(alpha[:, 0] + realmin, axis=1)
+        alpha[:, 0] *= c[:, [0]]
+
+        for t in range(1, nb_data):
+            alpha[:, t] = trans_rdot(alpha[:, t - 1]) * B[:, t]
+            # Scaling to avoid underflow issues
+            c[:, t] = 1.0 / np.sum(alpha[:, t] + realmin, axis=1)
+            alpha[:, t] *= c[:, [t]]
+
+        # backward variable beta (rescaled), zero after the end of each demonstration
+        beta = np.zeros((nb_demos, nb_data, self.nb_states))
+        beta[np.arange(nb_demos), lengths - 1] = c[np.arange(nb_demos), lengths - 1][:, None]
+
+        for t in range(nb_data - 2, -1, -1):
+            inside = (t < lengths - 1)[:, None]
+            beta[:, t] = np.where(
+                inside,
+                np.minimum(trans_dot(beta[:, t + 1] * B[:, t + 1]) * c[:, [t]], realmax),
+                beta[:, t])
+
+        # Smooth node marginals, gamma
+        gamma = alpha * beta / (np.sum(alpha * beta, axis=2, keepdims=True) + realmin)
+
+        # Smooth edge marginals, beta is zero after the end such that padding is not summed
+        if zeta_sum and band is not None:
+            zeta = band.masked_outer_sum(alpha[:, :-1], B[:, 1:] * beta[:, 1:])
+        elif zeta_sum:
+            zeta = self.Trans * np.matmul(np.swapaxes(alpha[:, :-1], 1, 2),
+                                          (B[:, 1:] * beta[:, 1:]))
+        else:
+            zeta = [self.Trans[:, :, None] * alpha[n, :l - 1].T[:, None] *
+                    (B[n, 1:l] * beta[n, 1:l]).T[None] for n, l in enumerate(lengths)]
+
+        return [alpha[n, :l].T for n, l in enumerate(lengths)], \
+               [beta[n, :l].T for n, l in enumerate(lengths)], \
+               [gamma[n, :l].T for n, l in enumerate(lengths)], \
+               [zeta[n] for n in range(nb_demos)], \
+               [c[n, :l] for n, l in enumerate(lengths)]
+
+    def init_params_random(self, data, left_to_right=False, self_trans=0.9, rng=None):
         """
 
         :param data:
@@ -282,15 +598,19 @@ class HMM(GMM):
         :type left_to_right: 	bool
         :param self_trans:		if left_to_right, self transition value to fill
         :type self_trans:		float
+        :param rng: 			Random generator, np.random is used if None
+        :type rng: 				np.random.Generator
         :return:
         """
+        rng = np.random if rng is None else rng
+
         mu = np.mean(data, axis=0)
         sigma = np.cov(data.T)
 
         if left_to_right:
             self.mu = np.array([mu for i in range(self.nb_states)])
         else:
-            self.mu = np.array([np.random.multivariate_normal(mu, sigma)
+            self.mu = np.array([rng.multivariate_normal(mu, sigma)
                                 for i in range(self.nb_states)])
 
         self.sigma = np.array(
@@ -298,21 +618,24 @@ class HMM(GMM):
         self.priors = np.ones(self.nb_states) / self.nb_states
 
         if left_to_right:
-            self.Trans = np.zeros((self.nb_states, self.nb_states))
+            trans = np.zeros((self.nb_states, self.nb_states))
             for i in range(self.nb_states):
                 if i < self.nb_states - 1:
-                    self.Trans[i, i] = self_trans
-                    self.Trans[i, i+1] = 1. - self_trans
+                    trans[i, i] = self_trans
+                    trans[i, i+1] = 1. - self_trans
                 else:
-                    self.Trans[i, i] = 1.
+                    trans[i, i] = 1.
 
+            self.Trans = trans
             self.init_priors = np.zeros(self.nb_states) / self.nb_states
         else:
-            self.Trans = np.ones((self.nb_states, self.nb_states)) * \
+            trans = np.ones((self.nb_states, self.nb_states)) * \
                 (1.-self_trans)/(self.nb_states-1)
             # remove diagonal
-            self.Trans *= (1.-np.eye(self.nb_states))
-            self.Trans += self_trans * np.eye(self.nb_states)
+            trans *= (1.-np.eye(self.nb_states))
+            trans += self_trans * np.eye(self.nb_states)
+
+            self.Trans = trans
             self.init_priors = np.ones(self.nb_states) / self.nb_states
 
     def gmm_init(self, data, **kwargs):
@@ -324,11 +647,12 @@ class HMM(GMM):
         self.Trans = np.ones((self.nb_states, self.nb_states))/self.nb_states
 
     def init_loop(self, demos):
-        self.Trans = 0.98 * np.eye(self.nb_states)
+        trans = 0.98 * np.eye(self.nb_states)
         for i in range(self.nb_states-1):
-            self.Trans[i, i + 1] = 0.02
+            trans[i, i + 1] = 0.02
 
-        self.Trans[-1, 0] = 0.02
+        trans[-1, 0] = 0.02
+        self.Trans = trans
 
         data = np.concatenate(demos, axis=0)
         _mu = np.mean(data, axis=0)
@@ -340,8 +664,135 @@ class HMM(GMM):
         self.init_priors = np.array(
             [1.] + [0. for i in range(self.nb_states-1)])
 
+    def e_step(self, demos, dep=None, table=None, cov_type='full', pool=None, keys=None):
+        """
+        Compute messages of each demonstration and their sufficient statistics.
+        Statistics of disjoint sets of demonstrations can be merged by addition.
+
+        :param demos:		[list of np.array([nb_timestep, nb_dim])]
+        :param dep:			[A x [B x [int]]] A list of list of dimensions or slices
+                or BlockStructure. For 'full', only the second moments of the blocks are
+                accumulated.
+        :param table:		np.array([nb_states, nb_demos]) - composed of 0 and 1
+        :param cov_type: 	[string] in ['full', 'diag', 'spherical']
+        :param pool: 		[EStepPool] or None
+                Pool of processes created with the same demos, in which the E-step is run.
+                Messages (and self._gammas) are then not kept.
+        :param keys: 		[list] or None
+                Keys of the demonstrations, under which their statistics are kept for
+                em_incremental. Default is demo_key of each demonstration, hashing them.
+        :return: 			[SufficientStats]
+        """
+        if keys is None:
+            keys = [demo_key(demo) for demo in demos]
+
+        blocks = None
+        if dep is not None and cov_type == 'full':
+            dep = blocks = self.get_block_structure(dep, nb_dim=demos[0].shape[1])
+
+        if pool is not None:
+            self._demo_stats_params = self.get_em_params()
+            demo_stats = pool.map(self._demo_stats_params, dep=dep, cov_type=cov_type)
+
+            self._gammas = None
+            self._demo_stats = {key: [s, 0.] for key, s in zip(keys, demo_stats)}
+
+            return sum(demo_stats)
+
+        stats = SufficientStats(self.nb_states, demos[0].shape[1], hmm=True, cov_type=cov_type,
+                                blocks=blocks)
+        self._gammas = []
+
+        # statistics of each demo are kept for em_incremental, with the parameters
+        # they were computed with
+        self._demo_stats = {}
+        self._demo_stats_params = self.get_em_params()
+
+        # forward-backward of all demos in batch
+        _, _, gammas, zeta_sums, cs = HMM.compute_messages_batch(self, demos, dep)
+
+        for key, demo, gamma, zeta_sum, c in zip(keys, demos, gammas, zeta_sums, cs):
+            demo_stats = SufficientStats.from_messages(
+                demo, gamma, zeta_sum, -np.sum(np.log(c)), cov_type=cov_type, blocks=blocks)
+
+            stats += demo_stats
+            self._gammas += [gamma]
+            self._demo_stats[key] = [demo_stats, 0.]
+
+        return stats
+
+    def m_step(self, stats, dep_mask=None, obs_fixed=False, trans_reg=None, trans_mask=None):
+        """
+        Update parameters from sufficient statistics. For 'diag' and 'spherical' statistics,
+        only variances are computed and stored.
+
+        :param stats: 		[SufficientStats]
+        :param dep_mask: 	[np.array([nb_dim, nb_dim])]
+                Composed of 0 and 1. Mask given the dependencies in the covariance matrices,
+                not needed if the statistics already have a block structure
+        :param obs_fixed: 	[bool]
+                If True, do not update observation model
+        :param trans_reg: 	[float]
+                Regularization of the transition matrix
+        :param trans_mask: 	[np.array([nb_states, nb_states])]
+                Composed of 0 and 1. Allowed transitions, e.g. for left-to-right models
+        :return:
+        """
+        if not obs_fixed:
+            # Update centers
+            self.mu = stats.mean()
+
+            # Update covariances, with regularization
+            if stats.cov_type != 'full':
+                self.sigma_diag = stats.variance(self.reg)
+            else:
+                sigma = stats.covariance(self.reg)
+
+                if dep_mask is not None and stats.blocks is None:
+                    sigma *= dep_mask
+
+                self.sigma = sigma
+
+        # Update initial state probablility vector
+        self.init_priors = stats.init_priors()
+
+        # Update transition probabilities
+        trans = stats.transition()
+
+        if trans_reg is not None:
+            trans += trans_reg
+            trans /= np.sum(trans, axis=1, keepdims=True)
+
+        if trans_mask is not None:
+            trans *= trans_mask
+            trans /= np.sum(trans, axis=1, keepdims=True)
+
+        self.Trans = trans
+
+    def get_trans_mask(self, left_to_right=False, loop=False):
+        """
+        Mask of allowed transitions
+
+        :param left_to_right: 	[bool]
+        :param loop: 			[bool]
+                If True, last state can transit to first state
+        :return: 				np.array([nb_states, nb_states]) or None if all allowed
+        """
+        if not (left_to_right or loop):
+            return None
+
+        mask = np.eye(self.nb_states)
+        for i in range(self.nb_states - 1):
+            mask[i, i + 1] = 1.
+        if loop:
+            mask[-1, 0] = 1.
+
+        return mask
+
     def em(self, demos, dep=None, reg=1e-8, table=None, end_cov=False, cov_type='full', dep_mask=None,
-           reg_finish=None, left_to_right=False, nb_max_steps=40, loop=False, obs_fixed=False, trans_reg=None):
+           reg_finish=None, left_to_right=False, nb_max_steps=40, loop=False, obs_fixed=False, trans_reg=None,
+           n_init=1, n_jobs=None, random_state=None, rng=None, trace=False,
+           accelerate=False):
         """
 
         :param demos:	[list of np.array([nb_timestep, nb_dim])]
@@ -361,8 +812,40 @@ class HMM(GMM):
         :param end_cov:	[bool]
                 If True, compute covariance matrix without regularization after convergence
         :param cov_type: 	[string] in ['full', 'diag', 'spherical']
+        :param n_init:		[int]
+                Number of restarts from random initialization (init_params_random), the one
+                with highest log-likelihood is kept. If mu and sigma are given, the first
+                restart starts from them. Log-likelihood and timing of each restart are
+                stored in self.em_restarts
+        :param n_jobs:		[int] or None
+                Number of processes to run restarts, None uses all processors.
+                Without restarts, if n_jobs is not None and not 1, the E-step of the
+                demos is run in a persistent pool of n_jobs processes (-1 uses all processors)
+        :param random_state:	[int] or None
+                Seed of the restarts
+        :param rng: 		[np.random.Generator] or None
+                Random generator for initialization
+        :param trace: 		[bool] or [EMTrace]
+                If True or EMTrace, record log-likelihood, timing and memory of each
+                iteration in self.em_trace
+        :param accelerate: 	[bool]
+                If True, accelerate EM with SQUAREM extrapolation. Each iteration then runs
+                two or three E-steps but far fewer iterations are needed.
         :return:
         """
+        if n_init > 1:
+            kwargs = dict(dep=dep, reg=reg, table=table, end_cov=end_cov, cov_type=cov_type,
+                          dep_mask=dep_mask, reg_finish=reg_finish, left_to_right=left_to_right,
+                          nb_max_steps=nb_max_steps, loop=loop, obs_fixed=obs_fixed,
+                          trans_reg=trans_reg, trace=trace, accelerate=accelerate)
+            reset = None
+            if self.mu is not None and self.sigma is not None:
+                # the first restart starts from the given parameters, the others randomly
+                def reset(model):
+                    model._mu, model.sigma = None, None
+
+            return em_restarts(HMM.em, self, (demos, ), kwargs, n_init, n_jobs=n_jobs,
+                               random_state=random_state, reset=reset)
 
         if reg_finish is not None:
             end_cov = True
@@ -370,140 +853,351 @@ class HMM(GMM):
         nb_min_steps = 2  # min num iterations
         max_diff_ll = 1e-4  # max log-likelihood increase
 
-        nb_samples = len(demos)
-        data = np.concatenate(demos).T
-        nb_data = data.shape[0]
-
-        s = [{} for d in demos]
         # stored log-likelihood
         LL = np.zeros(nb_max_steps)
 
         if dep is not None:
-            dep_mask = self.get_dep_mask(dep)
+            # compiled once for all iterations
+            dep = self.get_block_structure(dep)
+            dep_mask = dep.mask
+
+        self._em_dep, self._em_dep_mask = dep, dep_mask
 
         self.reg = reg
 
+        trace = make_trace(trace)
+        if trace is not None:
+            self.em_trace = trace
+
         if self.mu is None or self.sigma is None:
-            self.init_params_random(data.T, left_to_right=left_to_right)
+            with trace_phase(trace, 'init'):
+                self.init_params_random(np.concatenate(demos), left_to_right=left_to_right,
+                                        rng=rng)
 
         # create regularization matrix
-
-        if left_to_right or loop:
-            mask = np.eye(self.Trans.shape[0])
-            for i in range(self.Trans.shape[0] - 1):
-                mask[i, i + 1] = 1.
-            if loop:
-                mask[-1, 0] = 1.
+        mask = self.get_trans_mask(left_to_right, loop)
 
         if dep_mask is not None:
-            self.sigma *= dep_mask
-
-        for it in range(nb_max_steps):
+            self.sigma = self.sigma * dep_mask
 
-            for n, demo in enumerate(demos):
-                s[n]['alpha'], s[n]['beta'], s[n]['gamma'], s[n]['zeta'], s[n]['c'] = HMM.compute_messages(
-                    self, demo, dep, table)
+        pool = None
+        if n_jobs is not None and n_jobs != 1:
+            with trace_phase(trace, 'init'):
+                pool = EStepPool(HMM.e_step, self, demos, n_jobs=n_jobs)
 
-            # concatenate intermediary vars
-            gamma = np.hstack([s[i]['gamma'] for i in range(nb_samples)])
-            zeta = np.dstack([s[i]['zeta'] for i in range(nb_samples)])
-            gamma_init = np.hstack([s[i]['gamma'][:, 0:1]
-                                    for i in range(nb_samples)])
-            gamma_trk = np.hstack([s[i]['gamma'][:, 0:-1]
-                                   for i in range(nb_samples)])
+        # demos are hashed once, to key their statistics for em_incremental
+        keys = [demo_key(demo) for demo in demos]
 
-            gamma2 = gamma / (np.sum(gamma, axis=1, keepdims=True) + realmin)
+        def em_step():
+            # E-step
+            with trace_phase(trace, 'e_step'):
+                stats = HMM.e_step(self, demos, dep=dep, table=table, cov_type=cov_type,
+                                   pool=pool, keys=keys)
 
             # M-step
-            if not obs_fixed:
-                for i in range(self.nb_states):
-                    # Update centers
-                    self.mu[i] = np.einsum('a,ia->i', gamma2[i], data)
-
-                    # Update covariances
-                    Data_tmp = data - self.mu[i][:, None]
-                    self.sigma[i] = np.einsum('ij,jk->ik',
-                                              np.einsum('ij,j->ij', Data_tmp,
-                                                        gamma2[i, :]), Data_tmp.T)
-                    # Regularization
-                    self.sigma[i] = self.sigma[i] + self.reg
-
-                    if cov_type == 'diag':
-                        self.sigma[i] *= np.eye(self.sigma.shape[1])
-
-                if dep_mask is not None:
-                    self.sigma *= dep_mask
-
-            # Update initial state probablility vector
-            self.init_priors = np.mean(gamma_init, axis=1)
-
-            # Update transition probabilities
-            self.Trans = np.sum(zeta, axis=2) / \
-                (np.sum(gamma_trk, axis=1) + realmin)
-
-            if trans_reg is not None:
-                self.Trans += trans_reg
-                self.Trans /= np.sum(self.Trans, axis=1, keepdims=True)
-
-            if left_to_right or loop:
-                self.Trans *= mask
-                self.Trans /= np.sum(self.Trans, axis=1, keepdims=True)
-
-            # print self.Trans
-            # Compute avarage log-likelihood using alpha scaling factors
-            LL[it] = 0
-            for n in range(nb_samples):
-                LL[it] -= sum(np.log(s[n]['c']))
-            LL[it] = LL[it] / nb_samples
-
-            self._gammas = [s_['gamma'] for s_ in s]
-
-            # Check for convergence
-            if it > nb_min_steps and LL[it] - LL[it - 1] < max_diff_ll:
-                print("EM converges")
-                if end_cov:
-                    for i in range(self.nb_states):
+            with trace_phase(trace, 'm_step'):
+                HMM.m_step(self, stats, dep_mask=dep_mask, obs_fixed=obs_fixed,
+                           trans_reg=trans_reg, trans_mask=mask)
+
+            return stats,
+
+        squarem = SQUAREM(self) if accelerate else None
+
+        try:
+            for it in range(nb_max_steps):
+
+                if squarem is None:
+                    stats, = em_step()
+                else:
+                    stats, = squarem.step(em_step)
+
+                # Compute avarage log-likelihood using alpha scaling factors
+                LL[it] = stats.log_lik / stats.nb_seq
+                self._em_ll = LL[it]
+
+                if trace is not None:
+                    trace.add_iteration(LL[it], stats.nb_samples * (
+                        1 if squarem is None else squarem.nb_e_steps))
+
+                # Check for convergence
+                if it > nb_min_steps and LL[it] - LL[it - 1] < max_diff_ll:
+                    print("EM converges")
+                    if trace is not None:
+                        trace.converged = True
+                    if end_cov:
                         # recompute covariances without regularization
-                        Data_tmp = data - self.mu[i][:, None]
-                        self.sigma[i] = np.einsum('ij,jk->ik',
-                                                  np.einsum('ij,j->ij', Data_tmp,
-                                                            gamma2[i, :]), Data_tmp.T)
                         if reg_finish is not None:
                             self.reg = reg_finish
-                            self.sigma += self.reg[None]
 
-                    if cov_type == 'diag':
-                        self.sigma[i] *= np.eye(self.sigma.shape[1])
+                        reg_ = self.reg if reg_finish is not None else None
+
+                        if cov_type != 'full':
+                            self.sigma_diag = stats.variance(reg_)
+                        else:
+                            self.sigma = stats.covariance(reg_)
+
+                    # print "EM converged after " + str(it) + " iterations"
+                    # print LL[it]
+
+                    if dep_mask is not None and self.cov_type == 'full':
+                        self.sigma = self.sigma * dep_mask
 
-                # print "EM converged after " + str(it) + " iterations"
-                # print LL[it]
+                    return True
+
+            print("EM did not converge")
+            return False
+        finally:
+            if pool is not None:
+                pool.close()
+
+    def em_incremental(self, demos, dep=None, table=None, cov_type=None, nb_max_steps=10,
+                       tol=1e-3, left_to_right=False, loop=False, obs_fixed=False,
+                       trans_reg=None, verbose=False, dep_mask=None):
+        """
+        Warm-started EM after demonstrations were added to or removed from the training set.
+        Start from the current parameters and the statistics of each demonstration cached by
+        the last E-step (of em or em_incremental). At each iteration, the E-step is only
+        recomputed for new demonstrations and for those whose states changed materially since
+        their statistics were computed.
+
+        The change of a demonstration is the KL divergence of each state (observation model
+        and transitions) between the parameters used for its statistics and the current ones,
+        weighted by the occupancy of the state in the demonstration.
+
+        :param demos:			[list of np.array([nb_timestep, nb_dim])]
+                Full current set of demonstrations. Cached statistics of demonstrations that
+                are not in this list are dropped.
+        :param dep:				[A x [B x [int]]] A list of list of dimensions or slices
+        :param dep_mask: 		[np.array([nb_dim, nb_dim])]
+                Composed of 0 and 1. Mask given the dependencies in the covariance matrices.
+                If dep and dep_mask are None, those of the last em are used.
+        :param table:			np.array([nb_states, nb_demos]) - composed of 0 and 1
+        :param cov_type: 		[string] in ['full', 'diag', 'spherical'] or None
+                Default is the current covariance type of the model
+        :param nb_max_steps: 	[int]
+        :param tol: 			[float]
+                Change (average KL divergence per timestep) above which the E-step of a
+                demonstration is recomputed
+        :param left_to_right: 	[bool]
+        :param loop: 			[bool]
+        :param obs_fixed: 		[bool]
+        :param trans_reg: 		[float]
+        :param verbose: 		[bool]
+        :return: 				[bool] True if converged
+        """
+        cov_type = self.cov_type if cov_type is None else cov_type
+        nb_dim = demos[0].shape[1]
 
-                if dep_mask is not None:
-                    self.sigma *= dep_mask
+        if dep is None and dep_mask is None:
+            dep, dep_mask = self._em_dep, self._em_dep_mask
+        elif dep is not None:
+            dep = self.get_block_structure(dep, nb_dim=nb_dim)
+            dep_mask = dep.mask
 
+        self._em_dep, self._em_dep_mask = dep, dep_mask
+
+        blocks = dep if cov_type == 'full' else None
+
+        mask = self.get_trans_mask(left_to_right, loop)
+        max_diff_ll = 1e-4  # max log-likelihood increase
+
+        cache = self._demo_stats
+        keys = [demo_key(demo) for demo in demos]
+
+        # drop removed demos and statistics incompatible with the requested type
+        cache = {key: c for key, c in cache.items() if key in set(keys) and
+                 c[0].cov_type == cov_type and (c[0].blocks is None) == (blocks is None) and
+                 (blocks is None or np.array_equal(c[0].blocks.mask, blocks.mask))}
+
+        def add_change(old_params, new_params):
+            change = state_divergence(old_params, new_params)
+            for demo_stats in cache.values():
+                demo_stats[1] += np.sum(demo_stats[0].s0 * change) / demo_stats[0].nb_samples
+
+        params = self.get_em_params()
+        if cache:
+            add_change(self._demo_stats_params, params)
+
+        self._demo_stats, self._demo_stats_params = cache, params
+
+        ll = -np.inf
+        for it in range(nb_max_steps):
+            # E-step of new and changed demos
+            todo = {key: demo for key, demo in zip(keys, demos)
+                    if key not in cache or cache[key][1] > tol}
+            nb_computed = len(todo)
+
+            if nb_computed:
+                _, _, gammas, zeta_sums, cs = HMM.compute_messages_batch(
+                    self, list(todo.values()), dep)
+
+                for key, demo, gamma, zeta_sum, c in zip(todo, todo.values(), gammas,
+                                                         zeta_sums, cs):
+                    cache[key] = [SufficientStats.from_messages(
+                        demo, gamma, zeta_sum, -np.sum(np.log(c)), cov_type=cov_type,
+                        blocks=blocks), 0.]
+
+            if verbose:
+                print('Iteration %d: E-step of %d / %d demos' % (it, nb_computed, len(demos)))
+
+            if it > 0 and nb_computed == 0:
+                return True
+
+            stats = sum([cache[key][0] for key in keys])
+
+            # M-step
+            HMM.m_step(self, stats, dep_mask=dep_mask, obs_fixed=obs_fixed,
+                       trans_reg=trans_reg, trans_mask=mask)
+
+            new_params = self.get_em_params()
+            add_change(params, new_params)
+            params = self._demo_stats_params = new_params
+
+            ll, ll_prev = stats.log_lik / stats.nb_seq, ll
+            self._em_ll = ll
+
+            if ll - ll_prev < max_diff_ll:
                 return True
 
-        print("EM did not converge")
         return False
 
+    def online_update(self, x, forgetting=0.99, new_sequence=False, reset=False, cov_type=None,
+                      dep_mask=None, left_to_right=False, loop=False, trans_reg=None,
+                      update_every=1, prior_weight=None):
+        """
+        Recursive (online) EM, to adapt the model to a stream of observations. Running
+        sufficient statistics are decayed by a forgetting factor and updated at each
+        observation with the filtered marginals of the states and of the last transition,
+        in O(nb_states^2 + nb_states * nb_dim^2). The parameters are recomputed from them
+        every update_every observations (the factorization of the covariances, in
+        O(nb_states * nb_dim^3), is only done then).
+
+        :param x: 				np.array([nb_dim]) or np.array([nb_timestep, nb_dim])
+                One observation or a mini-sequence, continuing the stream
+        :param forgetting: 		[float] in (0., 1.]
+                Decay of the statistics at each observation, the effective memory is
+                1 / (1 - forgetting) observations
+        :param new_sequence: 	[bool]
+                If True, x starts a new sequence, its first state is drawn from init_priors
+        :param reset: 			[bool]
+                Forget running statistics, restart from the current parameters
+        :param cov_type: 		[string] in ['full', 'diag', 'spherical'] or None
+                Default is the current covariance type of the model
+        :param dep_mask: 		[np.array([nb_dim, nb_dim])]
+                Composed of 0 and 1. Mask given the dependencies in the covariance matrices
+        :param left_to_right: 	[bool]
+        :param loop: 			[bool]
+        :param trans_reg: 		[float]
+        :param update_every: 	[int]
+                Number of observations between updates of the parameters
+        :param prior_weight: 	[float] or None
+                Number of pseudo-observations given by the current parameters when the
+                statistics are (re)started. Default is 1 / (1 - forgetting).
+        :return: 				[float]
+                Log-likelihood of x given the past observations, before the update
+        """
+        x = x[None] if x.ndim == 1 else x
+        cov_type = self.cov_type if cov_type is None else cov_type
+
+        stats = self._update_stats
+        if reset or stats is None or not stats.is_hmm or stats.cov_type != cov_type:
+            if prior_weight is None:
+                prior_weight = 1. / (1. - forgetting) if forgetting < 1. else self.nb_states
+
+            stats = self._update_stats = SufficientStats.from_params(
+                self.mu, self.sigma, np.ones(self.nb_states) * prior_weight / self.nb_states,
+                trans=self.Trans, init_priors=self.init_priors, cov_type=cov_type)
+            self._update_count = 0
+
+            log_likelihood = None
+            if type(self).obs_likelihood is not HMM.obs_likelihood:
+                log_likelihood = lambda x: self.obs_likelihood(x)[1].T
+
+            self._update_filter = HMMFilter(self, log_likelihood=log_likelihood)
+
+        f = self._update_filter
+        mask = self.get_trans_mask(left_to_right, loop)
+
+        if new_sequence:
+            f.reset()
+
+        ll = 0.
+        for t in range(x.shape[0]):
+            log_b = f.log_likelihood(x[t:t + 1])[0]
+            m = np.max(log_b)
+            b = np.exp(log_b - m)
+
+            stats *= forgetting
+
+            if not f.started[0]:
+                gamma = f.model.init_priors * b
+                norm = np.sum(gamma)
+                gamma /= norm
+
+                stats.nb_seq += 1.
+                stats.init += gamma
+            else:
+                # filtered marginal of the last transition
+                xi = np.exp(f.log_alpha[0])[:, None] * f._trans * b[None]
+                norm = np.sum(xi)
+                xi /= norm
+
+                stats.trans += xi
+                stats.trans_from += np.sum(xi, axis=1)
+                gamma = np.sum(xi, axis=0)
+
+            ll += np.log(norm) + m
+            stats.add_resp(x[t:t + 1], gamma[:, None], np.log(norm) + m)
+
+            with np.errstate(divide='ignore'):
+                f.log_alpha[0] = np.log(gamma)
+            f.started[0] = True
+
+            self._update_count += 1
+            if self._update_count % update_every == 0:
+                HMM.m_step(self, stats, dep_mask=dep_mask, trans_reg=trans_reg,
+                           trans_mask=mask)
+                f.refresh()
+
+        return ll
+
+    def log_likelihood(self, demos, dep=None, marginal=None):
+        """
+        Log-likelihood of demonstrations, computed in batch with the forward recursion only
+
+        :param demos:		[list of np.array([nb_timestep, nb_dim])]
+        :param dep: 		[A x [B x [int]]] A list of list of dimensions
+        :param marginal: 	[slice(dim_start, dim_end)] or None
+        :return: 			np.array([nb_demos])
+        """
+        lengths = np.array([d.shape[0] for d in demos])
+        mask = np.arange(np.max(lengths))[:, None] < lengths[None]
+
+        B_, _ = self.obs_likelihood(np.concatenate(demos, axis=0), dep, marginal)
+
+        # time first [nb_timestep, nb_demos, nb_states], demos concatenated in order
+        B = np.zeros(mask.shape + (self.nb_states, ))
+        B.swapaxes(0, 1)[mask.T] = B_.T
+
+        band = self.trans_band
+        trans_rdot = band.rdot if band is not None else lambda x: x.dot(self.Trans)
+
+        return forward_log_likelihood(B, lengths, self.init_priors, trans_rdot)
+
     def score(self, demos):
         """
+        Negative log-likelihood of each demonstration
 
         :param demos:	[list of np.array([nb_timestep, nb_dim])]
-        :return:
+        :return:		[list of float]
         """
-        ll = []
-        for n, demo in enumerate(demos):
-            _, _, _, _, c = HMM.compute_messages(self, demo)
-            ll += [np.sum(np.log(c))]
-
-        return ll
+        return list(-HMM.log_likelihood(self, demos))
 
     def condition(self, data_in, dim_in, dim_out, h=None, gmm=False, return_gmm=False):
         if gmm:
             return super(HMM, self).condition(data_in, dim_in, dim_out, return_gmm=return_gmm)
         else:
-            a, _, _, _, _ = self.compute_messages(data_in, marginal=dim_in)
+            a, _ = self.forward_messages(data_in, marginal=dim_in)
 
             return super(HMM, self).condition(data_in, dim_in, dim_out, h=a)
 
@@ -519,101 +1213,128 @@ class HMM(GMM):
         self.trans = value
 
 
+    def get_velocity_conditioning(self, q_dim, reset=False):
+        """
+        Linear maps conditioning velocities on positions and positions on velocities for
+        each state, when the first q_dim dimensions of the model are positions q and the
+        others velocities q_dot:
+            E[q_dot | q, i] = b_qdot[i] + A_qdot[i] q
+            E[q | q_dot, i] = b_q[i] + A_q[i] q_dot
+        with the forward filter on positions. They are computed once and kept until mu,
+        sigma, Trans or init_priors are set. Parameters modified in place
+        (e.g. model.mu[0] += 1) are not detected, reset is then needed.
+
+        :param q_dim: 	[int]
+        :param reset: 	[bool]
+                If True, recompute from the current parameters
+        :return: 		[dict]
+        """
+        c = self._velocity_cond
+        if c is not None and c['q_dim'] == q_dim and not reset:
+            return c
+
+        mu, sigma = self.mu, self.sigma
+        q, v = slice(0, q_dim), slice(q_dim, None)
+
+        # Sigma_vq Sigma_qq^-1 and Sigma_qv Sigma_vv^-1, from symmetric covariances
+        A_qdot = np.swapaxes(np.linalg.solve(sigma[:, q, q], sigma[:, q, v]), 1, 2)
+        A_q = np.swapaxes(np.linalg.solve(sigma[:, v, v], sigma[:, v, q]), 1, 2)
+
+        log_likelihood = None
+        if type(self).obs_likelihood is not HMM.obs_likelihood:
+            log_likelihood = lambda x: self.obs_likelihood(x, marginal=q)[1].T
+
+        self._velocity_cond = {
+            'q_dim': q_dim,
+            'A_qdot': A_qdot, 'b_qdot': mu[:, v] - np.einsum('aij,aj->ai', A_qdot, mu[:, q]),
+            'A_q': A_q, 'b_q': mu[:, q] - np.einsum('aij,aj->ai', A_q, mu[:, v]),
+            'filter': HMMFilter(self, marginal=q, log_likelihood=log_likelihood)}
+
+        return self._velocity_cond
+
+    def _history_array(self, name, t, shape, axis):
+        """
+        Array-backed history stored in attribute name, with timesteps along axis and nan
+        where not computed. It is grown by doubling such that timestep t exists.
+        """
+        hist = getattr(self, name)
+        if hist is not None and hist.shape[:axis] + hist.shape[axis + 1:] == shape:
+            if hist.shape[axis] > t:
+                return hist
+            size = max(t + 1, 2 * hist.shape[axis])
+        else:
+            hist, size = None, max(t + 1, 64)
+
+        new = np.full(shape[:axis] + (size, ) + shape[axis:], np.nan)
+        if hist is not None:
+            new[(slice(None), ) * axis + (slice(0, hist.shape[axis]), )] = hist
+
+        setattr(self, name, new)
+        return new
+
     def predict_qdot(self, q, t):
-        q_dim = len(q)
-        q_dot = np.zeros((q_dim))
-        reset = False
-        for i in range(self.nb_states):
-            a = q - self.mu[i][0:q_dim]
-            b = inv(self.sigma[i][0:q_dim , 0:q_dim]) @ a
-            c = self.sigma[i][q_dim:, 0:q_dim] @ b
-            d = self.mu[i][q_dim:] + c
-            #h = self.h(i, q, t)
-            if t == 0:
-                reset = True
-            h = self.online_forward_message(q, marginal=slice(0, 7), reset=reset)
-            self.hs[i, t] = h[i]
-            q_dot += h[i] * d
-        return q_dot
+        """
+        Velocity given position, with one update of the forward filter on positions.
+        Probabilities of the states are stored in self.hs[:, t].
+
+        :param q: 	np.array([q_dim])
+        :param t: 	[int]
+                Timestep, the filter is restarted when t == 0
+        :return: 	np.array([nb_dim - q_dim])
+        """
+        c = self.get_velocity_conditioning(q.shape[0])
+
+        if t == 0:
+            c['filter'].reset()
 
+        h = c['filter'].step(q[None])[0]
+        self._history_array('hs', t, (self.nb_states, ), 1)[:, t] = h
+
+        return h.dot(c['b_qdot'] + np.matmul(c['A_qdot'], q))
 
     def predict_q(self, q_dot, q, t):
-        q_dim = len(q_dot)
-        q_new = np.zeros((q_dim))
-        for i in range(self.nb_states):
-            a = q_dot - self.mu[i][q_dim:]
-            b = inv(self.sigma[i][q_dim: , q_dim:]) @ a
-            c = self.sigma[i][0:q_dim, q_dim:] @ b
-            d = self.mu[i][:q_dim] + c
-            h = self.hs[i, t]
-            # maybe q_dot instead of q in h
-            q_new += h * d
-        return q_new
+        """
+        Position given velocity, with the probabilities of the states computed by
+        predict_qdot at timestep t
+
+        :param q_dot: 	np.array([nb_dim - q_dim])
+        :param q: 		np.array([q_dim])
+        :param t: 		[int]
+        :return: 		np.array([q_dim])
+        """
+        c = self.get_velocity_conditioning(self.nb_dim - q_dot.shape[0])
+
+        return self.hs[:, t].dot(c['b_q'] + np.matmul(c['A_q'], q_dot))
 
     def h(self, i, q, t):
-        if (i, t) in self._hs.keys():
+        if self._hs is not None and t < self._hs.shape[1] and not np.isnan(self._hs[i, t]):
             return self._hs[i, t]
         return self.h_right(i, q, t)
-        
-    def _normal_q(self, q, i):
-        q_dim = len(q)
-        #a = multivariate_normal.pdf(q,mean=self.mu[i][:q_dim], cov=self.sigma[i][:q_dim, :q_dim])
-        a = multi_variate_normal(np.array([q]), self.mu[i][0:q_dim], sigma=self.sigma[i][0:q_dim, 0:q_dim], log=True)
-        a = np.exp(a)
-        #a = q - self.mu[i][:q_dim]
-        #sigma = self.sigma[i][:q_dim, :q_dim]
-        #änorm = np.sqrt((2*np.pi)**q_dim) * np.abs(np.linalg.det(sigma))
-        #prob = a.T @ sigma @ a
-        #a = (- 0.5 * prob)/ norm 
-        return a + np.finfo(float).tiny
-        
+
+    def _normal_q(self, q, i=None):
+        """
+        Likelihood of position q for state i, or for all states if i is None
+        """
+        log_b = self.get_velocity_conditioning(q.shape[0])['filter'].log_likelihood(q[None])[0]
+
+        return np.exp(log_b if i is None else log_b[i]) + np.finfo(float).tiny
+
     def _history(self, q, t):
-        q_dim=len(q)
-        if t == 0:
-            s = 0
-            for i in range(self.nb_states):
-                res = float(self.priors[i] * self._normal_q(q, i))
-                s += res
-                self._hs[i, t] = res
-            for j in range(self.nb_states):
-                self._hs[j, t] = self._hs[j, t] / s
-        else:
-            for i in range(self.nb_states):
-                res = 0
-                for j in range(self.nb_states):
-                    res += self._hs[j, t-1] * self.Trans[j][i]
-                res *= float(self._normal_q(q, i))
-                self._hs[i, t] = res
-            s = 0
-            for k in range(self.nb_states):
-                res = 0
-                for j in range(self.nb_states):
-                    res += self._hs[j, t-1] * self.Trans[j][k]
-                res *= float(self._normal_q(q, k))
-                s += res
-            for i in range(self.nb_states):
-                self._hs[i, t] /= s
-    
+        """
+        Forward filtering on positions, starting from priors. Probabilities of the states
+        are stored in self._hs[:, t].
+
+        :param q: 	np.array([q_dim])
+        :param t: 	[int]
+        :return: 	np.array([nb_states])
+        """
+        hs = self._history_array('_hs', t, (self.nb_states, ), 1)
+        self._history_array('qs', t, q.shape, 0)[t] = q
+
+        h = self._normal_q(q) * (self.priors if t == 0 else hs[:, t - 1].dot(self.Trans))
+        hs[:, t] = h / np.sum(h)
+
+        return hs[:, t]
+
     def h_right(self, i, q, t):
-        self.qs[t] = q
-        if t == 0:
-            res = self.priors[i] * self._normal_q(q, i)
-            s = 0
-            for k in range(self.nb_states):
-                s += self.priors[k] * self._normal_q(q, i)
-            res /= s
-        else:
-            num = 0
-            for j in range(self.nb_states):
-                num += self._hs[j, t-1] * self.Trans[i][j]
-            num *= self._normal_q(q, i)
-            denom = 0
-            for k in range(self.nb_states):
-                tmp = 0
-                for j in range(self.nb_states):
-                    tmp += self._hs[j, t-1] * self.Trans[k][j]
-                tmp += self._normal_q(q, k)
-                denom += tmp
-            res = num / denom
-        self._hs[i, t] = res
-        return res 
\ No newline at end of file
+        return self._history(q, t)[i]
@@ -3,16 +3,77 @@ import numpy as np
 from .hmm import *
 from .functions import *
 from .model import *
+from .online import HSMMFilter, shift_durations, durations_alpha_0
 
 
 class OnlineForwardVariable():
+    """
+    State of the HSMM forward recursion, in buffers of fixed size. Only the last forward
+    variable over durations ALPHA [nb_states, nbD], the last scaled observation
+    probabilities bmx and the last probabilities S of entering each state are kept, such
+    that a step costs O(nb_states * nbD) and memory does not grow with time.
+
+    ALPHA is stored as a circular buffer over the duration axis, shifted in place as the
+    streams of HSMMFilter, see shift_durations.
+    """
     def __init__(self):
         self.nbD = None
         self.bmx = None
-        self.ALPHA = None
         self.S = None
         self.h = None
-        pass
+
+        self.buf = None  # np.array([1, nb_states, nbD])
+        self.head = np.zeros(1, dtype=int)
+        self._Pd2 = None  # duration probabilities, twice along durations
+
+    def init(self, Pd, priors):
+        """
+        ALPHA[:, d] = priors * Pd[:, d]
+
+        :param Pd: 		np.array([nb_states, nbD])
+        :param priors: 	np.array([nb_states])
+        """
+        self.nbD = Pd.shape[1]
+        self._Pd2 = np.concatenate([Pd, Pd], axis=1)
+        self.buf = (priors[:, None] * Pd)[None]
+        self.head = np.zeros(1, dtype=int)
+
+    @property
+    def ALPHA(self):
+        """
+        Forward variable over remaining durations, np.array([nb_states, nbD])
+        """
+        return np.roll(self.buf[0], -self.head[0], axis=1)
+
+    @property
+    def alpha_0(self):
+        """
+        ALPHA[:, 0], probabilities of leaving each state
+        """
+        return durations_alpha_0(self.buf, self.head)[0]
+
+    def shift(self, S, bmx=None):
+        """
+        ALPHA[:, d] <- S * Pd[:, d] + bmx * ALPHA[:, d + 1], in place
+
+        :param S: 		np.array([nb_states])
+        :param bmx: 	np.array([nb_states]) or None for ones
+        """
+        shift_durations(self.buf, self.head, S[None], None if bmx is None else bmx[None],
+                        self._Pd2)
+
+    def sum(self):
+        """
+        :return: 	np.array([nb_states]) sum of ALPHA over durations
+        """
+        return np.sum(self.buf[0], axis=1)
+
+    def copy(self):
+        fw = OnlineForwardVariable()
+        fw.__dict__.update(self.__dict__)
+        fw.buf = self.buf.copy()
+        fw.head = self.head.copy()
+        return fw
 
 
 class HSMM(HMM):
@@ -24,6 +85,13 @@ class HSMM(HMM):
         self._sigma_d = None
         self._trans_d = None
 
+        # duration probability tables, see get_duration_table
+        self._duration_tables = {}
+        # probability of the durations left out of the tables of forward variables
+        self.dur_tail_mass = 1e-8
+
+        self.ol = None  # online forward variable, see online_forward_variable_prob
+
     @property
     def trans_d(self):
         return self._trans_d
@@ -39,6 +107,7 @@ class HSMM(HMM):
     @mu_d.setter
     def mu_d(self, value):
         self._mu_d = value
+        self._duration_tables = {}
 
     @property
     def sigma_d(self):
@@ -47,9 +116,10 @@ class HSMM(HMM):
     @sigma_d.setter
     def sigma_d(self, value):
         self._sigma_d = value
+        self._duration_tables = {}
 
     def make_finish_state(self, demos, dep_mask=None):
-        state_sequ = [np.array(self.viterbi(d)) for d in demos]
+        state_sequ = self.viterbi_batch(demos)
         for i, d in enumerate(demos):
             state_sequ[i][-3:] = self.nb_states
         super(HSMM, self).make_finish_state(demos, dep_mask)
@@ -76,14 +146,15 @@ class HSMM(HMM):
         # create a table to count the transition
         trans_list = np.zeros((self.nb_states, self.nb_states))
 
-        s = demos if demos is not None else sequ
+        if sequ is None:
+            # decode all demonstrations at once
+            sequ = self.viterbi_batch(
+                demos if marginal is None else [d[:, marginal] for d in demos],
+                marginal=marginal)
+
         # reformat transition matrix by counting the transition
-        for j, d in enumerate(s):
-            if sequ is None:
-                state_seq_tmp = self.viterbi(
-                    d) if marginal is None else self.viterbi(d[:, marginal])
-            else:
-                state_seq_tmp = d.tolist()
+        for j, d in enumerate(sequ):
+            state_seq_tmp = d.tolist()
             prev_state = 0
 
             for i, state in enumerate(state_seq_tmp):
@@ -138,20 +209,49 @@ class HSMM(HMM):
         self.compute_duration(demos)
         return gamma
 
+    def em_incremental(self, demos, **kwargs):
+        converged = HMM.em_incremental(self, demos, **kwargs)
+
+        self.compute_duration(demos)
+        return converged
+
     def compute_messages(self, demo=None, dep=None, table=None, marginal=None, sample_size=200, p0=None):
-        if demo is None:
+        alpha, _ = self.forward_messages(demo, marginal=marginal, dep=dep, sample_size=sample_size,
+                                         p0=p0)
+
+        return alpha, None, None, None, None
+
+    def forward_messages(self, demo, marginal=None, dep=None, log=False, sample_size=200, p0=None):
+        """
+        Forward variables of the HSMM, see HMM.forward_messages. No scaling factors are
+        returned.
+
+        :param demo: 		[np.array([nb_timestep, nb_dim])] or None
+        :param marginal: 	[slice(dim_start, dim_end)] or []
+                If [] compute messages without observations, use size
+        :param dep: 		[A x [B x [int]]] A list of list of dimensions
+        :param log: 		[bool]
+                If True, return log_alpha
+        :param sample_size: [int]
+                Number of timesteps if demo is None
+        :param p0: 			np.array([nb_states]) or None
+        :return: 			alpha, None
+        """
+        if isinstance(demo, np.ndarray):
             sample_size = demo.shape[0]
         elif isinstance(demo, dict):
             sample_size = demo['x'].shape[0]
 
         if marginal == []:
-            alpha, beta, gamma, zeta, c = self.forward_variable_ts(
-                sample_size, p0=p0), None, None, None, None
+            alpha = self.forward_variable_ts(sample_size, p0=p0)
         else:
-            alpha, beta, gamma, zeta, c = self.forward_variable(
-                sample_size, demo, marginal), None, None, None, None
+            alpha = self.forward_variable(sample_size, demo, marginal, dep=dep)
 
-        return alpha, beta, gamma, zeta, c
+        if log:
+            with np.errstate(divide='ignore'):
+                alpha = np.log(alpha)
+
+        return alpha, None
 
     def forward_variable_ts(self, n_step, p0=None):
         """
@@ -162,22 +262,18 @@ class HSMM(HMM):
         :return:
         """
 
-        nbD = np.round(4 * n_step/self.nb_states)
-
-        self.Pd = np.zeros((self.nb_states, nbD))
-        # Precomputation of duration probabilities
+        nbD = int(np.round(4 * n_step/self.nb_states))
 
-        for i in range(self.nb_states):
-            self.Pd[i, :] = multi_variate_normal(
-                np.arange(nbD), self.Mu_Pd[i], self.Sigma_Pd[i], log=False)
-            self.Pd[i, :] = self.Pd[i, :] / np.sum(self.Pd[i, :])
+        # Precomputation of duration probabilities, truncated to the durations of the states
+        self.Pd = self.get_duration_table(nbD, tail_mass=self.dur_tail_mass)
+        nbD = self.Pd.shape[1]
 
         h = np.zeros((self.nb_states, n_step))
 
-        ALPHA, S, h[:, 0] = self._fwd_init_ts(nbD, p0=p0)
+        fw, h[:, 0] = self._fwd_init_ts(nbD, p0=p0)
 
         for i in range(1, n_step):
-            ALPHA, S, h[:, i] = self._fwd_step_ts(ALPHA, S, nbD)
+            h[:, i] = self._fwd_step_ts(fw)
 
         h /= np.sum(h, axis=0)
         return h
@@ -186,29 +282,25 @@ class HSMM(HMM):
         """
         Initiatize forward variable computation based only on duration (no observation)
         :param nbD: number of time steps
-        :return:
+        :return: 	[OnlineForwardVariable], np.array([nb_states])
         """
-        if p0 is None:
-            ALPHA = np.tile(self.init_priors, [nbD, 1]).T * self.Pd
-        else:
-            ALPHA = np.tile(p0, [nbD, 1]).T * self.Pd
+        fw = OnlineForwardVariable()
+        fw.init(self.Pd[:, :nbD], self.init_priors if p0 is None else p0)
 
-        # use [idx] to keep the dimension
-        S = np.dot(self.Trans_Pd.T, ALPHA[:, [0]])
+        fw.S = np.dot(self.Trans_Pd.T, fw.alpha_0)
 
-        return ALPHA, S, np.sum(ALPHA, axis=1)
+        return fw, fw.sum()
 
-    def _fwd_step_ts(self, ALPHA, S, nbD):
+    def _fwd_step_ts(self, fw):
         """
-        Step of forward variable computation based only on duration (no observation)
-        :return:
+        Step of forward variable computation based only on duration (no observation),
+        fw is updated in place
+        :return: 	np.array([nb_states])
         """
-        ALPHA = np.concatenate((S[:, [-1]] * self.Pd[:, 0:nbD-1] + ALPHA[:, 1:nbD],
-                                S[:, [-1]] * self.Pd[:, [nbD-1]]), axis=1)
-
-        S = np.concatenate((S, np.dot(self.Trans_Pd.T, ALPHA[:, [0]])), axis=1)
+        fw.shift(fw.S)
+        fw.S = np.dot(self.Trans_Pd.T, fw.alpha_0)
 
-        return ALPHA, S, np.sum(ALPHA, axis=1)
+        return fw.sum()
 
     def forward_variable(self, n_step=None, demo=None, marginal=None, dep=None, p_obs=None):
         """
@@ -235,15 +327,11 @@ class HSMM(HMM):
         elif isinstance(demo, dict):
             n_step = demo['x'].shape[0]
 
-        nbD = np.round(4 * n_step/self.nb_states)
+        nbD = int(np.round(4 * n_step/self.nb_states))
 
-        self.Pd = np.zeros((self.nb_states, nbD))
-
-        # Precomputation of duration probabilities
-        for i in range(self.nb_states):
-            self.Pd[i, :] = multi_variate_normal(
-                np.arange(nbD), self.Mu_Pd[i], self.Sigma_Pd[i], log=False)
-            self.Pd[i, :] = self.Pd[i, :] / np.sum(self.Pd[i, :])
+        # Precomputation of duration probabilities, truncated to the durations of the states
+        self.Pd = self.get_duration_table(nbD, tail_mass=self.dur_tail_mass)
+        nbD = self.Pd.shape[1]
 
         # compute observation marginal probabilities
         p_obs, _ = self.obs_likelihood(demo, dep, marginal, n_step)
@@ -251,11 +339,10 @@ class HSMM(HMM):
         self._B = p_obs
 
         h = np.zeros((self.nb_states, n_step))
-        bmx, ALPHA, S, h[:, 0] = self._fwd_init(nbD, p_obs[:, 0])
+        fw, h[:, 0] = self._fwd_init(nbD, p_obs[:, 0])
 
         for i in range(1, n_step):
-            bmx, ALPHA, S, h[:, i] = self._fwd_step(
-                bmx, ALPHA, S, nbD, p_obs[:, i])
+            h[:, i] = self._fwd_step(fw, p_obs[:, i])
 
         h /= np.sum(h, axis=0)
 
@@ -265,46 +352,42 @@ class HSMM(HMM):
         """
 
         :param nbD:
-        :return:
+        :param priors: 	np.array([nb_states]) observation probabilities
+        :return: 		[OnlineForwardVariable], np.array([nb_states])
         """
-        bmx = np.zeros((self.nb_states, 1))
+        fw = OnlineForwardVariable()
+        fw.init(self.Pd[:, :nbD], self.init_priors)
 
         Btmp = priors
+        sum_alpha = fw.sum()
 
-        ALPHA = np.tile(self.init_priors, [nbD, 1]).T * self.Pd
+        r = np.dot(Btmp.T, sum_alpha)
 
-        # r = Btmp.T * np.sum(ALPHA, axis=1)
-        r = np.dot(Btmp.T, np.sum(ALPHA, axis=1))
+        fw.bmx = Btmp / r
+        fw.S = np.dot(self.Trans_Pd.T, fw.bmx * fw.alpha_0)
 
-        bmx[:, 0] = Btmp / r
-        E = bmx * ALPHA[:, [0]]
-        S = np.dot(self.Trans_Pd.T, E)  # use [idx] to keep the dimension
+        return fw, Btmp * sum_alpha
 
-        return bmx, ALPHA, S, Btmp * np.sum(ALPHA, axis=1)
-
-    def _fwd_step(self, bmx, ALPHA, S, nbD, obs_marginal=None):
+    def _fwd_step(self, fw, obs_marginal=None):
         """
+        Step of forward variable computation, fw is updated in place
 
-        :param bmx:
-        :param ALPHA:
-        :param S:
-        :param nbD:
-        :return:
+        :param fw: 				[OnlineForwardVariable]
+        :param obs_marginal: 	np.array([nb_states]) observation probabilities
+        :return: 				np.array([nb_states])
         """
-
         Btmp = obs_marginal
 
-        ALPHA = np.concatenate((S[:, [-1]] * self.Pd[:, 0:nbD-1] + bmx[:, [-1]] * ALPHA[:, 1:nbD],
-                                S[:, [-1]] * self.Pd[:, [nbD-1]]), axis=1)
+        fw.shift(fw.S, fw.bmx)
+        sum_alpha = fw.sum()
 
-        r = np.dot(Btmp.T, np.sum(ALPHA, axis=1))
-        bmx = np.concatenate((bmx, Btmp[:, None] / r), axis=1)
-        E = bmx[:, [-1]] * ALPHA[:, [0]]
+        r = np.dot(Btmp.T, sum_alpha)
+        fw.bmx = Btmp / r
+        fw.S = np.dot(self.Trans_Pd.T, fw.alpha_0)
 
-        S = np.concatenate((S, np.dot(self.Trans_Pd.T, ALPHA[:, [0]])), axis=1)
-        alpha = Btmp * np.sum(ALPHA, axis=1)
+        alpha = Btmp * sum_alpha
         alpha /= np.sum(alpha)
-        return bmx, ALPHA, S, alpha
+        return alpha
 
     ########################################################################################
     # SANDBOX ABOVE
@@ -334,6 +417,66 @@ class HSMM(HMM):
     def Trans_Pd(self, value):
         self.trans_d = value
 
+    def get_duration_table(self, nbD, log=False, uniform_below=None, tail_mass=None):
+        """
+        Probabilities of durations 0, ..., nbD - 1 for each state, from the Gaussian
+        duration model Mu_Pd, Sigma_Pd. The tables are computed for all states at once and
+        kept for each (Mu_Pd, Sigma_Pd, nbD), they are dropped when mu_d or sigma_d are set.
+        The returned array is shared and read-only.
+
+        With tail_mass, the durations of each state are truncated where the probability of
+        longer durations falls below tail_mass, such that the size of the table follows the
+        durations of the states instead of nbD. The table is cut to the longest support and
+        padded with zeros for the other states.
+
+        :param nbD: 			[int]
+                Number of durations
+        :param log: 			[bool]
+                If True, log-densities are normalized instead of densities
+        :param uniform_below: 	[float] or None
+                States whose (log-)densities sum below this value get uniform probabilities
+        :param tail_mass: 		[float] or None
+                Probability of the durations left out of the support of each state
+        :return: 				np.array([nb_states, nbD]), less durations with tail_mass
+        """
+        mu = np.asarray(self.Mu_Pd, dtype=float).reshape(-1)
+        sigma = np.asarray(self.Sigma_Pd, dtype=float).reshape(-1)
+
+        key = (mu.tobytes(), sigma.tobytes(), nbD, log, uniform_below, tail_mass)
+        if key in self._duration_tables:
+            return self._duration_tables[key]
+
+        Pd = -0.5 * (np.arange(nbD)[None] - mu[:, None]) ** 2 / sigma[:, None] \
+             - 0.5 * (np.log(2 * np.pi) + np.log(np.abs(sigma)))[:, None]
+        if not log:
+            Pd = np.exp(Pd)
+
+        norm = np.sum(Pd, axis=1)
+        if uniform_below is None:
+            Pd /= norm[:, None]
+        else:
+            uniform = norm < uniform_below
+            Pd[~uniform] /= norm[~uniform, None]
+            Pd[uniform] = 1.0 / nbD
+
+        if tail_mass is not None:
+            # probability of durations longer or equal to d
+            tail = np.cumsum(Pd[:, ::-1], axis=1)[:, ::-1]
+            support = np.maximum(np.sum(tail > tail_mass, axis=1), 1)
+
+            Pd = Pd[:, :np.max(support)].copy()
+            Pd[np.arange(Pd.shape[1])[None] >= support[:, None]] = 0.
+            Pd /= np.sum(Pd, axis=1, keepdims=True)
+
+        Pd.flags.writeable = False
+
+        # only keep the tables of the last queries, parameters in keys can be modified in place
+        if len(self._duration_tables) >= 8:
+            self._duration_tables.pop(next(iter(self._duration_tables)))
+        self._duration_tables[key] = Pd
+
+        return Pd
+
     def forward_variable_priors(self, n_step, priors, tp_param=None, start_priors=None):
         """
         Compute the forward variable with some priors over the states
@@ -357,30 +500,21 @@ class HSMM(HMM):
             self._update_transition_matrix(tp_param)
 
         # nbD = np.round(2 * n_step/self.nb_states)
-        nbD = np.round(2 * n_step)
-
-        self.Pd = np.zeros((self.nb_states, nbD))
+        nbD = int(np.round(2 * n_step))
 
         # Precomputation of duration probabilities
-        for i in range(self.nb_states):
-            self.Pd[i, :] = multi_variate_normal(
-                np.arange(nbD), self.Mu_Pd[i], self.Sigma_Pd[i])
-            if np.sum(self.Pd[i, :]) < 1e-50:
-                self.Pd[i, :] = 1.0 / self.Pd[i, :].shape[0]
-            else:
-                self.Pd[i, :] = self.Pd[i, :] / np.sum(self.Pd[i, :])
+        self.Pd = self.get_duration_table(nbD, log=True, uniform_below=1e-50)
 
         h = np.zeros((self.nb_states, n_step))
 
         priors = colvec(priors)
         priors /= np.sum(priors)
 
-        bmx, ALPHA, S, h[:, [0]] = self._fwd_init_priors(
+        fw, h[:, [0]] = self._fwd_init_priors(
             nbD, priors, start_priors=start_priors)
 
         for i in range(1, n_step):
-            bmx, ALPHA, S, h[:, [i]] = self._fwd_step_priors(
-                bmx, ALPHA, S, nbD, priors)
+            h[:, [i]] = self._fwd_step_priors(fw, priors)
 
         h /= np.sum(h, axis=0)
 
@@ -396,50 +530,24 @@ class HSMM(HMM):
         :return:
         """
         if tp_param is None:
-            try:
-                # self.Trans_Fw = self.tp_trans.Prior_Trans
-                self.Trans_Fw = self.Trans_Pd
-                # print self.Trans_Fw
-            except:
-                print(
-                    "No task-parametrized transition matrix : normal transition matrix will be used")
-                self.Trans_Fw = self.Trans_Pd
-                # print self.Trans_Fw
+            # self.Trans_Fw = self.tp_trans.Prior_Trans
+            self.Trans_Fw = self.Trans_Pd
         else:  # compute the transition matrix for current parameters
             self._update_transition_matrix(tp_param)
 
-        self.ol = OnlineForwardVariable()
-
-        # self.ol.nbD = np.round(2 * n_step / self.nb_states)
         if nb_sum is None:
-            self.ol.nbD = np.round(2 * n_step)
+            nbD = int(np.round(2 * n_step))
         else:
-            self.ol.nbD = nb_sum
-
-        self.Pd = np.zeros((self.nb_states, self.ol.nbD))
-
-        # Precomputation of duration probabilities
-        for i in range(self.nb_states):
-            self.Pd[i, :] = multi_variate_normal(np.arange(self.ol.nbD), self.Mu_Pd[i],
-                                                 self.Sigma_Pd[i], log=False)
-            self.Pd[i, :] = self.Pd[i, :] / np.sum(self.Pd[i, :])
-
-        h = np.zeros((self.nb_states, n_step))
-
-        self.ol.h = np.zeros((self.nb_states, 1))
-
-        priors = colvec(priors)
-        priors /= np.sum(priors)
+            nbD = nb_sum
 
-        self.ol.bmx, self.ol.ALPHA, self.ol.S, self.ol.h = self._fwd_init_priors(self.ol.nbD, priors,
-                                                                                 start_priors=start_priors)
+        priors = np.asarray(priors, dtype=float).reshape(-1)
 
-        # for i in range(1, n_step):
-        # 	bmx, ALPHA, S, h[:, [i]] = self._fwd_step_priors(bmx, ALPHA, S, self.ol.nbD, priors)
-        #
-        # h /= np.sum(h, axis=0)
+        # state of the session, see HSMMFilter for several concurrent sessions
+        self.ol = HSMMFilter(self, nbD, trans=self.Trans_Fw, start_priors=start_priors,
+                             tail_mass=self.dur_tail_mass)
+        self.Pd = self.ol.Pd
 
-        return self.ol.h
+        return colvec(self.ol.step(priors / np.sum(priors))[0])
 
     def online_forward_variable_prob_step(self, priors):
         """
@@ -448,16 +556,11 @@ class HSMM(HMM):
         :param priors: 			[np.array((nb_states,))]
         :return:
         """
+        if self.ol is None:
+            raise ValueError('Online forward variable not initialized, '
+                             'call online_forward_variable_prob first')
 
-        priors = colvec(priors)
-        try:
-            self.ol.bmx, self.ol.ALPHA, self.ol.S, self.ol.h = \
-                self._fwd_step_priors(self.ol.bmx, self.ol.ALPHA, self.ol.S, self.ol.nbD, priors,
-                                      trans_reg=0.00, trans_diag=0.00)
-            return self.ol.h
-        except:
-            # traceback.print_exc(file=sys.stdout)
-            return None
+        return colvec(self.ol.step(np.asarray(priors).reshape(-1))[0])
 
     def online_forward_variable_prob_predict(self, n_step, priors):
         """
@@ -466,31 +569,13 @@ class HSMM(HMM):
         :param priors: 			[np.array((nb_states,))]
         :return:
         """
+        if self.ol is None:
+            raise ValueError('Online forward variable not initialized, '
+                             'call online_forward_variable_prob first')
 
-        h = np.zeros((self.nb_states, n_step))
-
-        priors = colvec(priors)
-        priors /= np.sum(priors)
-
-        # bmx, ALPHA, S, h[:, [0]] = self._fwd_init_priors(nbD, priors, start_priors=start_priors)
-        h[:, [0]] = self.ol.h
-        bmx = self.ol.bmx
-        ALPHA = self.ol.ALPHA
-        S = self.ol.S
-
-        try:
-            for i in range(1, n_step):
-                bmx, ALPHA, S, h[:, [i]] = self._fwd_step_priors(
-                    bmx, ALPHA, S, self.ol.nbD, priors)
-
-        except:
-            h = np.tile(self.ol.h, (1, n_step))
+        priors = np.asarray(priors, dtype=float).reshape(-1)
 
-            # traceback.print_exc(file=sys.stdout)
-
-        h /= np.sum(h, axis=0)
-
-        return h
+        return self.ol.predict(n_step, priors / np.sum(priors))[0]
 
     def forward_variable_hsum(self, n_step, Data, tp_param=None):
         """
@@ -510,15 +595,10 @@ class HSMM(HMM):
             self._update_transition_matrix(tp_param)
 
         # nbD = np.round(2 * n_step/self.nb_states)
-        nbD = np.round(4 * n_step)
-
-        self.Pd = np.zeros((self.nb_states, nbD))
+        nbD = int(np.round(4 * n_step))
 
         # Precomputation of duration probabilities
-        for i in range(self.nb_states):
-            self.Pd[i, :] = multi_variate_normal(
-                np.arange(nbD), self.Mu_Pd[i], self.Sigma_Pd[i])
-            self.Pd[i, :] = self.Pd[i, :] / np.sum(self.Pd[i, :])
+        self.Pd = self.get_duration_table(nbD, log=True)
 
         if np.isnan(self.Pd).any():
             print("Problem of duration probabilities")
@@ -526,10 +606,9 @@ class HSMM(HMM):
 
         h = np.zeros((self.nb_states, n_step))
 
-        bmx, ALPHA, S, h[:, [0]] = self._fwd_init_hsum(nbD, Data[:, 1])
+        fw, h[:, [0]] = self._fwd_init_hsum(nbD, Data[:, 1])
         for i in range(1, n_step):
-            bmx, ALPHA, S, h[:, [i]] = self._fwd_step_hsum(
-                bmx, ALPHA, S, nbD, Data[:, i])
+            h[:, [i]] = self._fwd_step_hsum(fw, Data[:, i])
 
         h /= np.sum(h, axis=0)
 
@@ -539,58 +618,46 @@ class HSMM(HMM):
         """
 
         :param nbD:
-        :return:
+        :param priors: 	np.array([nb_states, 1])
+        :return: 		[OnlineForwardVariable], np.array([nb_states, 1])
         """
-        bmx = np.zeros((self.nb_states, 1))
+        Btmp = priors[:, 0]
 
-        Btmp = priors
+        fw = OnlineForwardVariable()
+        fw.init(self.Pd[:, :nbD], self.init_priors if start_priors is None else
+                np.asarray(start_priors).reshape(-1))
 
-        if start_priors is None:
-            ALPHA = np.tile(colvec(self.init_priors), [1, nbD]) * self.Pd
-        else:
-            ALPHA = np.tile(colvec(start_priors), [1, nbD]) * self.Pd
-        # r = Btmp.T * np.sum(ALPHA, axis=1)
-        r = np.dot(Btmp.T, np.sum(ALPHA, axis=1))
+        sum_alpha = fw.sum()
+        r = np.dot(Btmp.T, sum_alpha)
 
-        bmx[:, [0]] = Btmp / r
-        E = bmx * ALPHA[:, [0]]
-        S = np.dot(self.Trans_Fw.T, E)  # use [idx] to keep the dimension
+        fw.bmx = Btmp / r
+        fw.S = np.dot(self.Trans_Fw.T, fw.bmx * fw.alpha_0)
 
-        return bmx, ALPHA, S, Btmp * colvec(np.sum(ALPHA, axis=1))
+        return fw, colvec(Btmp * sum_alpha)
 
-    def _fwd_step_priors(self, bmx, ALPHA, S, nbD, priors, trans_reg=0.0, trans_diag=0.0):
+    def _fwd_step_priors(self, fw, priors, trans_reg=0.0, trans_diag=0.0):
         """
+        Step of forward variable computation, fw is updated in place
 
-        :param bmx:
-        :param ALPHA:
-        :param S:
-        :param nbD:
-        :return:
+        :param fw: 		[OnlineForwardVariable]
+        :param priors: 	np.array([nb_states, 1])
+        :return: 		np.array([nb_states, 1])
         """
+        Btmp = priors[:, 0]
 
-        Btmp = priors
-
-        ALPHA = np.concatenate((S[:, [-1]] * self.Pd[:, 0:nbD-1] + bmx[:, [-1]] * ALPHA[:, 1:nbD],
-                                S[:, [-1]] * self.Pd[:, [nbD-1]]), axis=1)
+        fw.shift(fw.S, fw.bmx)
+        sum_alpha = fw.sum()
 
-        r = np.dot(Btmp.T, np.sum(ALPHA, axis=1))
-        bmx = np.concatenate((bmx, Btmp / r), axis=1)
-        E = bmx[:, [-1]] * ALPHA[:, [0]]
+        r = np.dot(Btmp.T, sum_alpha)
+        fw.bmx = Btmp / r
 
-        S = np.concatenate((S, np.dot(self.Trans_Fw.T + np.eye(self.nb_states)
-                                      * trans_diag + trans_reg, ALPHA[:, [0]])), axis=1)
-        alpha = Btmp * colvec(np.sum(ALPHA, axis=1))
+        fw.S = np.dot(self.Trans_Fw.T + np.eye(self.nb_states) * trans_diag + trans_reg,
+                      fw.alpha_0)
+        alpha = colvec(Btmp * sum_alpha)
         alpha /= np.sum(alpha)
-        return bmx, ALPHA, S, alpha
-
-    def _fwd_init_hsum(self, nbD, Data):
-        """
-
-        :param nbD:
-        :return:
-        """
-        bmx = np.zeros((self.nb_states, 1))
+        return alpha
 
+    def _obs_hsum(self, Data):
         Btmp = np.zeros((self.nb_states, 1))
 
         for i in range(self.nb_states):
@@ -598,43 +665,20 @@ class HSMM(HMM):
                 Data.reshape(-1, 1), self.Mu[:, i], self.Sigma[:, :, i]) + 1e-12
 
         Btmp /= np.sum(Btmp)
+        return Btmp
 
-        ALPHA = np.tile(colvec(self.init_priors), [1, nbD]) * self.Pd
-        # r = Btmp.T * np.sum(ALPHA, axis=1)
-        r = np.dot(Btmp.T, np.sum(ALPHA, axis=1))
-
-        bmx[:, [0]] = Btmp / r
-        E = bmx * ALPHA[:, [0]]
-        S = np.dot(self.Trans_Fw.T, E)  # use [idx] to keep the dimension
-
-        return bmx, ALPHA, S, Btmp * colvec(np.sum(ALPHA, axis=1))
-
-    def _fwd_step_hsum(self, bmx, ALPHA, S, nbD, Data):
+    def _fwd_init_hsum(self, nbD, Data):
         """
 
-        :param bmx:
-        :param ALPHA:
-        :param S:
         :param nbD:
         :return:
         """
+        return self._fwd_init_priors(nbD, self._obs_hsum(Data))
 
-        Btmp = np.zeros((self.nb_states, 1))
-
-        for i in range(self.nb_states):
-            Btmp[i] = multi_variate_normal(
-                Data.reshape(-1, 1), self.Mu[:, i], self.Sigma[:, :, i]) + 1e-12
-
-        Btmp /= np.sum(Btmp)
-
-        ALPHA = np.concatenate((S[:, [-1]] * self.Pd[:, 0:nbD-1] + bmx[:, [-1]] * ALPHA[:, 1:nbD],
-                                S[:, [-1]] * self.Pd[:, [nbD-1]]), axis=1)
-
-        r = np.dot(Btmp.T, np.sum(ALPHA, axis=1))
-        bmx = np.concatenate((bmx, Btmp / r), axis=1)
-        E = bmx[:, [-1]] * ALPHA[:, [0]]
+    def _fwd_step_hsum(self, fw, Data):
+        """
 
-        S = np.concatenate((S, np.dot(self.Trans_Fw.T, ALPHA[:, [0]])), axis=1)
-        alpha = Btmp * colvec(np.sum(ALPHA, axis=1))
-        alpha /= np.sum(alpha)
-        return bmx, ALPHA, S, alpha
+        :param fw: 		[OnlineForwardVariable]
+        :return:
+        """
+        return self._fwd_step_priors(fw, self._obs_hsum(Data))
@@ -0,0 +1,167 @@
+import numpy as np
+
+
+def sq_distances(x, centers):
+    """
+    Squared distances between samples and centers, expanded as |x|^2 - 2 x.c + |c|^2 to
+    use a matrix product. Samples and centers are first centered on the mean of the
+    samples, such that precision is not lost when the data are far from the origin.
+
+    :param x: 			np.array([nb_samples, nb_dim])
+    :param centers: 	np.array([nb_clusters, nb_dim])
+    :return: 			np.array([nb_samples, nb_clusters])
+    """
+    m = np.mean(x, axis=0)
+    x, centers = x - m, centers - m
+
+    d = np.sum(x ** 2, axis=1)[:, None] - 2. * x.dot(centers.T) + \
+        np.sum(centers ** 2, axis=1)[None]
+
+    return np.maximum(d, 0.)
+
+
+def assign_clusters(data, centers, chunk_size=4096):
+    """
+    Assign each sample to its closest center. Distances are computed by chunks of samples
+    such that memory does not depend on the number of samples.
+
+    :param data: 		np.array([nb_samples, nb_dim])
+    :param centers: 	np.array([nb_clusters, nb_dim])
+    :param chunk_size: 	[int]
+            Number of samples for which distances are computed at once
+    :return: 			np.array([nb_samples]), np.array([nb_samples])
+            index of closest center and squared distance to it
+    """
+    labels = np.zeros(data.shape[0], dtype=int)
+    sq_dist = np.zeros(data.shape[0])
+
+    for i in range(0, data.shape[0], chunk_size):
+        d = sq_distances(data[i:i + chunk_size], centers)
+
+        labels[i:i + chunk_size] = np.argmin(d, axis=1)
+        sq_dist[i:i + chunk_size] = d[np.arange(d.shape[0]), labels[i:i + chunk_size]]
+
+    return labels, sq_dist
+
+
+def kmeans_plusplus(data, nb_clusters, rng=None, nb_trials=None, chunk_size=4096):
+    """
+    k-means++ seeding, with greedy selection among several candidates at each step.
+
+    :param data: 		np.array([nb_samples, nb_dim])
+    :param nb_clusters: [int]
+    :param rng: 		[np.random.Generator] or None
+    :param nb_trials: 	[int] or None
+            Number of candidates evaluated for each new center, default 2 + log(nb_clusters)
+    :param chunk_size: 	[int]
+    :return: 			np.array([nb_clusters, nb_dim])
+    """
+    rng = np.random if rng is None else rng
+
+    if nb_trials is None:
+        nb_trials = 2 + int(np.log(nb_clusters))
+
+    centers = np.zeros((nb_clusters, data.shape[1]))
+    centers[0] = data[rng.randint(data.shape[0]) if rng is np.random
+                      else rng.integers(data.shape[0])]
+
+    _, min_dist = assign_clusters(data, centers[:1], chunk_size)
+
+    for k in range(1, nb_clusters):
+        # sample candidates proportionally to squared distance to closest center
+        p = min_dist / np.sum(min_dist) if np.sum(min_dist) > 0. else None
+        candidates = rng.choice(data.shape[0], size=nb_trials, p=p)
+
+        # keep the candidate that reduces the most the potential, distances to all
+        # candidates [nb_trials, nb_samples] computed at once
+        dists = np.empty((nb_trials, data.shape[0]))
+        for i in range(0, data.shape[0], chunk_size):
+            np.minimum(min_dist[None, i:i + chunk_size],
+                       sq_distances(data[i:i + chunk_size], data[candidates]).T,
+                       out=dists[:, i:i + chunk_size])
+
+        best = np.argmin(np.sum(dists, axis=1))
+
+        centers[k] = data[candidates[best]]
+        min_dist = dists[best]
+
+    return centers
+
+
+def kmeans(data, nb_clusters, maxiter=100, tol=1e-4, batch_size=None, rng=None,
+           chunk_size=4096):
+    """
+    k-means clustering initialized with k-means++. If batch_size is given, centers are
+    updated from random mini-batches (mini-batch k-means) instead of the full dataset.
+
+    :param data: 		np.array([nb_samples, nb_dim])
+    :param nb_clusters: [int]
+    :param maxiter: 	[int]
+    :param tol: 		[float]
+            Stop when the centers move less than tol, relative to data variance
+    :param batch_size: 	[int] or None
+            Size of mini-batches, full batch k-means if None
+    :param rng: 		[np.random.Generator] or None
+    :param chunk_size: 	[int]
+            Number of samples for which distances are computed at once
+    :return: 			np.array([nb_clusters, nb_dim]), np.array([nb_samples])
+            centers and labels of the samples
+    """
+    rng = np.random if rng is None else rng
+
+    init_data = data
+    if batch_size is not None and data.shape[0] > 10 * batch_size:
+        # seed on a subsample
+        init_data = data[rng.choice(data.shape[0], size=10 * batch_size, replace=False)]
+
+    centers = kmeans_plusplus(init_data, nb_clusters, rng=rng, chunk_size=chunk_size)
+    tol = tol * np.mean(np.var(data, axis=0))
+
+    if batch_size is None:
+        for it in range(maxiter):
+            labels, sq_dist = assign_clusters(data, centers, chunk_size)
+
+            counts = np.bincount(labels, minlength=nb_clusters)
+            sums = np.array([np.bincount(labels, weights=data[:, d], minlength=nb_clusters)
+                             for d in range(data.shape[1])]).T
+
+            new_centers = sums / np.maximum(counts, 1)[:, None]
+
+            # relocate empty clusters on the samples with largest distances
+            empty = np.nonzero(counts == 0)[0]
+            if empty.shape[0]:
+                new_centers[empty] = data[np.argsort(sq_dist)[::-1][:empty.shape[0]]]
+
+            shift = np.sum((new_centers - centers) ** 2)
+            centers = new_centers
+
+            if shift <= tol:
+                break
+    else:
+        counts = np.zeros(nb_clusters)
+
+        for it in range(maxiter):
+            batch = data[rng.choice(data.shape[0], size=min(batch_size, data.shape[0]),
+                                    replace=False)]
+            labels, _ = assign_clusters(batch, centers, chunk_size)
+
+            # per-center learning rate 1 / count
+            batch_counts = np.bincount(labels, minlength=nb_clusters)
+            batch_sums = np.array([np.bincount(labels, weights=batch[:, d], minlength=nb_clusters)
+                                   for d in range(data.shape[1])]).T
+
+            counts += batch_counts
+            lr = batch_counts / np.maximum(counts, 1)
+
+            new_centers = centers + lr[:, None] * (
+                batch_sums / np.maximum(batch_counts, 1)[:, None] - centers)
+
+            shift = np.sum((new_centers - centers) ** 2)
+            centers = new_centers
+
+            if shift <= tol:
+                break
+
+    labels, _ = assign_clusters(data, centers, chunk_size)
+
+    return centers, labels
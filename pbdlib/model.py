@@ -1,9 +1,112 @@
 import numpy as np
+from scipy.special import logsumexp
 from .functions import *
 from .utils import gaussian_moment_matching
 from .plot import plot_gmm
 
 
+class BlockStructure(object):
+    """
+    Block-diagonal structure of covariance matrices, compiled once from a list of
+    dependencies. Blocks of the same size are grouped such that likelihoods, covariance
+    updates and factorizations run in batch over all states and blocks of a group.
+    """
+
+    def __init__(self, dep, nb_dim):
+        """
+
+        :param dep:		[A x [B x [int]]] A list of list of dimensions or slices
+                Each list of dimensions indicates a dependence of variables in the covariance
+                matrix. Dimensions should not overlap.
+        :param nb_dim: 	[int]
+        """
+        self.nb_dim = nb_dim
+        self.blocks = [np.arange(nb_dim)[d] for d in dep]
+
+        sizes = sorted(set([b.shape[0] for b in self.blocks]))
+
+        # indices of blocks of same size [nb_blocks, block_size]
+        self.groups = [np.array([b for b in self.blocks if b.shape[0] == size])
+                       for size in sizes]
+
+        # dimensions not in any block, only their variance is kept
+        self.free = np.setdiff1d(np.arange(nb_dim), np.concatenate(self.blocks))
+
+        self.mask = np.eye(nb_dim)
+        for b in self.blocks:
+            self.mask[np.ix_(b, b)] = 1.
+
+    @staticmethod
+    def key(dep, nb_dim):
+        return (nb_dim, ) + tuple(tuple(np.arange(nb_dim)[d].tolist()) for d in dep)
+
+    def gather(self, sigma):
+        """
+        Get the blocks of covariance matrices
+
+        :param sigma: 	np.array([nb_states, nb_dim, nb_dim])
+        :return: 		[list of np.array([nb_states, nb_blocks, block_size, block_size])]
+        """
+        return [sigma[:, idx[:, :, None], idx[:, None, :]] for idx in self.groups]
+
+    def scatter(self, blocks, free_var=None):
+        """
+        Build block-diagonal covariance matrices
+
+        :param blocks: 		[list of np.array([nb_states, nb_blocks, block_size, block_size])]
+        :param free_var: 	np.array([nb_states, nb_free]) variances of dimensions not in blocks
+        :return: 			np.array([nb_states, nb_dim, nb_dim])
+        """
+        nb_states = blocks[0].shape[0]
+        sigma = np.zeros((nb_states, self.nb_dim, self.nb_dim))
+
+        for idx, block in zip(self.groups, blocks):
+            sigma[:, idx[:, :, None], idx[:, None, :]] = block
+
+        if free_var is not None and self.free.shape[0]:
+            sigma[:, self.free, self.free] = free_var
+
+        return sigma
+
+    def cholesky(self, sigma):
+        """
+        Cholesky decompositions of the blocks of covariance matrices
+
+        :param sigma: 	np.array([nb_states, nb_dim, nb_dim])
+        :return: 		[list of np.array([nb_states, nb_blocks, block_size, block_size])]
+        """
+        return [np.linalg.cholesky(block) for block in self.gather(sigma)]
+
+    def log_prob(self, x, mu, sigma_chol, chol_inv=None):
+        """
+        Log-likelihood of samples for all states, summed over the blocks
+
+        :param x: 			np.array([nb_samples, nb_dim])
+        :param mu: 			np.array([nb_states, nb_dim])
+        :param sigma_chol: 	[list of np.array([nb_states, nb_blocks, block_size, block_size])]
+                As given by cholesky
+        :param chol_inv: 	[list of np.array([nb_states, nb_blocks, block_size, block_size])]
+                Inverses of sigma_chol, computed by triangular solves if None
+        :return: 			np.array([nb_states, nb_samples])
+        """
+        x = x[:, None] if x.ndim == 1 else x
+        log_lik = np.zeros((mu.shape[0], x.shape[0]))
+
+        if chol_inv is None:
+            chol_inv = [triangular_inv(chol) for chol in sigma_chol]
+
+        for idx, chol, L_inv in zip(self.groups, sigma_chol, chol_inv):
+            # [nb_states, nb_blocks, nb_samples, block_size]
+            dx = np.swapaxes(x[:, idx], 0, 1)[None] - mu[:, idx][:, :, None]
+            z = np.einsum('abij,abcj->abci', L_inv, dx)
+
+            log_lik -= 0.5 * np.einsum('abci,abci->ac', z, z) + \
+                0.5 * idx.size * np.log(2 * np.pi) + \
+                np.sum(np.log(np.diagonal(chol, axis1=2, axis2=3)), axis=(1, 2))[:, None]
+
+        return log_lik
+
+
 class Model(object):
     """
     Basis class for Gaussian mixture model (GMM), Hidden Markov Model (HMM), Hidden semi-Markov
@@ -21,6 +124,11 @@ class Model(object):
         self._lmbda = None  # Precision matrix
         self._eta = None
 
+        # covariance type in ['full', 'diag', 'spherical']
+        self._cov_type = 'full'
+        # variances if cov_type is 'diag' [nb_states, nb_dim] or 'spherical' [nb_states, 1]
+        self._sigma_diag = None
+
         self._reg = None
         self.nb_dim = nb_dim
 
@@ -29,6 +137,10 @@ class Model(object):
 
         self._log_normalization = None
 
+        self._block_structure = None  # last compiled dependency structure
+        # cholesky decompositions and their inverses, by marginal and dependency structure
+        self._factors = {}
+
     @property
     def has_finish_state(self):
         return self._has_finish_state
@@ -121,6 +233,51 @@ class Model(object):
 
         return self._eta
 
+    @property
+    def cov_type(self):
+        """
+        Type of covariance matrices, in ['full', 'diag', 'spherical']. For 'diag' and
+        'spherical', only variances are stored (sigma_diag) and full matrices are computed
+        only when sigma, lmbda or sigma_chol are asked.
+
+        :return: [str]
+        """
+        return self._cov_type
+
+    @property
+    def sigma_diag(self):
+        """
+        Variances of MVNs distributions
+
+        :return: [np.array([nb_states, nb_dim])]
+        """
+        if self._sigma_diag is not None:
+            return np.broadcast_to(self._sigma_diag, (self.nb_states, self.nb_dim))
+        elif self.sigma is not None:
+            return np.diagonal(self.sigma, axis1=1, axis2=2)
+        return None
+
+    @sigma_diag.setter
+    def sigma_diag(self, value):
+        """
+
+        :param value: 	[np.array([nb_states, nb_dim])] for diagonal covariances
+                        or [np.array([nb_states])] for spherical covariances
+        """
+        self._eta = None
+        self._lmbda = None
+        self._sigma_chol = None
+        self._factors = {}
+        self._sigma = None
+        self._log_normalization = None
+
+        if value.ndim == 1:
+            self._cov_type = 'spherical'
+            self._sigma_diag = value[:, None]
+        else:
+            self._cov_type = 'diag'
+            self._sigma_diag = value
+
     @property
     def sigma_chol(self):
         """
@@ -128,12 +285,14 @@ class Model(object):
 
         :return: [np.array([nb_states, nb_dim, nb_dim])]
         """
-        if self.sigma is None:
-            return None
-        else:
-            if self._sigma_chol is None:
+        if self._sigma_chol is None:
+            if self._sigma_diag is not None:
+                self._sigma_chol = np.einsum('ai,ij->aij', np.sqrt(self.sigma_diag),
+                                             np.eye(self.nb_dim))
+            elif self.sigma is not None:
                 self._sigma_chol = np.linalg.cholesky(self.sigma)
-            return self._sigma_chol
+
+        return self._sigma_chol
 
     @property
     def sigma(self):
@@ -142,6 +301,8 @@ class Model(object):
 
         :return: [np.array([nb_states, nb_dim, nb_dim])]
         """
+        if self._sigma is None and self._sigma_diag is not None:
+            self._sigma = np.einsum('ai,ij->aij', self.sigma_diag, np.eye(self.nb_dim))
         if self._sigma is None and not self._lmbda is None:
             self._sigma = np.linalg.inv(self._lmbda)
         return self._sigma
@@ -151,8 +312,11 @@ class Model(object):
         self._eta = None
         self._lmbda = None
         self._sigma_chol = None
+        self._factors = {}
         self._sigma = value
         self._log_normalization = None
+        self._cov_type = 'full'
+        self._sigma_diag = None
 
     @property
     def lmbda(self):
@@ -161,6 +325,8 @@ class Model(object):
 
         :return: [np.array([nb_states, nb_dim, nb_dim])]
         """
+        if self._lmbda is None and self._sigma_diag is not None:
+            self._lmbda = np.einsum('ai,ij->aij', 1. / self.sigma_diag, np.eye(self.nb_dim))
         if self._lmbda is None and not self._sigma is None:
             self._lmbda = np.linalg.inv(self._sigma)
         return self._lmbda
@@ -170,20 +336,34 @@ class Model(object):
         self._eta = None
         self._sigma = None  # reset sigma
         self._sigma_chol = None
+        self._factors = {}
         self._lmbda = value
         self._log_normalization = None
+        self._cov_type = 'full'
+        self._sigma_diag = None
 
-    def get_dep_mask(self, deps):
-        mask = np.eye(self.nb_dim)
+    def get_block_structure(self, dep, nb_dim=None):
+        """
+        Compile a list of dependencies into a block structure, the last one is cached.
 
-        for dep in deps:
-            if isinstance(dep, slice):
-                mask[dep, dep] = 1.
-            elif isinstance(dep, list):
-                dGrid = np.ix_(dep, dep)
-                mask[dGrid] = 1.
+        :param dep:		[A x [B x [int]]] A list of list of dimensions or slices
+                or already compiled BlockStructure
+        :param nb_dim: 	[int] number of dimensions, default is nb_dim of the model
+        :return: 		[BlockStructure]
+        """
+        if isinstance(dep, BlockStructure):
+            return dep
+
+        nb_dim = self.nb_dim if nb_dim is None else nb_dim
+        key = BlockStructure.key(dep, nb_dim)
 
-        return mask
+        if self._block_structure is None or self._block_structure[0] != key:
+            self._block_structure = (key, BlockStructure(dep, nb_dim))
+
+        return self._block_structure[1]
+
+    def get_dep_mask(self, deps):
+        return self.get_block_structure(deps).mask
 
     def dep_mask(self, deps):
         """
@@ -194,13 +374,39 @@ class Model(object):
         :return:
         """
 
+        if self.cov_type != 'full':
+            return
+
         mask = self.get_dep_mask(deps)
 
-        self.sigma *= mask
+        # use setter to reset parameters
+        self.sigma = self.sigma * mask
 
-        # reset parameters
-        self._lmbda = None
-        self._sigma_chol = None
+    def get_em_params(self):
+        """
+        Copy of the parameters estimated by EM
+
+        :return: 	[dict of np.array]
+        """
+        params = {'priors': self.priors, 'mu': self.mu}
+
+        if self.cov_type == 'full':
+            params['sigma'] = self.sigma
+        elif self.cov_type == 'diag':
+            params['sigma_diag'] = self._sigma_diag
+        else:
+            params['sigma_diag'] = self._sigma_diag[:, 0]
+
+        return {k: np.array(v, dtype=float) for k, v in params.items()}
+
+    def set_em_params(self, params):
+        """
+        Set parameters as given by get_em_params, through their setters to reset caches
+
+        :param params: 	[dict of np.array]
+        """
+        for k, v in params.items():
+            setattr(self, k, v.copy())
 
     def keeponlydims(self, sl):
         """
@@ -209,19 +415,82 @@ class Model(object):
                 Slice of the dimensions to keep
         :return:
         """
+        if self.cov_type == 'diag':
+            self.sigma_diag = self._sigma_diag[:, sl]
+        elif self.cov_type == 'spherical':
+            self.sigma_diag = self._sigma_diag[:, 0]
+        else:
+            self.sigma = self.sigma[:, sl, sl]
+
         self.mu = self.mu[:, sl]
-        self.sigma = self.sigma[:, sl, sl]
 
     def init_zeros(self):
         """
         Init all parameters
         :return:
         """
-        self._priors = np.ones(self.nb_states)/self.nb_states
-        self._mu = np.array([np.zeros(self.nb_dim)
-                             for i in range(self.nb_states)])
-        self._sigma = np.array([np.eye(self.nb_dim)
-                                for i in range(self.nb_states)])
+        self.priors = np.ones(self.nb_states)/self.nb_states
+        self.mu = np.array([np.zeros(self.nb_dim)
+                            for i in range(self.nb_states)])
+        self.sigma = np.array([np.eye(self.nb_dim)
+                               for i in range(self.nb_states)])
+
+    def mvn_log_prob(self, x, marginal=None, dep=None):
+        """
+        Log-likelihood of samples for all the states, evaluated in a single pass
+
+        :param x: 			np.array([nb_samples, nb_dim])
+        :param marginal: 	[slice] or [list of index]
+                If not None, use the marginal distribution of these dimensions
+        :param dep: 		[A x [B x [int]]] A list of list of dimensions or slices
+                Each list of dimensions indicates a dependence of variables in the covariance matrix
+        :return: 			np.array([nb_states, nb_samples])
+        """
+        if self.cov_type != 'full':
+            # dependencies are irrelevant for diagonal covariances
+            if marginal is None:
+                return multi_variate_normal_diag(x, self.mu, self._sigma_diag)
+            else:
+                return multi_variate_normal_diag(
+                    x, self.mu[:, marginal], self.sigma_diag[:, marginal])
+
+        mu = self.mu if marginal is None else self.mu[:, marginal]
+        blocks = None if dep is None else self.get_block_structure(dep, nb_dim=mu.shape[1])
+
+        chol, chol_inv = self.get_factors(marginal, blocks)
+
+        if blocks is None:
+            return multi_variate_normal_batch(x, mu, chol, chol_inv=chol_inv)
+
+        # block diagonal computation
+        return blocks.log_prob(x, mu, chol, chol_inv)
+
+    def get_factors(self, marginal=None, blocks=None):
+        """
+        Cholesky decompositions of the (marginal) covariance matrices and their inverses,
+        kept for each marginal and block structure until the covariances are set.
+
+        :param marginal: 	[slice] or [list of index] or None
+        :param blocks: 		[BlockStructure] or None
+        :return: 			np.array([nb_states, nb_dim, nb_dim]) x 2 or, with blocks,
+                [list of np.array([nb_states, nb_blocks, block_size, block_size])] x 2
+        """
+        key = (None if marginal is None else tuple(np.arange(self.nb_dim)[marginal].tolist()),
+               None if blocks is None else BlockStructure.key(blocks.blocks, blocks.nb_dim))
+
+        if key not in self._factors:
+            if marginal is None and blocks is None:
+                chol = self.sigma_chol
+            else:
+                sigma = self.sigma if marginal is None else self.get_marginal(marginal)[1]
+                chol = np.linalg.cholesky(sigma) if blocks is None else blocks.cholesky(sigma)
+
+            chol_inv = triangular_inv(chol) if blocks is None else \
+                [triangular_inv(c) for c in chol]
+
+            self._factors[key] = (chol, chol_inv)
+
+        return self._factors[key]
 
     def plot(self, *args, **kwargs):
         """
@@ -276,42 +545,18 @@ class Model(object):
         :param h:
         :return:
         """
-        sample_size = data_in.shape[0]
-
         # compute responsabilities
-        mu_in, sigma_in = self.get_marginal(dim_in)
-
         if h is None:
-            h = np.zeros((self.nb_states, sample_size))
-            for i in range(self.nb_states):
-                h[i, :] = multi_variate_normal(data_in,
-                                               mu_in[i],
-                                               sigma_in[i])
-
-            h += np.log(self.priors)[:, None]
-            h = np.exp(h).T
-            h /= np.sum(h, axis=1, keepdims=True)
-            h = h.T
+            h = self.mvn_log_prob(data_in, marginal=dim_in) + \
+                np.log(self.priors)[:, None]
+            h = np.exp(h - logsumexp(h, axis=0, keepdims=True))
 
         self._h = h
-        mu_out, sigma_out = self.get_marginal(dim_out)
-        mu_est, sigma_est = ([], [])
-
-        inv_sigma_in_in, inv_sigma_out_in = ([], [])
-
-        _, sigma_in_out = self.get_marginal(dim_in, dim_out)
-
-        for i in range(self.nb_states):
-            inv_sigma_in_in += [np.linalg.inv(sigma_in[i])]
-            inv_sigma_out_in += [sigma_in_out[i].T.dot(inv_sigma_in_in[-1])]
-
-            mu_est += [mu_out[i] + np.einsum('ij,aj->ai',
-                                             inv_sigma_out_in[-1], data_in - mu_in[i])]
 
-            sigma_est += [sigma_out[i] -
-                          inv_sigma_out_in[-1].dot(sigma_in_out[i])]
+        # conditional distribution of each state, p(x_out|x_in, k) = N(A x_in + b, sigma)
+        As, bs, sigma_est = self.get_linear_conditional(dim_in, dim_out)
 
-        mu_est, sigma_est = (np.asarray(mu_est), np.asarray(sigma_est))
+        mu_est = np.einsum('aij,cj->aci', As, data_in) + bs[:, None]
 
         if return_gmm:
             return h, mu_est, sigma_est
@@ -558,7 +558,22 @@ class VBayesianHMM(VBayesianGMM, HMM):
     def __init__(self, *args, **kwargs):
         VBayesianGMM.__init__(self, *args, **kwargs)
         self._trans = None
+        self._trans_band = None
         self._init_priors = None
+        self._trans_offsets = None
+        self._online_filter = None
+        self._online_stream = None
+        self._update_stats = None
+        self._update_filter = None
+        self._update_count = 0
+        self._velocity_cond = None
+        self.qs = None
+        self.hs = None
+        self._hs = None
+        self._demo_stats = {}
+        self._demo_stats_params = None
+        self._em_dep = None
+        self._em_dep_mask = None
 
     def obs_likelihood(self, demo=None, dep=None, marginal=None, *args, **kwargs):
         return VBayesianGMM.obs_likelihood(self, demo=demo, dep=dep, marginal=marginal)
@@ -0,0 +1,578 @@
+import numpy as np
+
+from .functions import triangular_inv
+
+
+def logsumexp(a):
+    """
+    log(sum(exp(a))) over the last axis, keeping dimensions. Same as scipy.special.logsumexp
+    without its overhead, which dominates for the small arrays of one online step.
+
+    :param a: 	np.array([..., n])
+    :return: 	np.array([..., 1])
+    """
+    m = np.max(a, axis=-1, keepdims=True)
+    m = np.where(np.isfinite(m), m, 0.)
+
+    with np.errstate(divide='ignore'):
+        return np.log(np.sum(np.exp(a - m), axis=-1, keepdims=True)) + m
+
+
+def shift_durations(buf, head, S, bmx, Pd2):
+    """
+    Shift of HSMM forward variables over remaining durations, stored as circular buffers
+    ALPHA[:, d] = buf[:, (head + d) % nbD] for each stream:
+        ALPHA[:, d] <- S * Pd[:, d] + bmx * ALPHA[:, d + 1], in place
+
+    :param buf: 	np.array([nb, nb_states, nbD])
+    :param head: 	np.array([nb], dtype=int)
+    :param S: 		np.array([nb, nb_states])
+    :param bmx: 	np.array([nb, nb_states]) or None for ones
+    :param Pd2: 	np.array([nb_states, 2 * nbD])
+            duration probabilities Pd, twice along durations
+    """
+    nbD = Pd2.shape[1] // 2
+
+    # Pd[:, d] at the position of duration d, Pd2[:, nbD - head + p] at position p
+    if buf.shape[0] == 1:
+        # one stream, Pd is a slice of Pd2
+        b, h = buf[0], head[0]
+        if bmx is not None:
+            b *= bmx[0][:, None]
+        b[:, h] = 0.
+        h = head[0] = (h + 1) % nbD
+        b += S[0][:, None] * Pd2[:, nbD - h:2 * nbD - h]
+    else:
+        if bmx is not None:
+            buf *= bmx[:, :, None]
+        buf[np.arange(buf.shape[0]), :, head] = 0.
+        head += 1
+        head %= nbD
+
+        cols = nbD + np.arange(nbD)[None] - head[:, None]
+        buf += S[:, :, None] * np.swapaxes(Pd2[:, cols], 0, 1)
+
+
+def durations_alpha_0(buf, head):
+    """
+    ALPHA[:, 0] of each stream, probabilities of leaving each state, see shift_durations
+
+    :param buf: 	np.array([nb, nb_states, nbD])
+    :param head: 	np.array([nb], dtype=int)
+    :return: 		np.array([nb, nb_states])
+    """
+    if buf.shape[0] == 1:
+        return buf[:, :, head[0]]
+
+    return buf[np.arange(buf.shape[0]), :, head]
+
+
+class HMMFilter(object):
+    """
+    Online forward filtering of many concurrent streams of observations (e.g. robots or
+    sessions) with the same HMM. The filter runs in log domain and holds the state of all
+    streams as a [nb_streams, nb_states] array, updated in one vectorized step per tick.
+
+    The parameters of the model are read when the filter is created or refreshed.
+    """
+
+    def __init__(self, model, nb_streams=1, marginal=None, log_likelihood=None):
+        """
+
+        :param model: 			[HMM]
+        :param nb_streams: 		[int]
+        :param marginal: 		[slice(dim_start, dim_end)] or [list of int] or None
+                If not None, observations only contain these dimensions
+        :param log_likelihood: 	[function] or None
+                Log-likelihood of observations np.array([nb, nb_dim]) for each state,
+                returning np.array([nb, nb_states]). If None, use the Gaussian observation
+                model of the HMM, with factorizations computed once.
+        """
+        self.model = model
+        self.nb_streams = nb_streams
+        self.marginal = marginal
+        self.log_likelihood_fn = log_likelihood
+
+        self.refresh()
+
+        # log forward variable of each stream, normalized
+        self.log_alpha = np.zeros((nb_streams, self.nb_states))
+        self.started = np.zeros(nb_streams, dtype=bool)
+
+        # buffers for the update of all streams
+        self._z = np.empty((nb_streams, self.nb_states, self._mu_w.shape[1]))
+        self._log_b = np.empty((nb_streams, self.nb_states))
+
+    @property
+    def nb_states(self):
+        return self.model.nb_states
+
+    def refresh(self):
+        """
+        Recompute the quantities cached from the model, to be called when its parameters
+        changed
+        """
+        model = self.model
+
+        if model.cov_type != 'full':
+            # only variances, O(nb_states * nb_dim) per observation
+            if self.marginal is not None:
+                mu, sigma_diag = model.mu[:, self.marginal], model.sigma_diag[:, self.marginal]
+            else:
+                mu, sigma_diag = model.mu, model.sigma_diag
+
+            self._chol_inv = None
+            self._prec = 1. / (sigma_diag[:, :1] if model.cov_type == 'spherical' else sigma_diag)
+            self._mu_w = mu
+            self._log_norm = -0.5 * mu.shape[1] * np.log(2 * np.pi) - \
+                0.5 * np.sum(np.log(sigma_diag), axis=1)
+        else:
+            if self.marginal is not None:
+                mu, sigma = model.get_marginal(self.marginal)
+            else:
+                mu, sigma = model.mu, model.sigma
+
+            sigma_chol = np.linalg.cholesky(sigma)
+
+            self._chol_inv = triangular_inv(sigma_chol)
+            self._prec = None
+            self._mu_w = np.einsum('aij,aj->ai', self._chol_inv, mu)
+            self._log_norm = -0.5 * mu.shape[1] * np.log(2 * np.pi) - \
+                np.sum(np.log(np.diagonal(sigma_chol, axis1=1, axis2=2)), axis=1)
+
+        self._band = self.model.trans_band
+        self._trans = self.model.Trans
+
+        with np.errstate(divide='ignore'):
+            self._log_init = np.log(self.model.init_priors)
+
+    def reset(self, streams=None):
+        """
+        Restart streams, the next observation is considered as the first one
+
+        :param streams: 	[list of int] or None for all streams
+        """
+        self.started[slice(None) if streams is None else streams] = False
+
+    def add_streams(self, nb):
+        """
+        Add new streams, not started
+
+        :param nb: 	[int]
+        :return: 	[list of int] indices of the new streams
+        """
+        idx = list(range(self.nb_streams, self.nb_streams + nb))
+
+        self.nb_streams += nb
+        self.log_alpha = np.concatenate([self.log_alpha, np.zeros((nb, self.nb_states))])
+        self.started = np.concatenate([self.started, np.zeros(nb, dtype=bool)])
+        self._z = np.empty((self.nb_streams, ) + self._z.shape[1:])
+        self._log_b = np.empty((self.nb_streams, self.nb_states))
+
+        return idx
+
+    def log_likelihood(self, x, out=None):
+        """
+        :param x: 	np.array([nb, nb_dim])
+        :param out: np.array([nb, nb_states]) or None
+        :return: 	np.array([nb, nb_states])
+        """
+        if self.log_likelihood_fn is not None:
+            return self.log_likelihood_fn(x)
+
+        if out is None:
+            out = np.empty((x.shape[0], self.nb_states))
+            z = np.empty((x.shape[0], ) + self._z.shape[1:])
+        else:
+            z = self._z[:x.shape[0]]
+
+        if self._chol_inv is None:
+            # diagonal covariances, differences scaled by precisions
+            np.subtract(x[:, None], self._mu_w[None], out=z)
+            z *= z
+            z *= self._prec[None]
+            np.sum(z, axis=2, out=out)
+        else:
+            np.einsum('aij,sj->sai', self._chol_inv, x, out=z)
+            z -= self._mu_w[None]
+            np.einsum('sai,sai->sa', z, z, out=out)
+        out *= -0.5
+        out += self._log_norm[None]
+
+        return out
+
+    def predict(self, log_alpha):
+        """
+        Log-probabilities of the states at next step, log(alpha.dot(Trans))
+
+        :param log_alpha: 	np.array([nb, nb_states])
+        :return: 			np.array([nb, nb_states])
+        """
+        m = np.max(log_alpha, axis=1, keepdims=True)
+        alpha = np.exp(log_alpha - m)
+
+        alpha = self._band.rdot(alpha) if self._band is not None else alpha.dot(self._trans)
+
+        with np.errstate(divide='ignore'):
+            return np.log(alpha) + m
+
+    def step(self, x, streams=None):
+        """
+        Update streams with one observation each
+
+        :param x: 			np.array([nb_streams, nb_dim]) or np.array([len(streams), nb_dim])
+        :param streams: 	[list of int] or None for all streams
+        :return: 			np.array([nb, nb_states]) probabilities of the states
+        """
+        idx = slice(None) if streams is None else streams
+
+        log_b = self.log_likelihood(x, out=self._log_b[:x.shape[0]])
+        self.last_log_b = log_b
+
+        started = self.started[idx]
+        log_alpha = np.where(started[:, None], self.predict(self.log_alpha[idx]),
+                             self._log_init[None]) + log_b
+
+        log_alpha -= logsumexp(log_alpha)
+
+        self.log_alpha[idx] = log_alpha
+        self.started[idx] = True
+
+        return np.exp(log_alpha)
+
+    @property
+    def alpha(self):
+        """
+        Probabilities of the states of each stream
+
+        :return: np.array([nb_streams, nb_states])
+        """
+        return np.exp(self.log_alpha)
+
+
+class FixedLagSmoother(HMMFilter):
+    """
+    Fixed-lag smoothing of many concurrent streams. The last lag + 1 forward messages and
+    observation likelihoods of each stream are kept in a ring buffer. At each tick, the
+    smoothed probabilities of the states at time t - lag are computed by a backward pass
+    over the buffer only, in O(lag * nb_states^2) (or O(lag * nb_states * nb_bands) for
+    banded transitions).
+    """
+
+    def __init__(self, model, lag, nb_streams=1, marginal=None, log_likelihood=None):
+        """
+
+        :param model: 			[HMM]
+        :param lag: 			[int]
+                Number of future observations used to smooth the state
+        :param nb_streams: 		[int]
+        :param marginal: 		[slice(dim_start, dim_end)] or [list of int] or None
+        :param log_likelihood: 	[function] or None
+        """
+        self.lag = lag
+
+        HMMFilter.__init__(self, model, nb_streams=nb_streams, marginal=marginal,
+                           log_likelihood=log_likelihood)
+
+        self._buf_log_alpha = np.zeros((lag + 1, nb_streams, self.nb_states))
+        self._buf_log_b = np.zeros((lag + 1, nb_streams, self.nb_states))
+        self.count = np.zeros(nb_streams, dtype=int)  # observations since reset
+
+    def reset(self, streams=None):
+        HMMFilter.reset(self, streams)
+        self.count[slice(None) if streams is None else streams] = 0
+
+    def add_streams(self, nb):
+        idx = HMMFilter.add_streams(self, nb)
+
+        self._buf_log_alpha = np.concatenate(
+            [self._buf_log_alpha, np.zeros((self.lag + 1, nb, self.nb_states))], axis=1)
+        self._buf_log_b = np.concatenate(
+            [self._buf_log_b, np.zeros((self.lag + 1, nb, self.nb_states))], axis=1)
+        self.count = np.concatenate([self.count, np.zeros(nb, dtype=int)])
+
+        return idx
+
+    def backward(self, log_v):
+        """
+        log(Trans.dot(exp(log_v)))
+
+        :param log_v: 	np.array([nb, nb_states])
+        :return: 		np.array([nb, nb_states])
+        """
+        m = np.max(log_v, axis=1, keepdims=True)
+        v = np.exp(log_v - m)
+
+        v = self._band.dot(v) if self._band is not None else v.dot(self._trans.T)
+
+        with np.errstate(divide='ignore'):
+            return np.log(v) + m
+
+    def _smooth(self, streams, nb_steps):
+        """
+        Smoothed probabilities of the last nb_steps timesteps of the given streams
+
+        :param streams: 	np.array([nb], dtype=int)
+        :param nb_steps: 	[int] <= lag + 1
+        :return: 			np.array([nb_steps, nb, nb_states]), from oldest to most recent
+        """
+        size = self.lag + 1
+        pos = self.count[streams] - 1  # ring position of the last observation
+
+        log_beta = np.zeros((streams.shape[0], self.nb_states))
+        gamma = np.zeros((nb_steps, streams.shape[0], self.nb_states))
+
+        for k in range(nb_steps):
+            if k > 0:
+                log_beta = self.backward(
+                    self._buf_log_b[(pos - k + 1) % size, streams] + log_beta)
+                log_beta -= np.max(log_beta, axis=1, keepdims=True)
+
+            log_gamma = self._buf_log_alpha[(pos - k) % size, streams] + log_beta
+            gamma[nb_steps - 1 - k] = np.exp(
+                log_gamma - logsumexp(log_gamma))
+
+        return gamma
+
+    def step(self, x, streams=None):
+        """
+        Update streams with one observation each
+
+        :param x: 			np.array([nb_streams, nb_dim]) or np.array([len(streams), nb_dim])
+        :param streams: 	[list of int] or None for all streams
+        :return: 			np.array([nb, nb_states])
+                Smoothed probabilities of the states at time t - lag. Rows of streams with
+                less than lag + 1 observations are nan.
+        """
+        streams = np.arange(self.nb_streams) if streams is None else np.asarray(streams)
+
+        HMMFilter.step(self, x, streams)
+
+        pos = self.count[streams] % (self.lag + 1)
+        self._buf_log_alpha[pos, streams] = self.log_alpha[streams]
+        self._buf_log_b[pos, streams] = self.last_log_b
+        self.count[streams] += 1
+
+        gamma = np.full((streams.shape[0], self.nb_states), np.nan)
+        ready = self.count[streams] > self.lag
+
+        if np.any(ready):
+            gamma[ready] = self._smooth(streams[ready], self.lag + 1)[0]
+
+        return gamma
+
+    def flush(self, stream=0):
+        """
+        Smoothed probabilities of the last timesteps of a stream that were not given yet,
+        e.g. at the end of the stream
+
+        :param stream: 	[int]
+        :return: 		np.array([nb_timestep, nb_states]) with nb_timestep <= lag
+        """
+        nb_steps = min(self.count[stream], self.lag + 1)
+        gamma = self._smooth(np.array([stream]), nb_steps)[:, 0]
+
+        return gamma[1:] if self.count[stream] > self.lag else gamma
+
+
+
+class HSMMFilter(object):
+    """
+    Online forward variable of HSMMs for many concurrent sessions, given at each step
+    probabilities of the states from observations. The state of each session has a fixed
+    size: the forward variable over remaining durations [nb_states, nbD], stored as a
+    circular buffer shifted in place, the last scaled observation probabilities bmx and the
+    probabilities S of entering each state. Memory does not grow with the length of the
+    sessions and the states of all sessions are updated in one vectorized step.
+
+    The parameters of the model are read when the filter is created or refreshed.
+    """
+
+    def __init__(self, model, nbD, nb_streams=1, trans=None, start_priors=None,
+                 tail_mass=None):
+        """
+
+        :param model: 			[HSMM]
+        :param nbD: 			[int]
+                Maximum duration of the states
+        :param nb_streams: 		[int]
+        :param trans: 			np.array([nb_states, nb_states]) or None
+                Transition matrix between states, default is Trans_Pd of the model
+        :param start_priors: 	np.array([nb_states]) or None
+                Probabilities of the states at first step, default is init_priors of the model
+        :param tail_mass: 		[float] or None
+                If not None, durations are truncated to the support of the states, see
+                HSMM.get_duration_table, and nbD is the number of durations kept
+        """
+        self.model = model
+        self.max_nbD = nbD
+        self.tail_mass = tail_mass
+        self.nb_streams = nb_streams
+        self._trans = trans
+        self._start_priors = start_priors
+
+        self.buf = None
+        self.refresh()
+
+        shape = (nb_streams, self.nb_states)
+        self.buf = np.zeros(shape + (self.nbD, ))
+        self.head = np.zeros(nb_streams, dtype=int)  # position of duration 0 in buf
+        self.bmx = np.zeros(shape)
+        self.S = np.zeros(shape)
+        self.h = np.zeros(shape)
+        self.started = np.zeros(nb_streams, dtype=bool)
+
+        self._scratch = None  # buffers of predict
+
+    @property
+    def nb_states(self):
+        return self.model.nb_states
+
+    def refresh(self):
+        """
+        Recompute the quantities read from the model, to be called when its parameters
+        changed
+        """
+        model = self.model
+
+        self.trans = model.Trans_Pd if self._trans is None else self._trans
+        self.start_priors = model.init_priors if self._start_priors is None else \
+            np.asarray(self._start_priors).reshape(-1)
+
+        # duration probabilities, the streams follow changes of their support
+        self.Pd = model.get_duration_table(self.max_nbD, tail_mass=self.tail_mass)
+        if self.buf is not None and self.Pd.shape[1] != self.nbD:
+            self._resize(self.Pd.shape[1])
+        self.nbD = self.Pd.shape[1]
+        self._Pd2 = np.concatenate([self.Pd, self.Pd], axis=1)
+
+    def _resize(self, nbD):
+        """
+        Change the number of durations of the forward variables of the streams, longer
+        durations are dropped or padded with zeros
+
+        :param nbD: 	[int]
+        """
+        cols = (self.head[:, None] + np.arange(self.nbD)[None]) % self.nbD
+        alpha = np.take_along_axis(self.buf, cols[:, None], axis=2)
+
+        self.buf = np.zeros(alpha.shape[:2] + (nbD, ))
+        self.buf[:, :, :min(nbD, self.nbD)] = alpha[:, :, :nbD]
+        self.head[:] = 0
+        self._scratch = None
+
+    def reset(self, streams=None):
+        """
+        Restart streams, the next probabilities are considered as the first ones
+
+        :param streams: 	[list of int] or None for all streams
+        """
+        self.started[slice(None) if streams is None else streams] = False
+
+    def add_streams(self, nb):
+        """
+        Add new streams, not started
+
+        :param nb: 	[int]
+        :return: 	[list of int] indices of the new streams
+        """
+        idx = list(range(self.nb_streams, self.nb_streams + nb))
+
+        self.nb_streams += nb
+        self.buf = np.concatenate([self.buf, np.zeros((nb, ) + self.buf.shape[1:])])
+        self.head = np.concatenate([self.head, np.zeros(nb, dtype=int)])
+        for name in ['bmx', 'S', 'h']:
+            setattr(self, name, np.concatenate(
+                [getattr(self, name), np.zeros((nb, self.nb_states))]))
+        self.started = np.concatenate([self.started, np.zeros(nb, dtype=bool)])
+
+        return idx
+
+    def _update(self, buf, head, B, first, trans_reg=0., trans_diag=0.):
+        """
+        Scaling and probabilities of entering states after the forward variable over
+        durations was initialized (first) or shifted
+
+        :param B: 		np.array([nb, nb_states])
+                probabilities of the states from observations
+        :param first: 	np.array([nb], dtype=bool)
+        :return: 		bmx, S, h
+        """
+        sum_alpha = np.sum(buf, axis=2)
+        r = np.sum(B * sum_alpha, axis=1, keepdims=True)
+        bmx = B / r
+
+        alpha_0 = durations_alpha_0(buf, head)
+
+        trans = self.trans + np.eye(self.nb_states) * trans_diag + trans_reg
+        S = np.where(first[:, None], (bmx * alpha_0).dot(self.trans), alpha_0.dot(trans))
+
+        h = B * sum_alpha
+        h /= np.sum(h, axis=1, keepdims=True)
+
+        return bmx, S, h
+
+    def step(self, priors, streams=None, trans_reg=0., trans_diag=0.):
+        """
+        Update streams with the probabilities of the states given by one observation each
+
+        :param priors: 		np.array([nb_streams, nb_states]) or np.array([len(streams), nb_states])
+        :param streams: 	[list of int] or None for all streams
+        :param trans_reg: 	[float]
+        :param trans_diag: 	[float]
+        :return: 			np.array([nb, nb_states]) probabilities of the states
+        """
+        idx = np.arange(self.nb_streams) if streams is None else np.asarray(streams)
+        first = ~self.started[idx]
+
+        buf, head = self.buf[idx], self.head[idx]
+
+        buf[first] = self.start_priors[:, None] * self.Pd
+        head[first] = 0
+
+        if not np.all(first):
+            buf_, head_ = buf[~first], head[~first]
+            shift_durations(buf_, head_, self.S[idx[~first]], self.bmx[idx[~first]], self._Pd2)
+            buf[~first], head[~first] = buf_, head_
+
+        self.bmx[idx], self.S[idx], self.h[idx] = self._update(
+            buf, head, np.atleast_2d(priors), first, trans_reg, trans_diag)
+
+        self.buf[idx], self.head[idx] = buf, head
+        self.started[idx] = True
+
+        return self.h[idx]
+
+    def predict(self, n_step, priors, streams=None):
+        """
+        Probabilities of the states of started streams in the next steps, if the
+        probabilities given by observations stay the same. The state of the streams is not
+        changed, the prediction runs on buffers reused between calls.
+
+        :param n_step: 		[int]
+        :param priors: 		np.array([nb_states]) or np.array([nb, nb_states])
+        :param streams: 	[list of int] or None for all streams
+        :return: 			np.array([nb, nb_states, n_step])
+                the first step is the current state
+        """
+        idx = np.arange(self.nb_streams) if streams is None else np.asarray(streams)
+        B = np.broadcast_to(priors, (idx.shape[0], self.nb_states))
+
+        if self._scratch is None or self._scratch[0].shape[0] != idx.shape[0]:
+            self._scratch = (np.empty((idx.shape[0], ) + self.buf.shape[1:]),
+                             np.empty(idx.shape[0], dtype=int))
+        buf, head = self._scratch
+        np.take(self.buf, idx, axis=0, out=buf)
+        np.take(self.head, idx, out=head)
+
+        bmx, S = self.bmx[idx], self.S[idx]
+        first = np.zeros(idx.shape[0], dtype=bool)
+
+        h = np.zeros((idx.shape[0], self.nb_states, n_step))
+        h[:, :, 0] = self.h[idx]
+
+        for t in range(1, n_step):
+            shift_durations(buf, head, S, bmx, self._Pd2)
+            bmx, S, h[:, :, t] = self._update(buf, head, B, first)
+
+        return h
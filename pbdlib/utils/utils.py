@@ -203,7 +203,7 @@ def align_trajectories_hsmm(data, nb_states=5):
     model = HSMM(nb_dim=data[0].shape[1], nb_states=nb_states)
     model.init_hmm_kbins(data_vectorized)
 
-    qs = [model.viterbi(d) for d in data_vectorized]
+    qs = model.viterbi_batch(data_vectorized)
 
     time, sqs = list(zip(*[create_relative_time(q) for q in qs]))
 
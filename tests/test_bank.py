@@ -0,0 +1,53 @@
+import numpy as np
+
+import pbdlib as pbd
+
+
+def make_models():
+    rng = np.random.RandomState(0)
+    t = np.linspace(0, 1, 60)[:, None]
+
+    models, demos = [], []
+    for k, nb_states in enumerate([3, 5, 4]):
+        demos_k = [np.concatenate([t, np.sin((k + 2) * t) + rng.randn(60, 1) * 0.05,
+                                   rng.randn(60, 1) * 0.1], axis=1)
+                   for _ in range(3)]
+
+        model = pbd.HMM(nb_states=nb_states, nb_dim=3)
+        model.init_hmm_kbins(demos_k)
+        model.em(demos_k, reg=1e-3, nb_max_steps=5)
+
+        models += [model]
+        demos += demos_k
+
+    # sequences of different lengths
+    demos = [d[:40 + 5 * i] for i, d in enumerate(demos)]
+
+    return models, demos
+
+
+def test_hmm_bank_matches_models():
+    models, demos = make_models()
+
+    for marginal in [None, slice(0, 2)]:
+        x = demos if marginal is None else [d[:, marginal] for d in demos]
+        ref = np.array([m.log_likelihood(x, marginal=marginal) for m in models]).T
+
+        with pbd.HMMBank(models, marginal=marginal, batch_size=4) as bank:
+            np.testing.assert_allclose(bank.log_likelihood(x), ref, rtol=1e-8)
+            np.testing.assert_array_equal(bank.predict(x), np.argmax(ref, axis=1))
+
+    # log-likelihood from the scaling factors of forward-backward
+    for m, ll in zip(models, ref.T):
+        np.testing.assert_allclose(
+            [np.sum(-np.log(m.compute_messages(d, marginal=slice(0, 2))[4])) for d in x],
+            ll, rtol=1e-8)
+
+
+def test_hmm_bank_processes():
+    models, demos = make_models()
+
+    with pbd.HMMBank(models, n_jobs=2) as bank:
+        np.testing.assert_allclose(
+            bank.log_likelihood(demos),
+            np.array([m.log_likelihood(demos) for m in models]).T, rtol=1e-8)
@@ -0,0 +1,141 @@
+import numpy as np
+
+import pbdlib as pbd
+from pbdlib.em_utils import SufficientStats
+
+
+def make_data(seed=0):
+    rng = np.random.RandomState(seed)
+    centers = np.array([[0., 0.], [3., 1.], [-2., 4.]])
+    return np.concatenate([c + rng.randn(200, 2) * 0.5 for c in centers])
+
+
+def make_demos(nb_demos=6, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.linspace(0, 1, 80)[:, None]
+    return [np.concatenate([t, np.sin(6 * t) + rng.randn(80, 1) * 0.05], axis=1)
+            for _ in range(nb_demos)]
+
+
+def assert_stats_equal(a, b):
+    for k in ['s0', 's1', 's2', 'log_lik', 'nb_samples']:
+        np.testing.assert_allclose(getattr(a, k), getattr(b, k), rtol=1e-10, atol=1e-10)
+
+
+def test_sufficient_stats_merge_gmm():
+    data = make_data()
+
+    model = pbd.GMM(nb_states=3, nb_dim=2)
+    model.init_params_kmeans(data)
+
+    stats = model.e_step(data)
+    merged = sum([model.e_step(shard) for shard in np.array_split(data, 4)])
+
+    assert_stats_equal(stats, merged)
+    np.testing.assert_allclose(merged.covariance(), stats.covariance())
+
+    for cov_type in ['diag', 'spherical']:
+        assert_stats_equal(model.e_step(data, cov_type=cov_type), sum(
+            [model.e_step(shard, cov_type=cov_type) for shard in np.array_split(data, 3)]))
+
+
+def test_sufficient_stats_merge_hmm():
+    demos = make_demos()
+
+    model = pbd.HMM(nb_states=4, nb_dim=2)
+    model.init_hmm_kbins(demos)
+
+    stats = model.e_step(demos)
+    merged = model.e_step(demos[:2]) + model.e_step(demos[2:])
+
+    assert_stats_equal(stats, merged)
+    np.testing.assert_allclose(merged.transition(), stats.transition())
+    np.testing.assert_allclose(merged.init_priors(), stats.init_priors())
+
+
+def test_squarem_reaches_em_log_likelihood():
+    data = make_data(1)
+
+    init = pbd.GMM(nb_states=3, nb_dim=2)
+    init.init_params_random(data, rng=np.random.default_rng(0))
+
+    lls, nb_iters = [], []
+    for accelerate in [False, True]:
+        model = pbd.GMM(nb_states=3, nb_dim=2)
+        model.mu, model.sigma, model.priors = init.mu.copy(), init.sigma.copy(), \
+            init.priors.copy()
+
+        model.em(data, reg=1e-6, maxiter=500, minstepsize=1e-8, no_init=True, trace=True,
+                 accelerate=accelerate)
+
+        lls += [model._em_ll]
+        nb_iters += [model.em_trace.nb_iter]
+
+    assert lls[1] >= lls[0] - 1e-6
+    assert nb_iters[1] < nb_iters[0]
+
+
+def test_squarem_hmm():
+    demos = make_demos()
+
+    lls = []
+    for accelerate in [False, True]:
+        model = pbd.HMM(nb_states=4, nb_dim=2)
+        model.init_hmm_kbins(demos)
+        model.em(demos, reg=1e-4, nb_max_steps=100, accelerate=accelerate)
+
+        lls += [model._em_ll]
+
+    assert lls[1] >= lls[0] - 1e-3
+
+
+def test_em_restarts_keep_given_parameters_and_reproducible_seeds():
+    import pickle
+    from copy import deepcopy
+
+    demos = make_demos()
+
+    model = pbd.HMM(nb_states=4, nb_dim=2)
+    model.init_hmm_kbins(demos)
+    given = deepcopy(model)
+
+    model.em(demos, reg=1e-3, nb_max_steps=10, n_init=3, n_jobs=1, random_state=0)
+    restarts = pickle.loads(pickle.dumps(model.em_restarts))
+
+    # first restart from the given parameters
+    first = deepcopy(given)
+    first.em(demos, reg=1e-3, nb_max_steps=10)
+    assert restarts[0]['log_lik'] == first._em_ll
+
+    # other restarts reproduced from their seed
+    r = restarts[1]
+    seed = np.random.SeedSequence(r['entropy'], spawn_key=r['spawn_key'])
+
+    other = pbd.HMM(nb_states=4, nb_dim=2)
+    other.em(demos, reg=1e-3, nb_max_steps=10, rng=np.random.default_rng(seed))
+    assert r['log_lik'] == other._em_ll
+    assert r['log_lik'] != first._em_ll
+
+    assert model._em_ll == max(r['log_lik'] for r in restarts)
+
+
+def test_em_trace_aligned_with_iterations():
+    data = make_data(2)
+    demos = make_demos()
+
+    for accelerate in [False, True]:
+        gmm = pbd.GMM(nb_states=3, nb_dim=2)
+        gmm.em(data, reg=1e-6, trace=True, accelerate=accelerate,
+               rng=np.random.default_rng(0))
+
+        hmm = pbd.HMM(nb_states=4, nb_dim=2)
+        hmm.init_hmm_kbins(demos)
+        hmm.em(demos, reg=1e-3, trace=True, accelerate=accelerate)
+
+        for trace in [gmm.em_trace, hmm.em_trace]:
+            for name in ['e_step', 'm_step']:
+                assert len(trace.time[name]) == trace.nb_iter
+                assert len(trace.peak_memory[name]) == trace.nb_iter
+                assert all(t > 0. for t in trace.time[name])
+
+        assert len(gmm.em_trace.time['init']) == 1
@@ -0,0 +1,77 @@
+import numpy as np
+from scipy.stats import norm
+
+from pbdlib.functions import multi_variate_normal_diag, multi_variate_normal_batch
+
+
+def test_multi_variate_normal_diag_far_from_origin():
+    rng = np.random.RandomState(0)
+    nb_states, nb_dim = 3, 4
+
+    for offset in [1e4, 1e5]:
+        mu = offset + rng.randn(nb_states, nb_dim) * 1e-3
+        sigma_diag = np.full((nb_states, nb_dim), 1e-6)
+        x = offset + rng.randn(50, nb_dim) * 1e-3
+
+        exact = np.sum(norm.logpdf(x[None], mu[:, None], np.sqrt(sigma_diag)[:, None]),
+                       axis=2)
+
+        np.testing.assert_allclose(
+            multi_variate_normal_diag(x, mu, sigma_diag), exact, rtol=0, atol=1e-6)
+        np.testing.assert_allclose(
+            multi_variate_normal_diag(x, mu, sigma_diag, chunk_size=7), exact, rtol=0,
+            atol=1e-6)
+
+        sigma_chol = np.sqrt(sigma_diag)[:, :, None] * np.eye(nb_dim)[None]
+        np.testing.assert_allclose(
+            multi_variate_normal_batch(x, mu, sigma_chol), exact, rtol=0, atol=1e-6)
+
+
+def test_multi_variate_normal_diag_spherical():
+    rng = np.random.RandomState(1)
+    mu = rng.randn(2, 3)
+    sigma = np.array([[0.5], [2.]])
+    x = rng.randn(10, 3)
+
+    exact = np.sum(norm.logpdf(x[None], mu[:, None], np.sqrt(sigma)[:, None]), axis=2)
+
+    np.testing.assert_allclose(multi_variate_normal_diag(x, mu, sigma), exact)
+
+
+def test_multi_variate_normal_batch_full():
+    from scipy.stats import multivariate_normal
+
+    rng = np.random.RandomState(2)
+    mu = rng.randn(3, 4)
+    A = rng.randn(3, 4, 4)
+    sigma = np.matmul(A, np.swapaxes(A, 1, 2)) + 0.1 * np.eye(4)
+    x = rng.randn(20, 4)
+
+    exact = np.array([multivariate_normal(mu[i], sigma[i]).logpdf(x) for i in range(3)])
+
+    np.testing.assert_allclose(
+        multi_variate_normal_batch(x, mu, np.linalg.cholesky(sigma)), exact, rtol=1e-10)
+    np.testing.assert_allclose(
+        multi_variate_normal_batch(x, mu, np.linalg.cholesky(sigma), log=False),
+        np.exp(exact), rtol=1e-10)
+
+
+def test_block_structure_log_prob():
+    from scipy.stats import multivariate_normal
+    import pbdlib as pbd
+
+    rng = np.random.RandomState(3)
+    x = rng.randn(30, 5)
+
+    model = pbd.GMM(nb_states=2, nb_dim=5)
+    model.mu = rng.randn(2, 5)
+    A = rng.randn(2, 5, 5)
+    model.sigma = np.matmul(A, np.swapaxes(A, 1, 2)) + 0.1 * np.eye(5)
+
+    dep = [[0, 2], slice(3, 5), [1]]
+    blocks = model.get_block_structure(dep)
+    sigma = model.sigma * blocks.mask
+
+    exact = np.array([multivariate_normal(model.mu[i], sigma[i]).logpdf(x) for i in range(2)])
+
+    np.testing.assert_allclose(model.mvn_log_prob(x, dep=dep), exact, rtol=1e-10)
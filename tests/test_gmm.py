@@ -0,0 +1,36 @@
+import numpy as np
+
+import pbdlib as pbd
+
+
+def make_data(seed=0):
+    rng = np.random.RandomState(seed)
+    centers = np.array([[0., 0.], [4., 0.], [0., 4.]])
+    data = np.concatenate([c + rng.randn(1000, 2) * 0.5 for c in centers])
+
+    return data[rng.permutation(data.shape[0])]
+
+
+def test_em_stream_matches_em():
+    data = make_data()
+
+    init = pbd.GMM(nb_states=3, nb_dim=2)
+    init.reg = 1e-6
+    init.init_params_kmeans(data[:300], rng=np.random.default_rng(0))
+
+    batch = pbd.GMM(nb_states=3, nb_dim=2)
+    batch.mu, batch.sigma, batch.priors = init.mu, init.sigma, init.priors
+    batch.em(data, reg=1e-6, no_init=True)
+
+    stream = pbd.GMM(nb_states=3, nb_dim=2)
+    stream.mu, stream.sigma, stream.priors = init.mu, init.sigma, init.priors
+
+    # three passes over the data, in chunks of 100 samples
+    chunks = (data[i:i + 100] for epoch in range(3) for i in range(0, data.shape[0], 100))
+    ll = stream.em_stream(chunks, reg=1e-6)
+
+    assert ll.shape == (90, )
+    assert np.mean(ll[-30:]) > np.mean(ll[:5])
+    np.testing.assert_allclose(stream.mu, batch.mu, atol=0.05)
+    np.testing.assert_allclose(stream.sigma, batch.sigma, atol=0.05)
+    np.testing.assert_allclose(stream.priors, batch.priors, atol=0.02)
@@ -0,0 +1,215 @@
+import numpy as np
+
+import pbdlib as pbd
+
+
+def make_demos(nb_demos=4, nb_timestep=100, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.linspace(0, 1, nb_timestep)[:, None]
+    return [np.concatenate([t, np.sin(6 * t) + rng.randn(nb_timestep, 1) * 0.05], axis=1)
+            for _ in range(nb_demos)]
+
+
+def test_em_stream_hmm():
+    demos = make_demos()
+
+    model = pbd.HMM(nb_states=4, nb_dim=2)
+    model.init_hmm_kbins(demos)
+
+    ll = model.em_stream(iter(demos), reg=1e-3)
+
+    assert ll.shape == (len(demos), )
+    assert np.all(np.isfinite(ll))
+    assert np.all(np.isfinite(model.mu)) and np.all(np.isfinite(model.sigma))
+
+
+def test_online_update_keeps_stream_state():
+    demos = make_demos()
+
+    model = pbd.HMM(nb_states=4, nb_dim=2)
+    model.init_hmm_kbins(demos)
+
+    model.em_stream(iter(demos[:2]), reg=1e-3)
+    stream_count = model._stream_count
+
+    model.online_update(demos[2], new_sequence=True)
+    assert model._stream_count == stream_count
+
+    ll = model.partial_fit(demos[3])
+    assert np.isfinite(ll)
+    assert model._stream_count == stream_count + 1
+
+
+def test_compute_messages_batch_matches_compute_messages():
+    rng = np.random.RandomState(2)
+    demos = [np.cumsum(rng.randn(l, 2), axis=0) * 0.1 for l in [30, 300, 35, 280, 900, 40]]
+
+    model = pbd.HMM(nb_states=5, nb_dim=2)
+    model.init_hmm_kbins(demos)
+
+    # default buckets, and small buckets with demos alone in theirs
+    for max_size in [2 ** 22, 500]:
+        for zeta_sum in [True, False]:
+            messages = model.compute_messages_batch(demos, zeta_sum=zeta_sum,
+                                                    max_size=max_size)
+
+            for n, demo in enumerate(demos):
+                ref = model.compute_messages(demo, zeta_sum=zeta_sum)
+                for r, m in zip(ref, messages):
+                    np.testing.assert_allclose(m[n], r, atol=1e-10)
+
+
+def test_velocity_conditioning_follows_setters():
+    rng = np.random.RandomState(3)
+    demos = [np.cumsum(rng.randn(80, 4), axis=0) * 0.1 for _ in range(3)]
+
+    model = pbd.HMM(nb_states=3, nb_dim=4)
+    model.init_hmm_kbins(demos)
+
+    q = demos[0][10, :2]
+    qdot = model.predict_qdot(q, 0)
+    c = model.get_velocity_conditioning(2)
+
+    # computed once, kept across ticks
+    model.predict_qdot(q, 1)
+    assert model.get_velocity_conditioning(2) is c
+
+    # in-place edits are not detected until reset
+    model.mu[:, 2:] += 1.
+    np.testing.assert_allclose(model.predict_qdot(q, 0), qdot)
+
+    model.get_velocity_conditioning(2, reset=True)
+    np.testing.assert_allclose(model.predict_qdot(q, 0), qdot + 1.)
+
+    # set parameters invalidate the conditioning
+    model.mu = model.mu - np.array([0., 0., 1., 1.])
+    np.testing.assert_allclose(model.predict_qdot(q, 0), qdot)
+
+
+def test_trans_band_cached_and_detected_after_kbins():
+    demos = make_demos(nb_demos=5, nb_timestep=200)
+
+    model = pbd.HMM(nb_states=8, nb_dim=2)
+    model.init_hmm_kbins(demos)
+    assert model.trans_band is None
+
+    model.em(demos, reg=1e-3, nb_max_steps=10)
+
+    band = model.trans_band
+    assert band is not None and model.trans_band is band
+    np.testing.assert_array_equal(band.offsets, [0, 1])
+
+    # same results with the dense transition matrix
+    dense = pbd.HMM(nb_states=8, nb_dim=2)
+    dense.trans_band_tol = -1.
+    dense.mu, dense.sigma, dense.init_priors = model.mu, model.sigma, model.init_priors
+    dense.Trans = model.Trans
+    assert dense.trans_band is None
+
+    for demo in demos:
+        for m, d in zip(model.compute_messages(demo, zeta_sum=True),
+                        dense.compute_messages(demo, zeta_sum=True)):
+            np.testing.assert_allclose(m, d, rtol=1e-8, atol=1e-12)
+
+        np.testing.assert_array_equal(model.viterbi(demo), dense.viterbi(demo))
+
+    # setting Trans updates the band
+    model.Trans = np.ones((8, 8)) / 8.
+    assert model.trans_band is None
+
+
+def viterbi_reference(model, demo):
+    log_B = model.obs_likelihood(demo)[1]
+    with np.errstate(divide='ignore'):
+        log_trans, log_init = np.log(model.Trans), np.log(model.init_priors)
+
+    delta = log_init + log_B[:, 0]
+    psi = np.zeros(log_B.shape, dtype=int)
+    for t in range(1, log_B.shape[1]):
+        scores = delta[:, None] + log_trans
+        psi[:, t] = np.argmax(scores, axis=0)
+        delta = np.max(scores, axis=0) + log_B[:, t]
+
+    path = [int(np.argmax(delta))]
+    for t in range(log_B.shape[1] - 1, 0, -1):
+        path += [psi[path[-1], t]]
+
+    return path[::-1]
+
+
+def test_viterbi_batch_matches_reference():
+    demos = make_demos(nb_demos=5, nb_timestep=120)
+    demos = [d[:60 + 15 * i] for i, d in enumerate(demos)]
+
+    model = pbd.HMM(nb_states=8, nb_dim=2)
+    model.init_hmm_kbins(demos)
+
+    # dense transitions, then banded after EM
+    for em in [False, True]:
+        if em:
+            model.em(demos, reg=1e-3)
+            assert model.trans_band is not None
+
+        paths = model.viterbi_batch(demos)
+        for demo, path in zip(demos, paths):
+            assert list(path) == viterbi_reference(model, demo)
+            assert model.viterbi(demo) == list(path)
+
+
+def test_forward_messages():
+    demos = make_demos()
+
+    model = pbd.HMM(nb_states=4, nb_dim=2)
+    model.init_hmm_kbins(demos)
+
+    alpha, c = model.forward_messages(demos[0])
+    ref = model.compute_messages(demos[0])
+    np.testing.assert_allclose(alpha, ref[0])
+    np.testing.assert_allclose(c, ref[4])
+
+    log_alpha, log_c = model.forward_messages(demos[0], log=True)
+    np.testing.assert_allclose(np.exp(log_alpha), alpha, atol=1e-12)
+    np.testing.assert_allclose(log_c, np.log(c))
+
+
+def test_em_incremental():
+    from copy import deepcopy
+
+    demos = make_demos(nb_demos=8)
+
+    model = pbd.HMM(nb_states=5, nb_dim=2)
+    model.init_hmm_kbins(demos[:6])
+    model.em(demos[:6], reg=1e-3)
+    full = deepcopy(model)
+
+    # nothing to recompute without changes
+    mu = model.mu.copy()
+    assert model.em_incremental(demos[:6])
+    np.testing.assert_allclose(model.mu, mu)
+
+    # new demonstrations, close to EM on all demonstrations from the same parameters
+    assert model.em_incremental(demos)
+    full.em(demos, reg=1e-3)
+
+    np.testing.assert_allclose(model.mu, full.mu, atol=1e-2)
+    np.testing.assert_allclose(model._em_ll, full._em_ll, rtol=1e-3)
+    assert set(model._demo_stats) == set(pbd.em_utils.demo_key(d) for d in demos)
+
+
+def test_em_process_pool():
+    demos = make_demos(nb_demos=6)
+
+    models = []
+    for n_jobs in [None, 2]:
+        model = pbd.HMM(nb_states=4, nb_dim=2)
+        model.init_hmm_kbins(demos)
+        model.em(demos, reg=1e-3, n_jobs=n_jobs)
+        models += [model]
+
+    np.testing.assert_allclose(models[1].mu, models[0].mu, rtol=1e-10)
+    np.testing.assert_allclose(models[1].Trans, models[0].Trans, rtol=1e-10, atol=1e-14)
+    np.testing.assert_allclose(models[1]._em_ll, models[0]._em_ll, rtol=1e-12)
+
+    # statistics of the pool are kept for em_incremental
+    assert len(models[1]._demo_stats) == len(demos)
+    assert models[1].em_incremental(demos)
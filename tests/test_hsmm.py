@@ -0,0 +1,105 @@
+import numpy as np
+
+import pbdlib as pbd
+
+
+def make_model(seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.linspace(0, 1, 150)[:, None]
+    demos = [np.concatenate([t, np.sin(6 * t) + rng.randn(150, 1) * 0.05], axis=1)
+             for _ in range(4)]
+
+    model = pbd.HSMM(nb_states=5, nb_dim=2)
+    model.init_hmm_kbins(demos)
+
+    # durations of about 30 timesteps, transitions to the next states
+    model.Mu_Pd = np.full(model.nb_states, 30.)
+    model.Sigma_Pd = np.full(model.nb_states, 25.)
+    model.Trans_Pd = np.roll(np.eye(model.nb_states), 1, axis=1) * 0.8 + \
+        np.roll(np.eye(model.nb_states), 2, axis=1) * 0.2
+
+    return model, demos
+
+
+def forward_reference(model, B, nbD):
+    """
+    HSMM forward variable with the full duration table and ALPHA shifted by copy
+    """
+    Pd = np.array([pbd.multi_variate_normal(np.arange(nbD), model.Mu_Pd[i],
+                                            model.Sigma_Pd[i], log=False)
+                   for i in range(model.nb_states)])
+    Pd /= np.sum(Pd, axis=1, keepdims=True)
+
+    ALPHA = model.init_priors[:, None] * Pd
+    h = np.zeros(B.shape)
+
+    for t in range(B.shape[1]):
+        if t > 0:
+            ALPHA = S[:, None] * Pd + bmx[:, None] * np.concatenate(
+                [ALPHA[:, 1:], np.zeros((model.nb_states, 1))], axis=1)
+
+        bmx = B[:, t] / B[:, t].dot(np.sum(ALPHA, axis=1))
+        S = model.Trans_Pd.T.dot(bmx * ALPHA[:, 0] if t == 0 else ALPHA[:, 0])
+        h[:, t] = B[:, t] * np.sum(ALPHA, axis=1)
+
+    return h / np.sum(h, axis=0)
+
+
+def test_forward_variable_matches_reference():
+    model, demos = make_model()
+    demo = demos[0]
+
+    h = model.forward_variable(demo=demo)
+
+    # truncated duration table
+    assert model.Pd.shape[1] < int(np.round(4 * demo.shape[0] / model.nb_states))
+
+    B, _ = model.obs_likelihood(demo)
+    ref = forward_reference(model, B, int(np.round(4 * demo.shape[0] / model.nb_states)))
+
+    np.testing.assert_allclose(h, ref, atol=1e-6)
+
+
+def test_hsmm_filter_matches_reference():
+    model, demos = make_model()
+    nbD = 80
+
+    B = [model.obs_likelihood(demo)[0] for demo in demos[:3]]
+    f = pbd.HSMMFilter(model, nbD, nb_streams=3)
+
+    # streams started at different timesteps
+    h = np.zeros((3, model.nb_states, 150))
+    for t in range(150):
+        streams = [s for s in range(3) if t >= 10 * s]
+        h[streams, :, t - 10 * np.array(streams)] = f.step(
+            np.array([B[s][:, t - 10 * s] for s in streams]), streams=streams)
+
+    for s in range(3):
+        n = 150 - 10 * s
+        ref = forward_reference(model, B[s][:, :n], nbD)
+        np.testing.assert_allclose(h[s, :, :n], ref, atol=1e-10)
+
+
+def test_duration_table():
+    model, _ = make_model()
+    nbD = 100
+
+    Pd = model.get_duration_table(nbD)
+    assert model.get_duration_table(nbD) is Pd
+    assert not Pd.flags.writeable
+
+    ref = np.array([pbd.multi_variate_normal(np.arange(nbD), model.Mu_Pd[i],
+                                             model.Sigma_Pd[i], log=False)
+                    for i in range(model.nb_states)])
+    np.testing.assert_allclose(Pd, ref / np.sum(ref, axis=1, keepdims=True))
+
+    # truncated to the support of the states
+    Pd_t = model.get_duration_table(nbD, tail_mass=1e-8)
+    assert Pd_t.shape[1] < nbD
+    np.testing.assert_allclose(np.sum(Pd_t, axis=1), 1.)
+    np.testing.assert_allclose(Pd_t, Pd[:, :Pd_t.shape[1]], atol=1e-8)
+
+    # tables are dropped when the duration model is set
+    model.Mu_Pd = np.full(model.nb_states, 10.)
+    assert model.get_duration_table(nbD) is not Pd
+    assert np.argmax(model.get_duration_table(nbD)[0]) == 10
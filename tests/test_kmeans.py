@@ -0,0 +1,51 @@
+import numpy as np
+
+import pbdlib as pbd
+from pbdlib.kmeans import sq_distances, assign_clusters
+
+
+def make_data(offset=0., seed=0):
+    rng = np.random.RandomState(seed)
+    centers = offset + np.array([[0., 0.], [5., 0.], [0., 5.], [5., 5.]])
+    labels = np.repeat(np.arange(4), 250)
+
+    return centers[labels] + rng.randn(1000, 2) * 0.3, centers, labels
+
+
+def test_sq_distances_far_from_origin():
+    rng = np.random.RandomState(1)
+    x = 1e6 + rng.randn(50, 3) * 1e-3
+    centers = 1e6 + rng.randn(4, 3) * 1e-3
+
+    exact = np.sum((x[:, None] - centers[None]) ** 2, axis=2)
+    np.testing.assert_allclose(sq_distances(x, centers), exact, rtol=1e-6)
+
+    labels, d = assign_clusters(x, centers, chunk_size=7)
+    np.testing.assert_array_equal(labels, np.argmin(exact, axis=1))
+
+
+def test_kmeans_recovers_clusters():
+    for offset in [0., 1e5]:
+        data, centers, labels = make_data(offset)
+
+        for batch_size in [None, 100]:
+            found, found_labels = pbd.kmeans(data, 4, batch_size=batch_size,
+                                             rng=np.random.default_rng(0))
+
+            # each true center is matched by one found center
+            match = np.argmin(sq_distances(centers, found), axis=1)
+            assert np.unique(match).shape[0] == 4
+            np.testing.assert_allclose(found[match], centers, atol=0.1)
+            assert np.mean(match[labels] == found_labels) > 0.99
+
+
+def test_gmm_em_kmeans_init():
+    data, centers, _ = make_data()
+
+    model = pbd.GMM(nb_states=4, nb_dim=2)
+    model.em(data, reg=1e-6, random_init=False, kmeans_init=True,
+             rng=np.random.default_rng(0))
+
+    match = np.argmin(sq_distances(centers, model.mu), axis=1)
+    np.testing.assert_allclose(model.mu[match], centers, atol=0.1)
+    np.testing.assert_allclose(model.priors, 0.25, atol=0.01)
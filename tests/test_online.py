@@ -0,0 +1,72 @@
+import numpy as np
+
+import pbdlib as pbd
+from pbdlib.online import HMMFilter
+
+
+def make_model(cov_type='full', seed=0):
+    rng = np.random.RandomState(seed)
+    demos = [np.cumsum(rng.randn(60, 3), axis=0) * 0.1 for _ in range(4)]
+
+    model = pbd.HMM(nb_states=4, nb_dim=3)
+    model.init_hmm_kbins(demos)
+    if cov_type != 'full':
+        model.sigma_diag = np.diagonal(model.sigma, axis1=1, axis2=2).copy()
+
+    return model, demos
+
+
+def test_hmm_filter_matches_forward_messages():
+    for cov_type in ['full', 'diag']:
+        model, demos = make_model(cov_type)
+
+        f = HMMFilter(model, nb_streams=len(demos))
+        for t in range(demos[0].shape[0]):
+            alpha = f.step(np.array([d[t] for d in demos]))
+
+        for n, demo in enumerate(demos):
+            ref, _ = model.forward_messages(demo)
+            np.testing.assert_allclose(alpha[n], ref[:, -1], atol=1e-10)
+
+
+def test_online_forward_message_follows_parameters():
+    model, demos = make_model()
+    x = demos[0]
+    mu = model.mu.copy()
+
+    for t in range(x.shape[0]):
+        if t == 30:
+            model.mu = mu + 0.1
+        alpha = model.online_forward_message(x[t], reset=t == 0)
+
+    # forward recursion reading the current parameters at each step
+    ref = None
+    model.mu = mu
+    for t in range(x.shape[0]):
+        if t == 30:
+            model.mu = mu + 0.1
+        b = model.obs_likelihood(x[t][None])[0][:, 0]
+        ref = model.init_priors * b if ref is None else ref.dot(model.Trans) * b
+        ref /= np.sum(ref)
+
+    np.testing.assert_allclose(alpha, ref, atol=1e-10)
+
+
+def test_fixed_lag_smoother_matches_offline():
+    model, demos = make_model()
+    x = demos[0]
+    lag = 5
+
+    f = pbd.FixedLagSmoother(model, lag)
+    for t in range(x.shape[0]):
+        gamma = f.step(x[t][None])[0]
+
+        if t < lag:
+            assert np.all(np.isnan(gamma))
+        else:
+            # smoothed with the observations up to t
+            ref = model.compute_messages(x[:t + 1])[2][:, t - lag]
+            np.testing.assert_allclose(gamma, ref, atol=1e-8)
+
+    ref = model.compute_messages(x)[2]
+    np.testing.assert_allclose(f.flush(), ref[:, -lag:].T, atol=1e-8)